@@ -27,6 +27,7 @@ from subprocess import check_output, CalledProcessError
 
 from systemimage.apply import factory_reset, production_reset
 from systemimage.state import State
+from systemimage.statistics import statistics
 from systemimage.config import config
 
 
@@ -111,32 +112,59 @@ class Mediator:
         :rtype: bool
         """
         if self._update is None:
+            statistics.increment('checks')
             try:
-                self._state.run_until('download_files')
+                # An earlier process may have already done the check.
+                if not self._resume():
+                    self._state.run_until('download_files')
+                    self._state.save_check()
             except Exception as error:
                 # Rather than letting this percolate up, eventually reaching
                 # the GLib main loop and thus triggering apport, Let's log the
                 # error and set the relevant information in the class.
                 log.exception('check_for_update failed')
+                statistics.failure(type(error).__name__)
                 self._update = Update(error=str(error))
             else:
-                self._update = Update(self._state.winner)
-                self._channels = list()
-                for key in sorted(self._state.channels):
-                    channel = self._state.channels[key]
-
-                    # Ignore channels that are not installable on this device
-                    if self._config.device not in channel["devices"]:
-                        continue
-
-                    self._channels.append(dict(
-                        hidden=channel.get('hidden'),
-                        alias=channel.get('alias'),
-                        redirect=channel.get('redirect'),
-                        name=key
-                    ))
+                self._set_update()
         return self._update
 
+    def resume_check(self):
+        """Resume from the check saved by an earlier process.
+
+        See `State.resume_check()`.
+
+        :return: The available update, or None if there's no saved check
+            which is still fresh.
+        """
+        if self._update is None and self._resume():
+            self._set_update()
+        return self._update
+
+    def _resume(self):
+        try:
+            return self._state.resume_check()
+        except Exception:
+            # Just do the full check.  Whatever went wrong will most likely
+            # go wrong again, and be reported, if it matters.
+            log.exception('Cannot resume the saved check')
+            return False
+
+    def _set_update(self):
+        self._update = Update(self._state.winner)
+        self._channels = list()
+        # Only look at the channels which are installable on this device, so
+        # the others never get parsed.
+        channels = self._state.channels
+        for key in channels.installable(self._config.device):
+            channel = channels[key]
+            self._channels.append(dict(
+                hidden=channel.get('hidden'),
+                alias=channel.get('alias'),
+                redirect=channel.get('redirect'),
+                name=key
+            ))
+
     def download(self):
         """Download the available update."""
         # We only want callback progress during the actual download.
@@ -30,6 +30,7 @@ import logging
 from subprocess import CalledProcessError, check_call
 from systemimage.config import config
 from systemimage.helpers import atomic
+from systemimage.trace import tracer
 
 log = logging.getLogger('systemimage')
 
@@ -46,6 +47,7 @@ class Reboot(BaseApply):
     """Apply the update by rebooting the device."""
 
     def apply(self):
+        tracer.add_subprocess()
         try:
             check_call('/sbin/reboot -f recovery'.split(),
                        universal_newlines=True)
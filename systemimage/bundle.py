@@ -0,0 +1,283 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Offline update bundles.
+
+A bundle holds everything a device needs to upgrade along one winning path:
+the keyrings, channels.json, the index, and the update files, along with all
+their signatures, exactly as they were downloaded from the server.  When a
+device sideloads a bundle, its state machine runs just as it would online,
+except that its downloads come from the bundle.  Every signature and checksum
+is verified in exactly the same way.
+
+A bundle is an uncompressed tar file, with each file stored under its path
+on the server.  Since the update files are already compressed, nothing is
+lost by not compressing the bundle, and the files can be copied straight out
+of a memory map of it.
+"""
+
+__all__ = [
+    'BundleDownloadManager',
+    'BundleReader',
+    'BundleWriter',
+    'export',
+    ]
+
+
+import os
+import json
+import mmap
+import hashlib
+import logging
+import tarfile
+
+from contextlib import ExitStack
+from io import BytesIO
+from systemimage.candidates import iter_path
+from systemimage.config import config
+from systemimage.download import Canceled, DownloadManagerBase, Record
+from systemimage.gpg import Context
+from systemimage.helpers import (
+    calculate_signature, safe_remove, temporary_directory)
+from urllib.parse import urljoin, urlparse
+
+
+log = logging.getLogger('systemimage')
+
+# The bundle's own description of what's in it.
+MANIFEST = 'bundle.json'
+# How much to copy out of the bundle at a time, so that progress can be
+# reported and downloads canceled.
+CHUNK_SIZE = 1024 * 1024
+
+
+def _name(url):
+    # Files are stored in the bundle under their path on the server.
+    return urlparse(url).path.lstrip('/')
+
+
+class BundleWriter:
+    """Record every file downloaded into a new bundle.
+
+    While `config.export_bundle` is set to a writer, every group of files
+    downloaded is added to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp = path + '.tmp'
+        self._tar = tarfile.open(self._tmp, 'w', format=tarfile.PAX_FORMAT)
+        self.names = set()
+
+    def add(self, path, name):
+        """Add a local file to the bundle.
+
+        A file added under a name which is already in the bundle replaces
+        the earlier one.
+        """
+        self._tar.add(path, arcname=name, recursive=False)
+        self.names.add(name)
+
+    def record(self, records):
+        """Add downloaded files to the bundle.
+
+        :param records: The download `Record`s.
+        """
+        for record in records:
+            self.add(record.destination, _name(record.url))
+
+    def close(self, manifest):
+        """Finish the bundle and move it into place.
+
+        :param manifest: A dictionary describing the bundle.
+        """
+        data = json.dumps(manifest, indent=4, sort_keys=True).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        self._tar.addfile(info, BytesIO(data))
+        self._tar.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        """Throw the unfinished bundle away."""
+        self._tar.close()
+        safe_remove(self._tmp)
+
+
+class BundleReader:
+    """Read the files in a bundle from a memory map of it.
+
+    :raises ValueError: when the file isn't a bundle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            # Map each file's name to its offset and size in the bundle.  When
+            # a file was recorded more than once, the last one wins.
+            try:
+                with tarfile.open(fileobj=fp, mode='r:') as tar:
+                    self._members = {
+                        member.name: (member.offset_data, member.size)
+                        for member in tar if member.isfile()
+                        }
+            except tarfile.TarError as error:
+                raise ValueError('Not a bundle: {}'.format(error)) from None
+            if MANIFEST not in self._members:
+                raise ValueError('Not a bundle: no {}'.format(MANIFEST))
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.manifest = json.loads(bytes(self.view(MANIFEST)).decode('utf-8'))
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def view(self, name):
+        """Return a file's contents, without copying them.
+
+        :param name: The file's path on the server.
+        :return: A memoryview of the file's contents.
+        :raises KeyError: when the file isn't in the bundle.
+        """
+        offset, size = self._members[name]
+        return memoryview(self._map)[offset:offset + size]
+
+    def close(self):
+        self._map.close()
+
+
+class BundleDownloadManager(DownloadManagerBase):
+    """Download files from a bundle instead of the network.
+
+    Files which aren't in the bundle are missing, just like files which
+    aren't on the server.
+    """
+
+    def __init__(self, bundle, callback=None):
+        super().__init__()
+        self.bundle = bundle
+        # Copying out of the bundle is no measure of the network.
+        self.record_statistics = False
+        if callback is not None:
+            self.callbacks.append(callback)
+
+    def _get_files(self, records, pausable, signal_started):
+        views = []
+        for record in records:
+            try:
+                views.append(self.bundle.view(_name(record.url)))
+            except KeyError:
+                raise FileNotFoundError(record.url) from None
+        self.total = sum(len(view) for view in views)
+        with ExitStack() as resources:
+            # Like the other download managers, don't leave any files behind
+            # if anything goes wrong.
+            for record in records:
+                resources.callback(safe_remove, record.destination)
+            for record, view in zip(records, views):
+                checksum = hashlib.sha256()
+                with open(record.destination, 'xb') as fp:
+                    for offset in range(0, len(view), CHUNK_SIZE):
+                        chunk = view[offset:offset + CHUNK_SIZE]
+                        fp.write(chunk)
+                        checksum.update(chunk)
+                        self.received += len(chunk)
+                        self._do_callback()
+                        if self._queued_cancel:
+                            raise Canceled
+                if record.checksum not in ('', checksum.hexdigest()):
+                    # For backward compatibility with ubuntu-download_manager.
+                    raise FileNotFoundError(
+                        'HASH ERROR: {}'.format(record.destination))
+            resources.pop_all()
+
+
+def _get_files(state, tmpdir):
+    # Download and verify the winning path's files, just like the state
+    # machine would, so that they're recorded in the bundle.
+    from systemimage.state import ChecksumError
+    keyrings = [config.gpg.image_signing]
+    if os.path.exists(config.gpg.device_signing):
+        keyrings.append(config.gpg.device_signing)
+    downloads = []
+    checksums = []
+    for image_number, filerec in iter_path(state.winner):
+        dst = os.path.join(tmpdir, os.path.basename(filerec.path))
+        asc = os.path.join(tmpdir, os.path.basename(filerec.signature))
+        downloads.append(Record(
+            urljoin(config.http_base, filerec.path), dst, filerec.checksum))
+        downloads.append(Record(
+            urljoin(config.http_base, filerec.signature), asc))
+        checksums.append((dst, asc, filerec.checksum))
+    state.downloader.get_files(downloads, pausable=True)
+    with Context(*keyrings, blacklist=state.blacklist) as ctx:
+        for dst, asc, checksum in checksums:
+            ctx.validate(asc, dst)
+    for dst, asc, checksum in checksums:
+        with open(dst, 'rb') as fp:
+            got = calculate_signature(fp)
+        if got != checksum:
+            raise ChecksumError(dst, got, checksum)
+
+
+def export(path):
+    """Export the configured device's winning upgrade path to a bundle.
+
+    The state machine is run through calculating the winning path, and the
+    files for that path are downloaded and verified.  The bundle is only
+    written if everything checks out.
+
+    :param path: The bundle file to write.
+    :return: The winning path, which may be empty if the device is already
+        up-to-date, in which case no bundle is written.
+    """
+    # Avoid circular imports.
+    from systemimage.state import State
+    writer = BundleWriter(path)
+    config.export_bundle = writer
+    try:
+        state = State()
+        # These aren't the device's own downloads.
+        state.downloader.record_statistics = False
+        state.run_thru('calculate_winner')
+        if state.winner is None or len(state.winner) == 0:
+            writer.abort()
+            return []
+        with temporary_directory() as tmpdir:
+            _get_files(state, tmpdir)
+        # Keyrings which were already cached locally weren't downloaded, but
+        # a device sideloading the bundle may not have them.
+        local_keyrings = [
+            (config.gpg.image_master, 'gpg/image-master.tar.xz'),
+            (config.gpg.image_signing, 'gpg/image-signing.tar.xz'),
+            ]
+        if state.blacklist is not None:
+            local_keyrings.append((state.blacklist, 'gpg/blacklist.tar.xz'))
+        for local, name in local_keyrings:
+            for suffix in ('', '.asc'):
+                if name + suffix not in writer.names:
+                    writer.add(local + suffix, name + suffix)
+    except:
+        writer.abort()
+        raise
+    finally:
+        config.export_bundle = None
+    writer.close(dict(
+        channel=config.channel,
+        device=config.device,
+        build_number=config.build_number,
+        path=[image.version for image in state.winner],
+        ))
+    log.info('Exported {} files to {}', len(writer.names), path)
+    return state.winner
@@ -19,53 +19,115 @@ __all__ = [
     'delta_filter',
     'full_filter',
     'get_candidates',
+    'iter_candidates',
     'iter_path',
     'version_filter',
     ]
 
 
-from collections import deque
+import logging
+
+from collections import defaultdict, deque
+from systemimage.trace import traced
+
+
+log = logging.getLogger('systemimage')
+
+# The default caps for iter_candidates().  Real indexes come nowhere near
+# these, but an index with many parallel deltas could otherwise produce more
+# candidate paths than there's memory or time to score.
+MAX_PATHS = 1000
+MAX_DEPTH = 250
+BEAM_WIDTH = 100
+
+
+class _Step:
+    # One image in a candidate upgrade path, linked back to the image before
+    # it.  Paths which fork share everything up to the fork, rather than each
+    # getting a copy.
+    __slots__ = ('image', 'parent', 'depth', 'score')
+
+    def __init__(self, image, parent, score):
+        self.image = image
+        self.parent = parent
+        if parent is None:
+            self.depth = 1
+            self.score = score(image)
+        else:
+            self.depth = parent.depth + 1
+            self.score = parent.score + score(image)
+
+    def path(self):
+        images = []
+        step = self
+        while step is not None:
+            images.append(step.image)
+            step = step.parent
+        images.reverse()
+        return images
 
 
 class _Chaser:
-    def __init__(self):
-        # Paths are represented by lists, so we need to listify each element
-        # of the initial set of roots.
+    def __init__(self, beam_width):
         self._paths = deque()
+        self._beam_width = beam_width
+        self.pruned = 0
+
+    def __len__(self):
+        return len(self._paths)
 
     def __iter__(self):
         while self._paths:
             yield self._paths.pop()
 
-    def push(self, new_path):
-        # new_path must be a list.
-        self._paths.appendleft(new_path)
+    def push(self, new_step):
+        self._paths.appendleft(new_step)
+        # Only keep the best scoring paths waiting to be chased.  Of those
+        # which score the same, drop the one which has gotten the least far.
+        if (self._beam_width is not None
+                and len(self._paths) > self._beam_width):
+            self._paths.remove(max(
+                self._paths,
+                key=lambda step: (step.score, -step.image.version)))
+            self.pruned += 1
 
 
-def get_candidates(index, build):
-    """Calculate all the candidate upgrade paths.
+def _no_score(image):
+    return 0
 
-    This function returns a list of candidate upgrades paths, from the
-    current build number to the latest build available in the index
-    file.
 
-    Each element of this list of candidates is itself a list of `Image`
-    objects, in the order that they should be applied to upgrade the
-    device.
+def iter_candidates(index, build, *, score=None, max_paths=MAX_PATHS,
+                    max_depth=MAX_DEPTH, beam_width=BEAM_WIDTH):
+    """Generate the candidate upgrade paths.
 
-    The upgrade candidate chains are not sorted, ordered, or prioritized
-    in any way.  They are simply the list of upgrades that will satisfy
-    the requirements.  It is possible that there are no upgrade candidates if
-    the device is already at the latest build, or if the device is at a build
-    too old to update.
+    This is like `get_candidates()` except that the paths are generated one
+    at a time, and there are limits on how many there can be.  Whenever a
+    limit is hit, it is logged.  Any limit can be turned off by passing None.
 
     :param index: The index of available upgrades.
     :type index: An `Index`
     :param build: The build version number that the device is currently at.
-    :type build: str
-    :return: list-of-lists of upgrade paths.  The empty list is returned if
-        there are no candidate paths.
+    :type build: int
+    :param score: A function which takes an image and returns the amount
+        that image adds to the running score of any path it's in.  Lower is
+        better.  See `Scorer.running_score()`.
+    :param max_paths: Stop after generating this many paths.
+    :param max_depth: Drop paths which are longer than this many images.
+        Since they don't reach the latest build, they aren't candidates.
+    :param beam_width: At most this many paths which forked off the one being
+        followed are remembered, to be followed later.  When there are more,
+        the one with the worst running score is dropped.  Without a `score`,
+        there's no telling which is worst, so nothing is dropped.
+    :return: An iterator over the upgrade paths, each a list of `Image`s.
+
+    Note that `Scorer.choose()` still collects all the paths into a list
+    before it scores them, because a path's score depends on the other paths
+    (e.g. how much bigger it is than the smallest one).  So it's `max_paths`,
+    not the laziness, which keeps that from growing without bound.
     """
+    if score is None:
+        score = _no_score
+        beam_width = None
     # Start by splitting the images into fulls and delta.  Throw out any full
     # updates which have a minimum version greater than our version.
     fulls = set()
@@ -79,47 +141,99 @@ def get_candidates(index, build):
         else: # pragma: no cover
             # BAW 2013-04-30: log and ignore.
             raise AssertionError('unknown image type: {}'.format(image.type))
+    # Look up the deltas by their base, instead of searching through all of
+    # them at every step.
+    next_deltas = defaultdict(list)
+    for image in deltas:
+        next_deltas[image.base].append(image)
     # Load up the roots of candidate upgrade paths.
-    chaser = _Chaser()
+    chaser = _Chaser(beam_width)
     # Each full version that is newer than our current version provides the
     # start of an upgrade path.
     for image in fulls:
         if image.version > build:
-            chaser.push([image])
+            chaser.push(_Step(image, None, score))
     # Each delta with a base that matches our version also provides the start
     # of an upgrade path.
-    for image in deltas:
-        if image.base == build:
-            chaser.push([image])
+    for image in next_deltas.get(build, []):
+        chaser.push(_Step(image, None, score))
     # Chase the back pointers from the deltas until we run out of newer
     # versions.  It's possible to push new paths into the chaser if we find a
     # fork in the road (i.e. two deltas with the same base).
-    paths = list()
-    for path in chaser:
-        current = path[-1]
-        while True:
-            # Find all the deltas that have this step as their base.
-            next_steps = [delta for delta in deltas
-                          if delta.base == current.version]
-            # If there is no next step, then we're done with this path.
-            if len(next_steps) == 0:
-                paths.append(path)
+    found = 0
+    too_long = 0
+    try:
+        for step in chaser:
+            while True:
+                # Find all the deltas that have this step as their base.
+                next_steps = next_deltas.get(step.image.version, [])
+                # If there is no next step, then we're done with this path.
+                if len(next_steps) == 0:
+                    break
+                if max_depth is not None and step.depth >= max_depth:
+                    # This path doesn't reach the latest build, so it's no
+                    # candidate.  Its forks are still on the chaser.
+                    too_long += 1
+                    step = None
+                    break
+                # If there's a fork, take one fork now and push the other
+                # paths onto the chaser.
+                *forks, current = next_steps
+                for fork in forks:
+                    chaser.push(_Step(fork, step, score))
+                step = _Step(current, step, score)
+            if step is None:
+                continue
+            yield step.path()
+            found += 1
+            if max_paths is not None and found >= max_paths:
+                if len(chaser) > 0:
+                    log.info('Stopped at {} candidate paths, {} unexplored',
+                             found, len(chaser))
                 break
-            # If there's only one next step, append that to path and keep
-            # going, with this step as the current image.
-            elif len(next_steps) == 1:
-                current = next_steps[0]
-                path.append(current)
-            # Otherwise, we have a fork.  Take one fork now and push the other
-            # paths onto the chaser.
-            else:
-                current = next_steps.pop()
-                for fork in next_steps:
-                    new_path = path.copy()
-                    new_path.append(fork)
-                    chaser.push(new_path)
-                path.append(current)
-    return paths
+    finally:
+        if chaser.pruned > 0:
+            log.info('Pruned {} candidate paths beyond the beam width of {}',
+                     chaser.pruned, beam_width)
+        if too_long > 0:
+            log.info('Dropped {} candidate paths longer than {} images',
+                     too_long, max_depth)
+
+
+@traced('get_candidates', 'candidates')
+def get_candidates(index, build, *, score=None, max_paths=None,
+                   max_depth=None, beam_width=None):
+    """Calculate all the candidate upgrade paths.
+
+    This function returns a list of candidate upgrades paths, from the
+    current build number to the latest build available in the index
+    file.
+
+    Each element of this list of candidates is itself a list of `Image`
+    objects, in the order that they should be applied to upgrade the
+    device.
+
+    The upgrade candidate chains are not sorted, ordered, or prioritized
+    in any way.  They are simply the list of upgrades that will satisfy
+    the requirements.  It is possible that there are no upgrade candidates if
+    the device is already at the latest build, or if the device is at a build
+    too old to update.
+
+    :param index: The index of available upgrades.
+    :type index: An `Index`
+    :param build: The build version number that the device is currently at.
+    :type build: str
+    :param score: See `iter_candidates()`.
+    :param max_paths: See `iter_candidates()`.  Unlike there, by default
+        there is no limit.
+    :param max_depth: Likewise.
+    :param beam_width: Likewise.
+    :return: list-of-lists of upgrade paths.  The empty list is returned if
+        there are no candidate paths.
+    """
+    return list(iter_candidates(
+        index, build, score=score, max_paths=max_paths,
+        max_depth=max_depth, beam_width=beam_width))
 
 
 def iter_path(winner):
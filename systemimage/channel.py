@@ -25,34 +25,144 @@ import json
 from systemimage.bag import Bag
 
 
-def _parse_device_mappings(device_mapping):
-    devices = {}
+class _LazyBag(Bag):
+    """A Bag whose values are only built from the raw JSON when asked for.
+
+    A channels.json file can list hundreds of devices in dozens of channels,
+    but a client only ever looks at a few of them, so there's no point in
+    building a Bag for every one.  The keys are known up front, so iterating
+    over a lazy Bag, or testing for membership, builds nothing.
+    """
+
+    def __init__(self, mapping, factory):
+        super().__init__()
+        self._mapping = mapping
+        self._factory = factory
+        self._safe_keys = None
+
+    def _raw_key(self, name):
+        # Map an attribute name back to its raw key, e.g. daily_proposed ->
+        # daily-proposed.  Most names are their own raw keys, so only build
+        # the full mapping when one isn't.
+        if name in self._mapping:
+            return name
+        if self._safe_keys is None:
+            self._safe_keys = {
+                self._normalize_key_value(key, None)[0]: key
+                for key in self._mapping
+                }
+        return self._safe_keys.get(name)
+
+    def _materialize(self, key):
+        if key not in self.__untranslated__:
+            self._load_items({key: self._factory(self._mapping[key])})
+
+    def __getattr__(self, name):
+        # This is only called when normal attribute lookup fails, i.e. for
+        # values which haven't been built yet.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        key = self._raw_key(name)
+        if key is None:
+            raise AttributeError(name)
+        self._materialize(key)
+        return self.__dict__[name]
+
+    def __getitem__(self, key):
+        if key in self._mapping:
+            self._materialize(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if key in self._mapping:
+            raise ValueError('Attributes are immutable: {}'.format(key))
+        super().__setitem__(key, value)
+
+    def __contains__(self, key):
+        return key in self._mapping or key in self.__untranslated__
+
+    def get(self, key, default=None):
+        raw_key = self._raw_key(key)
+        if raw_key is not None:
+            self._materialize(raw_key)
+        return super().get(key, default)
+
+    def keys(self):
+        for key in self._mapping:
+            if not key.startswith('_'):
+                yield key
+        for key in super().keys():
+            if key not in self._mapping:
+                yield key
+
+    # Pickle protocol.  Only the raw mapping is needed, since everything else
+    # can be built from it again.
+
+    def __getstate__(self):
+        return self._mapping, self._factory
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def _parse_device(mapping):
+    # Most of the keys at this level (e.g. index) have flat values, however
+    # the keyring key is itself a mapping, and the incremental key is a list
+    # of mappings.  Don't change the raw mapping, since it may be needed
+    # again.
+    mapping = dict(mapping)
+    keyring = mapping.pop('keyring', None)
+    if keyring is not None:
+        mapping['keyring'] = Bag(**keyring)
+    incremental = mapping.pop('incremental', None)
+    if incremental is not None:
+        mapping['incremental'] = [Bag(**entry) for entry in incremental]
+    # e.g. nexus7 -> {index, keyring}
+    return Bag(**mapping)
+
+
+def _parse_channel(mapping):
+    mapping = dict(mapping)
+    mapping['hidden'] = mapping.get('hidden') or False
     # e.g. keys: nexus7, nexus4
-    for device_name, mapping_1 in device_mapping.items():
-        # Most of the keys at this level (e.g. index) have flat values,
-        # however the keyring key is itself a mapping.
-        keyring = mapping_1.pop('keyring', None)
-        if keyring is not None:
-            mapping_1['keyring'] = Bag(**keyring)
-        # e.g. nexus7 -> {index, keyring}
-        devices[device_name] = Bag(**mapping_1)
-    return Bag(**devices)
-
-
-class Channels(Bag):
+    mapping['devices'] = _LazyBag(mapping.pop('devices'), _parse_device)
+    return Bag(**mapping)
+
+
+class Channels(_LazyBag):
+    """The channels in a channels.json file.
+
+    Each channel's Bag, and each device's Bag within it, is built the first
+    time it's looked up.
+    """
+
+    def __init__(self, mapping):
+        super().__init__(mapping, _parse_channel)
+        # Map each device to the sorted names of the channels it can be
+        # installed from.  This only walks the keys of the raw mappings, so
+        # it's much cheaper than building the Bags.
+        self._installable = {}
+        for channel_name in sorted(mapping):
+            for device_name in mapping[channel_name]['devices']:
+                self._installable.setdefault(device_name, []).append(
+                    channel_name)
+
+    def __getstate__(self):
+        return (self._mapping,)
+
     @classmethod
     def from_json(cls, data):
         mapping = json.loads(data)
-        channels = {}
         for channel_name, mapping_1 in mapping.items():
-            hidden = mapping_1.pop('hidden', None)
-            if hidden is None:
-                hidden = False
-            else:
-                assert hidden in (True, False), (
-                    "Unexpected value for 'hidden': {}".format(hidden))
-            mapping_1['hidden'] = hidden
-            device_mapping = mapping_1.pop('devices')
-            mapping_1['devices'] = _parse_device_mappings(device_mapping)
-            channels[channel_name] = Bag(**mapping_1)
-        return cls(**channels)
+            hidden = mapping_1.get('hidden')
+            assert hidden in (None, True, False), (
+                "Unexpected value for 'hidden': {}".format(hidden))
+        return cls(mapping)
+
+    def installable(self, device):
+        """Return the names of the channels a device can be installed from.
+
+        :param device: The device name.
+        :return: The sorted list of channel names.
+        """
+        return list(self._installable.get(device, ()))
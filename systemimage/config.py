@@ -22,26 +22,90 @@ __all__ = [
 
 
 import os
+import json
+import stat
 import atexit
 
 from configparser import ConfigParser
 from contextlib import ExitStack
+from datetime import timedelta
 from pathlib import Path
 from systemimage.bag import Bag
 from systemimage.helpers import (
-    NO_PORT, as_loglevel, as_object, as_port, as_stripped, as_timedelta,
-    makedirs, temporary_directory)
+    NO_PORT, as_loglevel, as_object, as_port, as_positive_size, as_size,
+    as_stripped, as_timedelta, atomic, makedirs, temporary_directory)
 
 
 SECTIONS = ('service', 'system', 'gpg', 'updater', 'hooks', 'dbus')
 USER_AGENT = ('Ubuntu System Image Upgrade Client: '
               'device={0.device};channel={0.channel};build={0.build_number}')
+DEFAULT_SETTINGS_DB = '/var/lib/system-image/settings.db'
+# The converted values of the ini files are cached in this file, next to the
+# settings database.  Bump the version whenever its layout changes.
+SNAPSHOT_FILE = 'config.snapshot'
+SNAPSHOT_VERSION = 4
 
 
 def expand_path(path):
     return os.path.abspath(os.path.expanduser(path))
 
 
+# How the values in each section are converted from their ini file strings.
+# Values without a converter are kept as strings.
+CONVERTERS = dict(
+    service=dict(http_port=as_port,
+                 https_port=as_port,
+                 build_number=int,
+                 device=as_stripped,
+                 ),
+    system=dict(timeout=as_timedelta,
+                loglevel=as_loglevel,
+                logsize=as_size,
+                logcount=int,
+                settings_db=expand_path,
+                tempdir=expand_path,
+                ),
+    gpg=dict(),
+    updater=dict(throughput=as_positive_size,
+                 verify_cost=as_timedelta,
+                 apply_cost=as_timedelta,
+                 reboot_cost=as_timedelta,
+                 ),
+    hooks=dict(device=as_object,
+               scorer=as_object,
+               apply=as_object,
+               ),
+    dbus=dict(lifetime=as_timedelta),
+    )
+
+
+def _to_snapshot(converter, value):
+    # Return the converted value as something JSON can hold.
+    if converter is as_timedelta:
+        return value.total_seconds()
+    if converter is as_loglevel:
+        return list(value)
+    if converter is as_port and value is NO_PORT:
+        return None
+    if converter is as_object:
+        return str(value)
+    return value
+
+
+def _from_snapshot(converter, value):
+    # The reverse of _to_snapshot().  Hook objects are only imported when
+    # they're called, so this doesn't import anything either.
+    if converter is as_timedelta:
+        return timedelta(seconds=value)
+    if converter is as_loglevel:
+        return tuple(value)
+    if converter is as_port and value is None:
+        return NO_PORT
+    if converter is as_object:
+        return as_object(value)
+    return value
+
+
 class SafeConfigParser(ConfigParser):
     """Like ConfigParser, but with default empty sections.
 
@@ -58,6 +122,9 @@ class SafeConfigParser(ConfigParser):
 
 class Configuration:
     def __init__(self, directory=None):
+        # Bumped every time a configuration directory is (re)loaded, so that
+        # anything derived from the configuration can tell when it's stale.
+        self.generation = 0
         self._set_defaults()
         # Because the configuration object is a global singleton, it makes for
         # a convenient place to stash information used by widely separate
@@ -73,6 +140,11 @@ class Configuration:
         # other parts of the system.
         self.skip_gpg_verification = False
         self.override_gsm = False
+        # Offline update bundles; see systemimage.bundle.  When exporting,
+        # every download is recorded in a BundleWriter, and when sideloading,
+        # every download comes from a BundleReader.
+        self.export_bundle = None
+        self.sideload_bundle = None
         # Cache.
         self._device = None
         self._build_number = None
@@ -105,7 +177,10 @@ class Configuration:
             tempdir='/tmp',
             logfile='/var/log/system-image/client.log',
             loglevel=as_loglevel('info'),
-            settings_db='/var/lib/system-image/settings.db',
+            logsize=as_size('10M'),
+            logcount=3,
+            settings_db=DEFAULT_SETTINGS_DB,
+            stats_textfile='',
             )
         self.gpg = Bag(
             archive_master='/usr/share/system-image/archive-master.tar.xz',
@@ -118,6 +193,11 @@ class Configuration:
         self.updater = Bag(
             cache_partition='/android/cache/recovery',
             data_partition='/var/lib/system-image',
+            # Used by the systemimage.scores.TimeScorer.
+            throughput=as_size('256K'),
+            verify_cost=as_timedelta('15s'),
+            apply_cost=as_timedelta('2m'),
+            reboot_cost=as_timedelta('1m'),
             )
         self.hooks = Bag(
             device=as_object('systemimage.device.SystemProperty'),
@@ -128,30 +208,20 @@ class Configuration:
             lifetime=as_timedelta('10m'),
             )
 
-    def _load_file(self, path):
+    def _read_file(self, path):
+        # Return the raw values in the ini file, by section.
         parser = SafeConfigParser()
         str_path = str(path)
         parser.read(str_path)
+        return {section: dict(parser[section]) for section in SECTIONS}
+
+    def _load_file(self, path, sections=None):
+        if sections is None:
+            sections = self._read_file(path)
         self.ini_files.append(path)
-        self.service.update(converters=dict(http_port=as_port,
-                                            https_port=as_port,
-                                            build_number=int,
-                                            device=as_stripped,
-                                            ),
-                            **parser['service'])
-        self.system.update(converters=dict(timeout=as_timedelta,
-                                           loglevel=as_loglevel,
-                                           settings_db=expand_path,
-                                           tempdir=expand_path),
-                            **parser['system'])
-        self.gpg.update(**parser['gpg'])
-        self.updater.update(**parser['updater'])
-        self.hooks.update(converters=dict(device=as_object,
-                                          scorer=as_object,
-                                          apply=as_object),
-                          **parser['hooks'])
-        self.dbus.update(converters=dict(lifetime=as_timedelta),
-                         **parser['dbus'])
+        for section in SECTIONS:
+            getattr(self, section).update(
+                converters=CONVERTERS[section], **sections[section])
 
     def load(self, directory):
         """Load up the configuration from a config.d directory."""
@@ -161,6 +231,7 @@ class Configuration:
         if self.config_d is not None:
             raise RuntimeError('Configuration already loaded; use .reload()')
         self.config_d = directory
+        self.generation += 1
         if not Path(directory).is_dir():
             raise TypeError(
                 '.load() requires a directory: {}'.format(directory))
@@ -176,10 +247,99 @@ class Configuration:
             except ValueError:
                 continue
             candidates.append((serial, child))
-        for serial, path in sorted(candidates):
-            self._load_file(path)
+        paths = [path for serial, path in sorted(candidates)]
+        # The ini files can't say where the snapshot is without parsing them,
+        # so it's always looked for next to the default settings database.
+        snapshot = os.path.join(
+            os.path.dirname(self.system.settings_db), SNAPSHOT_FILE)
+        key = self._snapshot_key(directory, paths)
+        values = self._load_snapshot(snapshot, key)
+        if values is None:
+            files = [(path, self._read_file(path)) for path in paths]
+            for path, sections in files:
+                self._load_file(path, sections)
+            self._save_snapshot(snapshot, key, files)
+        else:
+            # The values are already converted, so they go straight in.
+            self.ini_files.extend(paths)
+            for section in SECTIONS:
+                getattr(self, section).update(**values[section])
         self._calculate_http_bases()
 
+    def _snapshot_key(self, directory, paths):
+        # The snapshot is valid as long as the same ini files, with the same
+        # mtimes and sizes, are in the same directory.  Paths are expanded
+        # against the home and current directories, so those must be the
+        # same too.
+        files = []
+        for path in paths:
+            try:
+                info = path.stat()
+            except OSError:
+                # E.g. a dangling symlink, which ConfigParser ignores.
+                files.append([str(path), None, None])
+            else:
+                files.append([str(path), info.st_mtime_ns, info.st_size])
+        return dict(
+            version=SNAPSHOT_VERSION,
+            directory=os.path.abspath(str(directory)),
+            files=files,
+            home=os.path.expanduser('~'),
+            cwd=os.getcwd(),
+            )
+
+    def _load_snapshot(self, path, key):
+        # Return the converted values, by section, from a valid snapshot, or
+        # None.  Anything going wrong just means the ini files get parsed.
+        # The snapshot says which hook classes to import, so it's only
+        # trusted if it was written by this user, and only this user can
+        # change it.
+        try:
+            with open(path, encoding='utf-8') as fp:
+                info = os.fstat(fp.fileno())
+                if (info.st_uid != os.geteuid()
+                        or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+                    return None
+                snapshot = json.load(fp)
+            if snapshot['key'] != key:
+                return None
+            values = {}
+            for section in SECTIONS:
+                converters = CONVERTERS[section]
+                values[section] = {
+                    str(name): _from_snapshot(converters.get(name), value)
+                    for name, value in snapshot['values'][section].items()
+                    }
+        except Exception:
+            return None
+        return values
+
+    def _save_snapshot(self, path, key, files):
+        # Only save the snapshot if the settings database is where the next
+        # load will look for it, and never create the directory.
+        directory = os.path.dirname(path)
+        if (os.path.dirname(self.system.settings_db) != directory
+                or not os.path.isdir(directory)):
+            return
+        # Save the final value of every key the ini files set.
+        values = {}
+        for section in SECTIONS:
+            bag = getattr(self, section)
+            converters = CONVERTERS[section]
+            values[section] = {
+                name: _to_snapshot(converters.get(name), bag[name])
+                for path, sections in files
+                for name in sections[section]
+                }
+        snapshot = dict(key=key, values=values)
+        # As in .load(), the logging system isn't initialized yet, so
+        # failures are silently ignored.
+        try:
+            with atomic(path) as fp:
+                json.dump(snapshot, fp)
+        except OSError:
+            pass
+
     def reload(self):
         """Reload the configuration directory."""
         # Reset some cached attributes.
@@ -246,9 +406,15 @@ class Configuration:
         if self._device is None:
             # Start by looking for a [service]device setting.  Use this if it
             # exists, otherwise fall back to calling the hook.
-            self._device = getattr(self.service, 'device', None)
-            if not self._device:
-                self._device = self.hooks.device().get_device()
+            device = getattr(self.service, 'device', None)
+            if not device:
+                # Avoid circular imports.
+                from systemimage.facts import NEVER, PROCESS, facts
+                provider = self.hooks.device()
+                device = facts.device(provider, self.system.settings_db)
+                if getattr(provider, 'cache', PROCESS) == NEVER:
+                    return device
+            self._device = device
         return self._device
 
     @device.setter
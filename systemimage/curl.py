@@ -28,6 +28,7 @@ from contextlib import ExitStack
 from gi.repository import GLib
 from systemimage.config import config
 from systemimage.download import Canceled, DownloadManagerBase
+from threading import Event, current_thread, main_thread
 
 log = logging.getLogger('systemimage')
 
@@ -39,6 +40,9 @@ LOW_SPEED_TIME = 120        # seconds
 MAX_REDIRECTS = 5
 MAX_TOTAL_CONNECTIONS = 4
 SELECT_TIMEOUT = 0.05       # 20fps
+# Metadata (channels, indexes, and keyrings) is asked for compressed, and
+# libcurl transparently decodes it.  The update files are already compressed.
+METADATA_ENCODING = 'gzip'
 
 
 def _curl_debug(debug_type, debug_msg):             # pragma: no cover
@@ -54,8 +58,9 @@ def make_testable(c):
 
 
 class SingleDownload:
-    def __init__(self, record):
+    def __init__(self, record, *, accept_encoding=None):
         self.url, self.destination, self.expected_checksum = record
+        self.accept_encoding = accept_encoding
         self._checksum = None
         self._fp = None
         self._resources = ExitStack()
@@ -69,6 +74,9 @@ class SingleDownload:
         # Set the common options.
         c.setopt(pycurl.URL, self.url)
         c.setopt(pycurl.USERAGENT, config.user_agent)
+        # The checksum and the destination file both see the decoded bytes.
+        if self.accept_encoding is not None:
+            c.setopt(pycurl.ACCEPT_ENCODING, self.accept_encoding)
         # If we're doing a HEAD, then we don't want the body of the
         # file.  Otherwise, set things up to write the body data to the
         # destination file.
@@ -126,6 +134,12 @@ class SingleDownload:
         return self._checksum.hexdigest()
 
 
+def _signal_started():
+    config.dbus_service.DownloadStarted()
+    # Stop GLib from calling this function again.
+    return False
+
+
 class CurlDownloadManager(DownloadManagerBase):
     """The PyCURL based download manager."""
 
@@ -135,17 +149,29 @@ class CurlDownloadManager(DownloadManagerBase):
             self.callbacks.append(callback)
         self._pausables = []
         self._paused = False
+        # The state of the handles, which may lag behind the requested state
+        # in self._paused.  See _sync_pause().
+        self._handles_paused = False
+        # Set whenever the download loop should run, i.e. when it's not
+        # paused.  This is only waited on when the loop is running outside
+        # of the main thread.
+        self._running = Event()
+        self._running.set()
 
     def _get_files(self, records, pausable, signal_started):
+        # Only the update files themselves are pausable; everything else is
+        # metadata.
+        encoding = None if pausable else METADATA_ENCODING
+        connections = self.max_connections or MAX_TOTAL_CONNECTIONS
         # Start by doing a HEAD on all the URLs so that we can get the total
         # target download size in bytes, at least as best as is possible.
         with ExitStack() as resources:
             handles = []
             multi = pycurl.CurlMulti()
-            multi.setopt(
-                pycurl.M_MAX_TOTAL_CONNECTIONS, MAX_TOTAL_CONNECTIONS)
+            multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, connections)
             for record in records:
-                download = SingleDownload(record)
+                download = SingleDownload(
+                    record, accept_encoding=encoding)
                 resources.callback(download.close)
                 handle = download.make_handle(HEAD=True)
                 handles.append(handle)
@@ -161,15 +187,17 @@ class CurlDownloadManager(DownloadManagerBase):
         # Now do a GET on all the URLs.  This will write the data to the
         # destination file and collect the checksums.
         if signal_started and config.dbus_service is not None:
-            config.dbus_service.DownloadStarted()
+            # We may be running in the D-Bus service's worker thread, so let
+            # the main loop send the signal.
+            GLib.idle_add(_signal_started)
         with ExitStack() as resources:
             resources.callback(setattr, self, '_handles', None)
             downloads = []
             multi = pycurl.CurlMulti()
-            multi.setopt(
-                pycurl.M_MAX_TOTAL_CONNECTIONS, MAX_TOTAL_CONNECTIONS)
+            multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, connections)
             for record in records:
-                download = SingleDownload(record)
+                download = SingleDownload(
+                    record, accept_encoding=encoding)
                 downloads.append(download)
                 resources.callback(download.close)
                 handle = download.make_handle(HEAD=False)
@@ -234,8 +262,15 @@ class CurlDownloadManager(DownloadManagerBase):
         # once in a while.  It turns out that even if we're not running a D-Bus
         # main loop (i.e. during the in-process tests) periodically dispatching
         # into GLib doesn't hurt, so just do it unconditionally.
+        #
+        # The exception is when we're running in the D-Bus service's worker
+        # thread.  Then the main loop is running in the main thread, where it
+        # dispatches the D-Bus events for us, and it owns the default context
+        # so we couldn't iterate it anyway.  In that case, we just wait while
+        # the download is paused.
         self.received = 0
         context = GLib.main_context_default()
+        in_main_thread = (current_thread() is main_thread())
         while True:
             # Do the progress callback, but only if the current received size
             # is different than the last one.  Don't worry about in which
@@ -248,10 +283,15 @@ class CurlDownloadManager(DownloadManagerBase):
             if not self._do_once(multi, handles):
                 break
             multi.select(SELECT_TIMEOUT)
-            # Let D-Bus events get dispatched, but only block if downloads are
-            # paused.
-            while context.iteration(may_block=self._paused):
-                pass
+            if in_main_thread:
+                # Let D-Bus events get dispatched, but only block if
+                # downloads are paused.
+                while context.iteration(may_block=self._paused):
+                    pass
+            else:
+                self._sync_pause()
+                self._running.wait()
+            self._sync_pause()
             if self._queued_cancel:
                 raise Canceled
         # One last callback, unconditionally.
@@ -259,10 +299,20 @@ class CurlDownloadManager(DownloadManagerBase):
             sum(c.getinfo(pycurl.SIZE_DOWNLOAD) for c in handles))
         self._do_callback()
 
-    def pause(self):
+    def _sync_pause(self):
+        # PyCURL handles are not thread-safe, so pause() and resume() only
+        # record the requested state.  The handles are actually paused and
+        # continued here, in the thread running the download.
+        if self._paused == self._handles_paused:
+            return
+        flag = (pycurl.PAUSE_ALL if self._paused else pycurl.PAUSE_CONT)
         for c in self._pausables:
-            c.pause(pycurl.PAUSE_ALL)
+            c.pause(flag)
+        self._handles_paused = self._paused
+
+    def pause(self):
         self._paused = True
+        self._running.clear()
         # 2014-10-20 BAW: We could plumb through the `service` object from
         # service.py (the main entry point for system-image-dbus, but that's
         # actually a bit of a pain, so do the expedient thing and grab the
@@ -273,5 +323,9 @@ class CurlDownloadManager(DownloadManagerBase):
 
     def resume(self):
         self._paused = False
-        for c in self._pausables:
-            c.pause(pycurl.PAUSE_CONT)
+        self._running.set()
+
+    def cancel(self):
+        super().cancel()
+        # Wake up a paused download loop so that it sees the cancel.
+        self._running.set()
@@ -18,23 +18,31 @@
 __all__ = [
     'Loop',
     'Service',
+    'Worker',
+    'call_in_main_thread',
     'log_and_exit',
     ]
 
 
 import os
 import sys
+import dbus
 import logging
 
+from concurrent.futures import Future
 from datetime import datetime
 from dbus.service import Object, method, signal
 from functools import wraps
-from gi.repository import GLib
+from gi.repository import Gio, GLib
+from queue import Queue
+from systemimage import helpers
 from systemimage.api import Mediator
 from systemimage.config import config
 from systemimage.helpers import last_update_date
 from systemimage.settings import Settings
-from threading import Lock
+from systemimage.statistics import statistics
+from systemimage.trace import tracer
+from threading import Lock, Thread, current_thread, main_thread
 
 
 EMPTYSTRING = ''
@@ -89,6 +97,60 @@ class Loop:
         self._loop.run()
 
 
+def call_in_main_thread(function, *args):
+    """Call `function(*args)` in the thread running the GLib main loop.
+
+    When called from the main thread, the function is called immediately.
+    Otherwise, the call is queued up as an idle callback so that the main
+    loop will make it the next time it has nothing better to do.
+    """
+    if current_thread() is main_thread():
+        function(*args)
+        return
+    def idle():
+        function(*args)
+        # Stop GLib from calling this function again.
+        return False
+    GLib.idle_add(idle)
+
+
+class Worker:
+    """Run blocking jobs in order, on a single worker thread.
+
+    Checking for and downloading updates can take a long time, mostly spent
+    waiting on the network or on gpg.  If that work happened in the GLib main
+    loop, every other D-Bus method call (e.g. Information() or GetSetting())
+    would have to wait for it to complete.  Instead, the work is handed to
+    this object, and when it is done, a completion callback is called back in
+    the main loop thread with a `concurrent.futures.Future` carrying either
+    the job's return value or its exception.
+
+    The thread is a daemon thread so that a job which is still in progress
+    cannot keep the process alive after the main loop has exited.
+    """
+
+    def __init__(self):
+        self._jobs = Queue()
+        self._thread = None
+
+    def submit(self, job, done):
+        if self._thread is None:
+            self._thread = Thread(
+                target=self._run, name='system-image-worker', daemon=True)
+            self._thread.start()
+        self._jobs.put((job, done))
+
+    def _run(self):
+        while True:
+            job, done = self._jobs.get()
+            future = Future()
+            try:
+                future.set_result(job())
+            except Exception as error:
+                future.set_exception(error)
+            call_in_main_thread(done, future)
+
+
 class Service(Object):
     """Main dbus service."""
 
@@ -97,6 +159,7 @@ class Service(Object):
         self.loop = loop
         self._api = Mediator(self._progress_callback)
         log.info('Mediator created {}', self._api)
+        self._worker = Worker()
         self._checking = Lock()
         self._downloading = Lock()
         self._update = None
@@ -104,12 +167,47 @@ class Service(Object):
         self._applicable = False
         self._failure_count = 0
         self._last_error = ''
-
-    @log_and_exit
-    def _check_for_update(self):
-        # Asynchronous method call.
+        # The cached response to Information(), and the configuration
+        # generation it was calculated from.
+        self._information = None
+        self._information_generation = None
+        self._monitors = []
+        self._watch_files()
+
+    def _watch_files(self):
+        # Some of what Information() returns can be changed by other
+        # processes, so watch those files for changes.  This uses inotify
+        # under the hood.  The last update date comes from the mtime of a
+        # file which gets touched by the recovery-time updater.  The settings
+        # database can be written to by e.g. system-image-cli --set.
+        for monitor in self._monitors:
+            monitor.cancel()
+        paths = (helpers.LAST_UPDATE_FILE, config.system.settings_db)
+        # Keep references, otherwise the monitors get garbage collected.
+        self._monitors = []
+        for path in paths:
+            try:
+                monitor = Gio.File.new_for_path(path).monitor_file(
+                    Gio.FileMonitorFlags.NONE, None)
+            except GLib.Error as error:
+                # Without the watch, Information() still gets invalidated by
+                # everything the service does itself.
+                log.info('Cannot watch {}: {}', path, error)
+                continue
+            monitor.connect('changed', self._invalidate_information)
+            self._monitors.append(monitor)
+
+    def _invalidate_information(self, *ignore):
+        self._information = None
+
+    @log_and_exit
+    def _check_for_update(self, future):
+        # Called in the main loop once the worker thread has finished the
+        # check.  Any exception raised by the check is re-raised here.
         log.info('Enter _check_for_update()')
-        self._update = self._api.check_for_update()
+        self._update = future.result()
+        self._invalidate_information()
+        statistics.save()
         log.info('_check_for_update(): checking lock releasing')
         try:
             self._checking.release()
@@ -184,18 +282,22 @@ class Service(Object):
         log.info('Mediator recreated {}', self._api)
         self._failure_count = 0
         self._last_error = ''
-        # Arrange for the actual check to happen in a little while, so that
-        # this method can return immediately.
-        GLib.timeout_add(50, self._check_for_update)
+        # Do the actual check in the worker thread so that this method, and
+        # any other D-Bus method called while the check is in progress, can
+        # return immediately.
+        self._worker.submit(self._api.check_for_update, self._check_for_update)
 
     #@log_and_exit
     def _progress_callback(self, received, total):
         # Plumb the progress through our own D-Bus API.  Our API is defined as
         # signalling a percentage and an eta.  We can calculate the percentage
         # easily, but the eta is harder.  For now, we just send 0 as the eta.
+        #
+        # This is called from the worker thread, so the signal must be sent
+        # from the main loop.
         percentage = received * 100 // total
         eta = 0
-        self.UpdateProgress(percentage, eta)
+        call_in_main_thread(self.UpdateProgress, percentage, eta)
 
     @log_and_exit
     def _download(self):
@@ -204,6 +306,15 @@ class Service(Object):
             self._paused = False
             log.info('Download previously paused')
             return
+        if (self._update is None
+                and not self._downloading.locked()
+                and self._checking.acquire(blocking=False)):
+            # Nothing has been checked yet by this process, but an earlier
+            # one may have checked before it exited.  Resume from its check
+            # if that's still fresh, and then download.
+            log.info('Resuming the saved check')
+            self._worker.submit(self._api.resume_check, self._resumed)
+            return False
         if (self._downloading.locked()                  # Already in progress.
             or self._update is None                     # Not yet checked.
             or not self._update.is_available            # No update available.
@@ -217,35 +328,66 @@ class Service(Object):
                      self._failure_count, self._last_error)
             return
         log.info('_download(): downloading lock entering critical section')
-        with self._downloading:
-            log.info('Update is downloading')
-            try:
-                # Always start by sending a UpdateProgress(0, 0).  This is
-                # enough to get the u/i's attention.
-                self.UpdateProgress(0, 0)
-                self._api.download()
-            except Exception:
-                log.exception('Download failed')
-                self._failure_count += 1
-                # Set the last error string to the exception's class name.
-                exception, value = sys.exc_info()[:2]
-                # if there's no meaningful value, omit it.
-                value_str = str(value)
-                name = exception.__name__
-                self._last_error = ('{}'.format(name)
-                                    if len(value_str) == 0
-                                    else '{}: {}'.format(name, value))
-                self.UpdateFailed(self._failure_count, self._last_error)
-            else:
-                log.info('Update downloaded')
-                self.UpdateDownloaded()
-                self._failure_count = 0
-                self._last_error = ''
-                self._applicable = True
-        log.info('_download(): downloading lock finished critical section')
+        self._downloading.acquire()
+        log.info('Update is downloading')
+        # Always start by sending a UpdateProgress(0, 0).  This is enough to
+        # get the u/i's attention.
+        self.UpdateProgress(0, 0)
+        # The download itself happens in the worker thread.  The downloading
+        # lock stays held until _downloaded() gets called back in the main
+        # loop.
+        self._worker.submit(self._api.download, self._downloaded)
         # Stop GLib from calling this method again.
         return False
 
+    @log_and_exit
+    def _resumed(self, future):
+        # Called in the main loop once the worker thread has tried to resume
+        # the saved check.
+        try:
+            update = future.result()
+        except Exception:
+            log.exception('Cannot resume the saved check')
+            update = None
+        finally:
+            self._checking.release()
+        if update is None:
+            log.info('No saved check to resume, download not available')
+            return
+        self._update = update
+        self._invalidate_information()
+        self._download()
+
+    @log_and_exit
+    def _downloaded(self, future):
+        # Called in the main loop once the worker thread has finished the
+        # download, successfully or not.
+        try:
+            future.result()
+        except Exception:
+            log.exception('Download failed')
+            self._failure_count += 1
+            # Set the last error string to the exception's class name.
+            exception, value = sys.exc_info()[:2]
+            # if there's no meaningful value, omit it.
+            value_str = str(value)
+            name = exception.__name__
+            self._last_error = ('{}'.format(name)
+                                if len(value_str) == 0
+                                else '{}: {}'.format(name, value))
+            statistics.failure(name)
+            self.UpdateFailed(self._failure_count, self._last_error)
+        else:
+            log.info('Update downloaded')
+            self.UpdateDownloaded()
+            self._failure_count = 0
+            self._last_error = ''
+            self._applicable = True
+        finally:
+            self._downloading.release()
+            statistics.save()
+        log.info('_download(): downloading lock finished critical section')
+
     @log_and_exit
     @method('com.canonical.SystemImage')
     def DownloadUpdate(self):
@@ -323,6 +465,15 @@ class Service(Object):
     @method('com.canonical.SystemImage', out_signature='a{ss}')
     def Information(self):
         self.loop.keepalive()
+        # Settings UIs call this a lot, so serve it from a snapshot which is
+        # only recalculated when something it depends on changes.
+        if (self._information is None
+                or self._information_generation != config.generation):
+            self._information = self._calculate_information()
+            self._information_generation = config.generation
+        return dict(self._information)
+
+    def _calculate_information(self):
         settings = Settings()
         current_build_number = str(config.build_number)
         version_detail = getattr(config.service, 'version_detail', '')
@@ -345,36 +496,67 @@ class Service(Object):
             response['target_version_detail'] = self._update.version_detail
         return response
 
-    @log_and_exit
-    @method('com.canonical.SystemImage', in_signature='ss')
-    def SetSetting(self, key, value):
-        """Set a key/value setting.
-
-        Some values are special, e.g. min_battery and auto_downloads.
-        Implement these special semantics here.
-        """
-        self.loop.keepalive()
+    @staticmethod
+    def _valid_setting(key, value):
+        # Some values are special, e.g. min_battery and auto_downloads.
+        # Invalid values for these are silently ignored.
         if key == 'min_battery':
             try:
                 as_int = int(value)
             except ValueError:
-                return
+                return False
             if as_int < 0 or as_int > 100:
-                return
+                return False
         if key == 'auto_download':
             try:
                 as_int = int(value)
             except ValueError:
-                return
+                return False
             if as_int not in (0, 1, 2):
-                return
+                return False
+        return True
+
+    @log_and_exit
+    @method('com.canonical.SystemImage', in_signature='ss')
+    def SetSetting(self, key, value):
+        """Set a key/value setting.
+
+        Some values are special, e.g. min_battery and auto_downloads.
+        Implement these special semantics here.
+        """
+        self.loop.keepalive()
+        if not self._valid_setting(key, value):
+            return
         settings = Settings()
         old_value = settings.get(key)
         settings.set(key, value)
+        self._invalidate_information()
         if value != old_value:
             # Send the signal.
             self.SettingChanged(key, value)
 
+    @log_and_exit
+    @method('com.canonical.SystemImage', in_signature='a{ss}')
+    def SetSettings(self, new_settings):
+        """Set several key/value settings at once.
+
+        This is like calling SetSetting() for each item, except that all the
+        valid settings are written in a single transaction.
+        """
+        self.loop.keepalive()
+        new_settings = {
+            str(key): str(value)
+            for key, value in new_settings.items()
+            if self._valid_setting(key, value)
+            }
+        settings = Settings()
+        old_settings = settings.get_many(new_settings)
+        settings.set_many(new_settings)
+        self._invalidate_information()
+        for key, value in new_settings.items():
+            if value != old_settings[key]:
+                self.SettingChanged(key, value)
+
     @log_and_exit
     @method('com.canonical.SystemImage', in_signature='s', out_signature='s')
     def GetSetting(self, key):
@@ -382,6 +564,47 @@ class Service(Object):
         self.loop.keepalive()
         return Settings().get(key)
 
+    @log_and_exit
+    @method('com.canonical.SystemImage', in_signature='as',
+            out_signature='a{ss}')
+    def GetSettings(self, keys):
+        """Get several settings at once."""
+        self.loop.keepalive()
+        return Settings().get_many(str(key) for key in keys)
+
+    @log_and_exit
+    @method('com.canonical.SystemImage', out_signature='a{sv}')
+    def GetStatistics(self):
+        """Get the counters and histograms kept across restarts."""
+        self.loop.keepalive()
+        snapshot = statistics.as_dict()
+        # Be explicit about the types, since the counters can outgrow int32.
+        response = dbus.Dictionary(signature='sv')
+        for name, value in snapshot['counters'].items():
+            response[name] = (dbus.Double(value)
+                              if isinstance(value, float)
+                              else dbus.UInt64(value))
+        response['failures_by_class'] = dbus.Dictionary(
+            {name: dbus.UInt64(value)
+             for name, value in snapshot['failures'].items()},
+            signature='st')
+        throughput = snapshot['throughput']
+        response['throughput_buckets'] = dbus.Array(
+            [dbus.UInt64(bound) for bound in throughput['buckets']],
+            signature='t')
+        response['throughput_counts'] = dbus.Array(
+            [dbus.UInt64(count) for count in throughput['counts']],
+            signature='t')
+        response['throughput_sum'] = dbus.Double(throughput['sum'])
+        return response
+
+    @log_and_exit
+    @method('com.canonical.SystemImage', out_signature='s')
+    def GetTrace(self):
+        """Get the step timings of the last check and download."""
+        self.loop.keepalive()
+        return tracer.as_chrome_trace()
+
     @log_and_exit
     @method('com.canonical.SystemImage')
     def FactoryReset(self):
@@ -415,12 +638,14 @@ class Service(Object):
     @method('com.canonical.SystemImage', in_signature='s', out_signature='b')
     def SetChannel(self, channel):
         """Set channel to get updates from"""
+        self._invalidate_information()
         return self._api.set_channel(channel)
 
     @log_and_exit
     @method('com.canonical.SystemImage', in_signature='i')
     def SetBuild(self, build):
         """Set build to get updates from"""
+        self._invalidate_information()
         self._api.set_build(build)
 
 
@@ -471,6 +696,7 @@ class Service(Object):
         # For .Information()'s last_check_date value.
         iso8601_now = datetime.now().replace(microsecond=0).isoformat(sep=' ')
         Settings().set('last_check_date', iso8601_now)
+        self._invalidate_information()
         log.debug('EMIT UpdateAvailableStatus({}, {}, {}, {}, {}, {})',
                   is_available, downloading, available_version, update_size,
                   last_update_date, repr(error_reason))
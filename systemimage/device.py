@@ -23,11 +23,18 @@ __all__ = [
 import logging
 
 from subprocess import CalledProcessError, check_output
+from systemimage.facts import BOOT, PROCESS
+from systemimage.trace import tracer
 
 
 class BaseDevice:
     """Common device calculation actions."""
 
+    # How long the device name may be cached.  The name is always cached for
+    # the life of the process, unless this is NEVER.  If it's BOOT, it is
+    # also cached across processes until the next reboot.
+    cache = PROCESS
+
     def get_device(self): # pragma: no cover
         """Subclasses must override this."""
         raise NotImplementedError
@@ -36,8 +43,12 @@ class BaseDevice:
 class SystemProperty(BaseDevice):
     """Get the device type through system properties."""
 
+    # The read-only system properties can't change until the next boot.
+    cache = BOOT
+
     def get_device(self):
         log = logging.getLogger('systemimage')
+        tracer.add_subprocess()
         try:
             stdout = check_output(
                 'getprop ro.product.device'.split(), universal_newlines=True)
@@ -30,6 +30,10 @@ import logging
 from collections import namedtuple
 from io import StringIO
 from pprint import pformat
+from systemimage.config import config
+from systemimage.statistics import statistics
+from systemimage.trace import tracer
+from time import monotonic
 
 try:
     import pycurl
@@ -84,6 +88,13 @@ class DownloadManagerBase:
         # of bytes received so far, and the total amount of bytes to be
         # downloaded.
         self.callbacks = []
+        # The most files to download at once, or None for the download
+        # manager's default.  Not all download managers support this.
+        self.max_connections = None
+        # Whether downloads count towards this device's statistics.  Only
+        # the device's own downloads from the network say anything about how
+        # fast it downloads.
+        self.record_statistics = True
         self.total = 0
         self.received = 0
         self._queued_cancel = False
@@ -206,7 +217,20 @@ class DownloadManagerBase:
             else:
                 print('\t{} [{}] -> {}'.format(*record), file=fp)
         log.info('{}'.format(fp.getvalue()))
-        self._get_files(records, pausable, signal_started)
+        start = monotonic()
+        with tracer.span('get_files', 'download'):
+            self._get_files(records, pausable, signal_started)
+            tracer.add_bytes(self.received)
+        if config.export_bundle is not None:
+            config.export_bundle.record(records)
+        if not self.record_statistics:
+            return
+        # Only the update files themselves are pausable; everything else is
+        # metadata (keyrings, channels, and indexes).
+        statistics.increment(
+            'payload_bytes' if pausable else 'metadata_bytes', self.received)
+        statistics.throughput(
+            self.received, monotonic() - start, payload=pausable)
 
     @staticmethod
     def allow_gsm():
@@ -224,6 +248,9 @@ class DownloadManagerBase:
 def get_download_manager(*args):
     # We have to avoid circular imports since both download managers import
     # various things from this module.
+    if config.sideload_bundle is not None:
+        from systemimage.bundle import BundleDownloadManager
+        return BundleDownloadManager(config.sideload_bundle, *args)
     from systemimage.curl import CurlDownloadManager
     from systemimage.udm import DOWNLOADER_INTERFACE, UDMDownloadManager
     # Detect if we have ubuntu-download-manager.
@@ -0,0 +1,211 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cached facts about the host.
+
+The device name, the machine id, the hardware clock offset, and the last
+update date are asked for over and over again, e.g. on every D-Bus
+`Information()` call and every time a winning path is scored.  Computing
+them means forking `getprop`, or opening and reading files, so they are
+computed once and then only revalidated by stat'ing the files they came
+from.
+"""
+
+__all__ = [
+    'BOOT',
+    'FACTS_FILE',
+    'HostFacts',
+    'NEVER',
+    'PROCESS',
+    'facts',
+    ]
+
+
+import os
+import json
+import logging
+
+from contextlib import suppress
+from datetime import datetime, timedelta
+from systemimage import helpers
+from systemimage.config import config
+from systemimage.helpers import atomic
+from threading import Lock
+
+
+# How long the result of a [hooks] provider may be cached.  Providers declare
+# this with a `cache` class attribute, which defaults to PROCESS.
+NEVER = 'never'
+PROCESS = 'process'
+BOOT = 'boot'
+
+# BOOT cacheable results are kept in this file, next to the settings
+# database.
+FACTS_FILE = 'facts.json'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+# What the device provider returns when it can't tell.  This is never cached
+# across processes.
+UNKNOWN_DEVICE = '?'
+
+
+log = logging.getLogger('systemimage')
+
+
+def _stat(path, *, follow_symlinks=True):
+    # Just enough of a file's stat to tell whether it changed.
+    try:
+        info = os.stat(str(path), follow_symlinks=follow_symlinks)
+    except OSError:
+        return None
+    return info.st_ino, info.st_mtime_ns, info.st_size
+
+
+def _boot_id():
+    try:
+        with open(BOOT_ID_FILE, encoding='utf-8') as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+
+class HostFacts:
+    """Facts about the host, computed on demand and cached."""
+
+    def __init__(self):
+        self._lock = Lock()
+        # Map the name of each fact to its key and value.  The key is what
+        # the value was computed from, e.g. the stat of a file, so whenever
+        # the key changes, the value is computed again.
+        self._cache = {}
+
+    def _get(self, name, key, compute):
+        with self._lock:
+            cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = compute()
+        with self._lock:
+            self._cache[name] = (key, value)
+        return value
+
+    def invalidate(self, *names):
+        """Forget the named facts, or all of them if none are named."""
+        with self._lock:
+            if len(names) == 0:
+                self._cache.clear()
+            for name in names:
+                self._cache.pop(name, None)
+
+    def machine_id(self):
+        """Return the unique machine id.
+
+        :raises RuntimeError: when there is no machine-id file.
+        """
+        paths = list(helpers.UNIQUE_MACHINE_ID_FILES)
+        key = [(path, _stat(path)) for path in paths]
+        def compute():
+            for path in paths:
+                with suppress(FileNotFoundError):
+                    with open(path, 'r', encoding='utf-8') as fp:
+                        return fp.read().strip()
+            raise RuntimeError('No machine-id file found')
+        return self._get('machine_id', key, compute)
+
+    def clock_offset(self):
+        """Return the hardware clock offset in seconds.
+
+        See `systemimage.helpers.get_android_offset()`.
+        """
+        path = helpers.TIMEKEEPER_OFFSET_FILE
+        return self._get('clock_offset', (path, _stat(path)),
+                         helpers.get_android_offset)
+
+    def last_update_date(self):
+        """Return the last update date, as a string.
+
+        See `systemimage.helpers.last_update_date()`.
+        """
+        path = helpers.LAST_UPDATE_FILE
+        # The config.d files are only used when the last update file doesn't
+        # exist, but they're cheap to stat.
+        key = ((path, _stat(path)),
+               [(str(ini_file), _stat(ini_file, follow_symlinks=False))
+                for ini_file in config.ini_files],
+               self.clock_offset())
+        return self._get('last_update_date', key,
+                         lambda: self._last_update_date(path))
+
+    def _last_update_date(self, path):
+        try:
+            timestamp_raw = os.stat(path).st_mtime
+            timestamp = datetime.fromtimestamp(timestamp_raw)
+        except (FileNotFoundError, PermissionError):
+            # We fall back to the latest mtime of the config.d/*.ini files.
+            # For robustness, watch out for two possibilities: the config
+            # file could have been deleted after the system started up (thus
+            # making config.ini_files include nonexistent files), and the ini
+            # file could be a dangling symlink.  For the latter, use lstat().
+            timestamps = []
+            for ini_file in config.ini_files:
+                with suppress(FileNotFoundError):
+                    timestamps.append(
+                        datetime.fromtimestamp(ini_file.lstat().st_mtime))
+            if len(timestamps) == 0:
+                return 'Unknown'
+            timestamp = sorted(timestamps)[-1]
+        delta = timedelta(seconds=self.clock_offset())
+        return str(timestamp.replace(microsecond=0) + delta)
+
+    def device(self, provider, settings_db):
+        """Return the device name from a [hooks]device provider.
+
+        Callers are expected to cache PROCESS cacheable results themselves,
+        as `Configuration.device` does, so only BOOT cacheable results are
+        cached here.  These are saved next to the settings database, keyed on
+        the provider and the kernel's boot id, so that later processes don't
+        have to ask the provider again until the next reboot.
+
+        :param provider: The device provider instance.
+        :param settings_db: The path to the settings database.
+        :return: The device name.
+        """
+        boot_id = _boot_id()
+        if getattr(provider, 'cache', PROCESS) != BOOT or boot_id is None:
+            return provider.get_device()
+        path = os.path.join(os.path.dirname(settings_db), FACTS_FILE)
+        name = '{}.{}'.format(
+            type(provider).__module__, type(provider).__qualname__)
+        key = dict(provider=name, boot_id=boot_id)
+        saved = {}
+        with suppress(OSError, ValueError):
+            with open(path, encoding='utf-8') as fp:
+                saved = json.load(fp)
+        entry = saved.get('device') if isinstance(saved, dict) else None
+        if (isinstance(entry, dict)
+                and {k: entry.get(k) for k in key} == key
+                and entry.get('value')):
+            return entry['value']
+        device = provider.get_device()
+        if device != UNKNOWN_DEVICE:
+            saved = dict(device=dict(value=device, **key))
+            try:
+                with atomic(path) as fp:
+                    json.dump(saved, fp)
+            except OSError as error:
+                log.info('Cannot save {}: {}', path, error)
+        return device
+
+
+facts = HostFacts()
@@ -17,18 +17,37 @@
 
 __all__ = [
     'Context',
+    'KeyringIndex',
+    'KeyringInfo',
     'SignatureError',
+    'keyring_index',
+    'verify_file',
     ]
 
 
 import os
+import json
 import gnupg
 import hashlib
 import tarfile
 
+from collections import namedtuple
 from contextlib import ExitStack
 from systemimage.config import config
-from systemimage.helpers import calculate_signature, temporary_directory
+from systemimage.helpers import (
+    atomic, calculate_signature, makedirs, temporary_directory)
+from systemimage.statistics import statistics
+from systemimage.trace import traced, tracer
+from threading import Lock
+
+
+KEYRING_CACHE_DIR = 'keyring-cache'
+KEYRING_INDEX_FILE = 'index.json'
+
+# Everything we ever need to know about a keyring .tar.xz file, short of
+# actually loading its keys into gpg.
+KeyringInfo = namedtuple('KeyringInfo',
+                         'type model expiry fingerprints gpg_path')
 
 
 class SignatureError(Exception):
@@ -86,6 +105,199 @@ class SignatureError(Exception):
 """.format(self, list(self.keyrings), checksum_str, path_str)
 
 
+def _list_fingerprints(gpg_path):
+    with temporary_directory(prefix='si-gnupghome',
+                             dir=config.tempdir) as home:
+        with statistics.gpg():
+            tracer.add_subprocess()
+            ctx = gnupg.GPG(gnupghome=home, keyring=[gpg_path])
+        with statistics.gpg():
+            tracer.add_subprocess()
+            keys = ctx.list_keys()
+        return sorted(info['fingerprint'] for info in keys)
+
+
+class KeyringIndex:
+    """Metadata about keyring .tar.xz files, keyed on the tarball's digest.
+
+    Every check has to look inside the image-master and image-signing
+    tarballs, both to find the keyring.gpg file and to make sure the
+    keyring.json file says the keyring hasn't expired.  Unpacking them means
+    xz decompression, which is not cheap on a phone.  Instead, we unpack each
+    distinct tarball once, remember what's in keyring.json along with the
+    keyring's fingerprints, and keep the extracted .gpg file around under a
+    name derived from the tarball's SHA256 digest.
+
+    The digest itself is memoized on the tarball's inode, size, and mtime, so
+    in the steady state a lookup costs a single stat() call.  The index is
+    persisted in a directory next to the settings database so that it
+    survives across processes; if that isn't writable, the index is kept in
+    the process's temporary directory instead.
+
+    The index also maps the digests of bare .gpg keyring files to their
+    fingerprints, so that gpg only ever has to list the keys of any given
+    keyring once per process.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (path, inode, size, mtime) -> hex digest
+        self._digests = {}
+        # (cache directory, hex digest) -> KeyringInfo
+        self._entries = {}
+        # settings.db path -> cache directory
+        self._directories = {}
+        # Cache directories whose index file has been read.
+        self._loaded = set()
+        # .gpg file hex digest -> tuple of fingerprints
+        self._fingerprints = {}
+
+    def clear(self):
+        """Forget everything, but leave the persistent index alone."""
+        with self._lock:
+            self._digests.clear()
+            self._entries.clear()
+            self._directories.clear()
+            self._loaded.clear()
+            self._fingerprints.clear()
+
+    def digest(self, path):
+        """Return the SHA256 hex digest of the file at `path`.
+
+        :raises FileNotFoundError: when the path does not exist.
+        """
+        info = os.stat(path)
+        key = (path, info.st_ino, info.st_size, info.st_mtime_ns)
+        checksum = self._digests.get(key)
+        if checksum is None:
+            with open(path, 'rb') as fp:
+                checksum = calculate_signature(fp)
+            self._digests[key] = checksum
+        return checksum
+
+    def _directory(self):
+        settings_db = str(config.system.settings_db)
+        directory = self._directories.get(settings_db)
+        if directory is None:
+            directory = os.path.join(
+                os.path.dirname(settings_db), KEYRING_CACHE_DIR)
+            try:
+                makedirs(directory)
+                if not os.access(directory, os.W_OK):
+                    raise PermissionError(directory)
+            except OSError:
+                # Fall back to the per-process temporary directory.  The
+                # index won't outlive this process, but it still saves us
+                # unpacking the same tarball over and over.
+                directory = os.path.join(config.tempdir, KEYRING_CACHE_DIR)
+                makedirs(directory)
+            self._directories[settings_db] = directory
+        return directory
+
+    def _load(self, directory):
+        if directory in self._loaded:
+            return
+        self._loaded.add(directory)
+        try:
+            with open(os.path.join(directory, KEYRING_INDEX_FILE),
+                      encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            # A missing or corrupt index just means we start from scratch.
+            return
+        for checksum, record in data.items():
+            self._entries[(directory, checksum)] = KeyringInfo(
+                record.get('type'),
+                record.get('model'),
+                record.get('expiry'),
+                tuple(record.get('fingerprints', ())),
+                os.path.join(directory, checksum + '.gpg'))
+
+    def _save(self, directory):
+        data = {}
+        for (entry_directory, checksum), info in self._entries.items():
+            if entry_directory == directory:
+                data[checksum] = dict(
+                    type=info.type,
+                    model=info.model,
+                    expiry=info.expiry,
+                    fingerprints=list(info.fingerprints),
+                    )
+        try:
+            with atomic(os.path.join(directory, KEYRING_INDEX_FILE)) as fp:
+                json.dump(data, fp, sort_keys=True)
+        except OSError:                             # pragma: no cover
+            # We'll just have to unpack the tarball again next time.
+            pass
+
+    def _extract(self, path, gpg_path):
+        with tarfile.open(path, 'r:xz') as tf:
+            gpg_data = tf.extractfile('keyring.gpg').read()
+            try:
+                json_fp = tf.extractfile('keyring.json')
+            except KeyError:
+                data = {}
+            else:
+                data = json.loads(json_fp.read().decode('utf-8'))
+        with atomic(gpg_path, encoding=None) as fp:
+            fp.write(gpg_data)
+        return KeyringInfo(
+            data.get('type'),
+            data.get('model'),
+            data.get('expiry'),
+            self._gpg_fingerprints(gpg_path),
+            gpg_path)
+
+    def _gpg_fingerprints(self, gpg_path):
+        checksum = self.digest(gpg_path)
+        fingerprints = self._fingerprints.get(checksum)
+        if fingerprints is None:
+            fingerprints = tuple(_list_fingerprints(gpg_path))
+            self._fingerprints[checksum] = fingerprints
+        return fingerprints
+
+    def fingerprints(self, gpg_path):
+        """Return the fingerprints of the keys in a bare .gpg keyring file.
+
+        :param gpg_path: The path to the .gpg keyring file.
+        :return: The sorted fingerprints.
+        :rtype: tuple
+        :raises FileNotFoundError: when the keyring does not exist.
+        """
+        with self._lock:
+            return self._gpg_fingerprints(gpg_path)
+
+    def lookup(self, path):
+        """Return the `KeyringInfo` for the given keyring .tar.xz file.
+
+        The tarball is only unpacked if we've never seen its contents before
+        (or if the extracted .gpg file has since disappeared).  Note that
+        this does *not* verify the signature on the tarball.  That must be
+        done elsewhere.
+
+        :param path: The path to the keyring .tar.xz file.
+        :return: The keyring's metadata.
+        :rtype: KeyringInfo
+        :raises FileNotFoundError: when the tarball does not exist.
+        """
+        with self._lock:
+            checksum = self.digest(path)
+            directory = self._directory()
+            self._load(directory)
+            info = self._entries.get((directory, checksum))
+            if info is not None and os.path.exists(info.gpg_path):
+                return info
+            info = self._extract(
+                path, os.path.join(directory, checksum + '.gpg'))
+            self._entries[(directory, checksum)] = info
+            self._save(directory)
+            return info
+
+
+# The process-wide keyring index.
+keyring_index = KeyringIndex()
+
+
 
 class Context:
     def __init__(self, *keyrings, blacklist=None):
@@ -105,24 +317,29 @@ class Context:
         self._ctx = None
         self._stack = ExitStack()
         self._keyrings = []
-        # The keyrings must be .tar.xz files, which need to be unpacked and
-        # the keyring.gpg files inside them cached, using their actual name
-        # (based on the .tar.xz file name).  If we don't already have a cache
-        # of the .gpg file, do the unpackaging and use the contained .gpg file
-        # as the keyring.  Note that this class does *not* validate the
-        # .tar.xz files.  That must be done elsewhere.
+        # All the fingerprints come out of the keyring index, so there's no
+        # need to ask gpg to list the keys in either the keyrings or the
+        # blacklist, and verification is just a set lookup.
+        self._fingerprints = set()
+        fallbacks = []
+        # The keyrings must be .tar.xz files, which need to be unpacked to
+        # get at the keyring.gpg files inside them.  The keyring index takes
+        # care of only unpacking any given tarball once.  If the tarball
+        # doesn't exist, fall back to a .gpg file cached in the temporary
+        # directory under the tarball's base name.  Note that this class does
+        # *not* validate the .tar.xz files.  That must be done elsewhere.
         for path in keyrings:
             base, dot, tarxz = os.path.basename(path).partition('.')
             assert dot == '.' and tarxz == 'tar.xz', (
                 'Expected a .tar.xz path, got: {}'.format(path))
-            keyring_path = os.path.join(config.tempdir, base + '.gpg')
-            if not os.path.exists(keyring_path):
-                with tarfile.open(path, 'r:xz') as tf:
-                    tf.extract('keyring.gpg', config.tempdir)
-                    os.rename(
-                        os.path.join(config.tempdir, 'keyring.gpg'),
-                        os.path.join(config.tempdir, keyring_path))
-            self._keyrings.append(keyring_path)
+            if os.path.exists(path):
+                info = keyring_index.lookup(path)
+                self._keyrings.append(info.gpg_path)
+                self._fingerprints.update(info.fingerprints)
+            else:
+                keyring_path = os.path.join(config.tempdir, base + '.gpg')
+                self._keyrings.append(keyring_path)
+                fallbacks.append(keyring_path)
         # Since python-gnupg doesn't do this for us, verify that all the
         # keyrings and blacklist files exist.  Yes, this introduces a race
         # condition, but I don't see any good way to eliminate this given
@@ -130,15 +347,20 @@ class Context:
         for path in self._keyrings:
             if not os.path.exists(path):            # pragma: no cover
                 raise FileNotFoundError(path)
+        for path in fallbacks:
+            self._fingerprints.update(keyring_index.fingerprints(path))
         if blacklist is not None:
             if not os.path.exists(blacklist):
                 raise FileNotFoundError(blacklist)
             # Extract all the blacklisted fingerprints.
-            with Context(blacklist) as ctx:
-                self._blacklisted_fingerprints = ctx.fingerprints
+            self._blacklisted_fingerprints = set(
+                keyring_index.lookup(blacklist).fingerprints)
         else:
             self._blacklisted_fingerprints = set()
+        self._valid_fingerprints = frozenset(
+            self._fingerprints - self._blacklisted_fingerprints)
 
+    @traced('Context.enter', 'gpg')
     def __enter__(self):
         try:
             # Use a temporary directory for the $GNUPGHOME, but be sure to
@@ -146,7 +368,10 @@ class Context:
             home = self._stack.enter_context(
                 temporary_directory(prefix='si-gnupghome',
                                     dir=config.tempdir))
-            self._ctx = gnupg.GPG(gnupghome=home, keyring=self._keyrings)
+            with statistics.gpg():
+                # Even creating the context runs gpg, to get its version.
+                tracer.add_subprocess()
+                self._ctx = gnupg.GPG(gnupghome=home, keyring=self._keyrings)
             self._stack.callback(setattr, self, '_ctx', None)
         except:              # pragma: no cover
             # Restore all context and re-raise the exception.
@@ -162,16 +387,19 @@ class Context:
 
     @property
     def keys(self):
+        tracer.add_subprocess()
         return self._ctx.list_keys()
 
     @property
     def fingerprints(self):
-        return set(info['fingerprint'] for info in self._ctx.list_keys())
+        return set(self._fingerprints)
 
     @property
     def key_ids(self):
+        tracer.add_subprocess()
         return set(info['keyid'] for info in self._ctx.list_keys())
 
+    @traced('Context.verify', 'gpg')
     def verify(self, signature_path, data_path):
         """Verify a GPG signature.
 
@@ -193,14 +421,15 @@ class Context:
         # disable all GPG checks.
         if config.skip_gpg_verification:
             return True
-        with open(signature_path, 'rb') as sig_fp:
+        with open(signature_path, 'rb') as sig_fp, statistics.gpg():
+            tracer.add_subprocess()
             verified = self._ctx.verify_file(sig_fp, data_path)
         # If the file is properly signed, we'll be able to get back a set of
         # fingerprints that signed the file.   From here we do a set operation
         # to see if the fingerprints are in the list of keys from all the
-        # loaded-up keyrings.  If so, the signature succeeds.
-        return verified.fingerprint in (self.fingerprints -
-                                        self._blacklisted_fingerprints)
+        # loaded-up keyrings, minus the blacklisted ones.  If so, the
+        # signature succeeds.
+        return verified.fingerprint in self._valid_fingerprints
 
     def validate(self, signature_path, data_path):
         """Like .verify() but raises a SignatureError when invalid.
@@ -219,3 +448,26 @@ class Context:
         if not self.verify(signature_path, data_path):
             raise SignatureError(signature_path, data_path,
                                  self.keyring_paths, self.blacklist_path)
+
+
+def verify_file(path, signature_path, keyrings, checksum=None,
+                blacklist=None):
+    """Is a local file present, properly signed, and the expected one?
+
+    :param path: The file system path to the data file.
+    :param signature_path: The file system path to its detached signature.
+    :param keyrings: The keyrings the signature must be good against.
+    :param checksum: If given, the SHA256 hex digest the data file must have.
+    :param blacklist: The blacklist keyring, if there is one.
+    :return: True if both files exist, the signature is good, and the
+        checksum matches.
+    """
+    if not os.path.exists(path) or not os.path.exists(signature_path):
+        return False
+    with Context(*keyrings, blacklist=blacklist) as ctx:
+        if not ctx.verify(signature_path, path):
+            return False
+    if checksum is None:
+        return True
+    with open(path, 'rb') as fp:
+        return calculate_signature(fp) == checksum
@@ -17,16 +17,20 @@
 
 __all__ = [
     'DEFAULT_DIRMODE',
+    'GiB',
     'MiB',
     'as_loglevel',
     'as_object',
     'as_port',
+    'as_positive_size',
+    'as_size',
     'as_stripped',
     'as_timedelta',
     'atomic',
     'calculate_signature',
     'last_update_date',
     'makedirs',
+    'package_version',
     'phased_percentage',
     'safe_remove',
     'temporary_directory',
@@ -41,8 +45,8 @@ import shutil
 import logging
 import tempfile
 
-from contextlib import ExitStack, contextmanager, suppress
-from datetime import datetime, timedelta
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
 from hashlib import sha256
 from importlib import import_module
 
@@ -52,6 +56,7 @@ LAST_UPDATE_FILE = '/userdata/.last_update'
 TIMEKEEPER_OFFSET_FILE = '/data/time/timekeep'
 DEFAULT_DIRMODE = 0o02700
 MiB = 1 << 20
+GiB = 1 << 30
 EMPTYSTRING = ''
 NO_PORT = object()
 
@@ -147,6 +152,10 @@ class _Called:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __str__(self):
+        # The dotted path, without importing anything.
+        return '{}.{}'.format(self._path, self._name)
+
 
 def as_object(value):
     """Convert a Python dotted-path specification to an object.
@@ -214,6 +223,28 @@ def as_port(value):
     return result
 
 
+def as_size(value):
+    """Convert a size string to the equivalent number of bytes.
+
+    The size is a non-negative integer, optionally followed by one of the
+    (case-insensitive) binary unit markers ``K``, ``M``, or ``G``.
+    """
+    mo = re.fullmatch(r'\s*(\d+)\s*([kmg]?)\s*', value, re.IGNORECASE)
+    if mo is None:
+        raise ValueError(value)
+    number, unit = mo.groups()
+    shift = {'': 0, 'k': 10, 'm': 20, 'g': 30}[unit.lower()]
+    return int(number) << shift
+
+
+def as_positive_size(value):
+    """Like `as_size()`, but the size can't be zero."""
+    size = as_size(value)
+    if size == 0:
+        raise ValueError(value)
+    return size
+
+
 def as_stripped(value):
     return value.strip()
 
@@ -240,6 +271,18 @@ def makedirs(dir, mode=DEFAULT_DIRMODE):
     os.makedirs(dir, mode=mode, exist_ok=True)
 
 
+def package_version():
+    """Return the version of system-image, from the version.txt file.
+
+    This reads the file directly instead of through pkg_resources, which is
+    very slow to import, and would be the bulk of the command line's startup
+    time.
+    """
+    path = os.path.join(os.path.dirname(__file__), 'version.txt')
+    with open(path, encoding='utf-8') as fp:
+        return fp.read().strip()
+
+
 def get_android_offset():
     """Return the number of seconds delta between the hardware clock and now.
 
@@ -278,28 +321,12 @@ def last_update_date():
     /etc/system-image/config.d/*.ini (or whatever directory was given with the
     -C/--config option).  We also use the Android offset, if it is available,
     to get a more correct date.
+
+    The date is cached until any of these files change.
     """
     # Avoid circular imports.
-    from systemimage.config import config
-    try:
-        timestamp_raw = os.stat(LAST_UPDATE_FILE).st_mtime
-        timestamp = datetime.fromtimestamp(timestamp_raw)
-    except (FileNotFoundError, PermissionError):
-        # We fall back to the latest mtime of the config.d/*.ini files.  For
-        # robustness, watch out for two possibilities: the config file could
-        # have been deleted after the system started up (thus making
-        # config.ini_files include nonexistent files), and the ini file could
-        # be a dangling symlink.  For the latter, use lstat().
-        timestamps = []
-        for path in config.ini_files:
-            with suppress(FileNotFoundError):
-                timestamps.append(
-                    datetime.fromtimestamp(path.lstat().st_mtime))
-        if len(timestamps) == 0:
-            return 'Unknown'
-        timestamp = sorted(timestamps)[-1]
-    delta = timedelta(seconds=get_android_offset())
-    return str(timestamp.replace(microsecond=0) + delta)
+    from systemimage.facts import facts
+    return facts.last_update_date()
 
 
 def version_detail(details_string=None):
@@ -322,17 +349,10 @@ def version_detail(details_string=None):
 def phased_percentage(channel, target):
     # Avoid circular imports.
     from systemimage.config import config
+    from systemimage.facts import facts
     if config.phase_override is not None:
         return config.phase_override
-    for path in UNIQUE_MACHINE_ID_FILES:
-        try:
-            with open(path, 'r', encoding='utf-8') as fp:
-                machine_id = fp.read().strip()
-                break                               # pragma: no branch
-        except FileNotFoundError:
-            pass
-    else:
-        raise RuntimeError('No machine-id file found')
+    machine_id = facts.machine_id()
     r = random.Random()
     r.seed('{}.{}.{}'.format(channel, target, machine_id))
     return r.randint(0, 100)
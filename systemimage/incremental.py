@@ -0,0 +1,99 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generate incremental indexes from a full index.
+
+A full index.json file has every image ever published for a channel and
+device, so it grows forever.  An incremental index only has the images that
+can be part of an upgrade path for devices at or above a given build: the
+full images newer than that build, and the deltas based on it or anything
+newer.  Clients at or above the build get exactly the same candidate upgrade
+paths from it as from the full index.
+
+Run this as:
+
+    $ python3 -m systemimage.incremental --since 300 index.json \\
+          -o index-since-300.json
+
+then sign the output like the full index, and advertise it in the device's
+entry in channels.json:
+
+    "incremental": [
+        {"since": 300, "index": "/daily/mako/index-since-300.json"}
+        ]
+"""
+
+__all__ = [
+    'incremental_index',
+    'main',
+    ]
+
+
+import sys
+import json
+import argparse
+
+
+def incremental_index(data, since):
+    """Return an incremental index for devices at or above a build.
+
+    :param data: The JSON text of the full index.
+    :param since: The lowest build the incremental index is good for.
+    :return: The JSON text of the incremental index.
+    """
+    mapping = json.loads(data)
+    images = []
+    for image in mapping['images']:
+        if image['type'] == 'full':
+            # A device never upgrades to a full image at or below its build.
+            keep = image['version'] > since
+        else:
+            # Nor to a delta based on a build below its own.
+            keep = image['base'] >= since
+        if keep:
+            images.append(image)
+    global_ = dict(mapping['global'])
+    global_['since'] = since
+    return json.dumps({'global': global_, 'images': images},
+                      indent=4, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m systemimage.incremental',
+        description='Generate an incremental index from a full index')
+    parser.add_argument('index', metavar='INDEX',
+                        help="""The full index.json file.""")
+    parser.add_argument('-s', '--since', type=int, required=True,
+                        metavar='BUILD',
+                        help="""The lowest build number the incremental index
+                        is good for.""")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="""Write the incremental index to FILE instead
+                        of standard output.""")
+    args = parser.parse_args(argv)
+    with open(args.index, encoding='utf-8') as fp:
+        full = fp.read()
+    incremental = incremental_index(full, args.since)
+    if args.output is None:
+        print(incremental)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            fp.write(incremental)
+    return 0
+
+
+if __name__ == '__main__':                          # pragma: no cover
+    sys.exit(main())
@@ -25,6 +25,7 @@ import json
 from datetime import datetime, timezone
 from systemimage.bag import Bag
 from systemimage.image import Image
+from systemimage.trace import traced
 
 
 IN_FMT = '%a %b %d %H:%M:%S %Z %Y'
@@ -33,10 +34,11 @@ OUT_FMT = '%a %b %d %H:%M:%S UTC %Y'
 
 class Index(Bag):
     @classmethod
+    @traced('Index.from_json', 'parse')
     def from_json(cls, data):
         """Parse the JSON data and produce an index."""
         mapping = json.loads(data)
-        # Parse the global data, of which there is only the timestamp.  Even
+        # Parse the global data, which is mostly just the timestamp.  Even
         # though the string will contain 'UTC' (which we assert is so since we
         # can only handle UTC timestamps), strptime() will return a naive
         # datetime.  We'll turn it into an aware datetime in UTC, which is the
@@ -46,6 +48,10 @@ class Index(Bag):
         naive_generated_at = datetime.strptime(timestamp_str, IN_FMT)
         generated_at=naive_generated_at.replace(tzinfo=timezone.utc)
         global_ = Bag(generated_at=generated_at)
+        # Incremental indexes also say which build they cover devices from.
+        since = mapping['global'].get('since')
+        if since is not None:
+            global_['since'] = since
         # Parse the images.
         images = []
         for image_data in mapping['images']:
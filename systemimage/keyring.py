@@ -18,20 +18,19 @@
 
 __all__ = [
     'KeyringError',
+    'check_keyring',
     'get_keyring',
     ]
 
 
 import os
-import json
 import shutil
-import tarfile
 
 from contextlib import ExitStack
 from datetime import datetime, timezone
 from systemimage.config import config
 from systemimage.download import get_download_manager
-from systemimage.gpg import Context
+from systemimage.gpg import Context, keyring_index
 from systemimage.helpers import makedirs, safe_remove
 from urllib.parse import urljoin
 
@@ -43,6 +42,45 @@ class KeyringError(Exception):
         self.message = message
 
 
+def check_keyring(path, keyring_type, model):
+    """Verify the contents of a keyring .tar.xz file.
+
+    Its keyring.json file must name the expected keyring type, and the
+    given device model if it names one at all, and the keyring must not have
+    expired.  The signature of the file is not checked.
+
+    :param path: The path to the keyring .tar.xz file.
+    :param keyring_type: The expected type of the keyring.
+    :param model: The device model the keyring must apply to.
+    :return: The keyring's information from the keyring index.
+    :raises KeyringError: when any of the checks fail.
+    """
+    # The keyring index unpacks the tarball for us, and remembers what it
+    # found so that subsequent uses of the installed copy of this keyring
+    # won't need to unpack it again.
+    info = keyring_index.lookup(path)
+    # Check the mandatory keys first.
+    json_type = info.type
+    if keyring_type != json_type:
+        raise KeyringError(
+            'keyring type mismatch; wanted: {}, got: {}'.format(
+                keyring_type, json_type))
+    # Check the optional keys next.
+    json_model = info.model
+    if json_model not in (model, None):
+        raise KeyringError(
+            'keyring model mismatch; wanted: {}, got: {}'.format(
+                model, json_model))
+    expiry = info.expiry
+    if expiry is not None:
+        # Get our current timestamp in UTC.
+        timestamp = datetime.now(tz=timezone.utc).timestamp()
+        if expiry < timestamp:
+            # We've passed the expiration date for this keyring.
+            raise KeyringError('expired keyring timestamp')
+    return info
+
+
 def get_keyring(keyring_type, urls, sigkr, blacklist=None):
     """Download, verify, and unpack a keyring.
 
@@ -111,35 +149,8 @@ def get_keyring(keyring_type, urls, sigkr, blacklist=None):
         signing_keyring = getattr(config.gpg, sigkr.replace('-', '_'))
         with Context(signing_keyring, blacklist=blacklist) as ctx:
             ctx.validate(ascxz_dst, tarxz_dst)
-        # The signature is good, so now unpack the tarball, load the json file
-        # and verify its contents.
-        keyring_gpg = os.path.join(config.tempdir, 'keyring.gpg')
-        keyring_json = os.path.join(config.tempdir, 'keyring.json')
-        with tarfile.open(tarxz_dst, 'r:xz') as tf:
-            tf.extractall(config.tempdir)
-        stack.callback(os.remove, keyring_gpg)
-        stack.callback(os.remove, keyring_json)
-        with open(keyring_json, 'r', encoding='utf-8') as fp:
-            data = json.load(fp)
-        # Check the mandatory keys first.
-        json_type = data['type']
-        if keyring_type != json_type:
-            raise KeyringError(
-                'keyring type mismatch; wanted: {}, got: {}'.format(
-                    keyring_type, json_type))
-        # Check the optional keys next.
-        json_model = data.get('model')
-        if json_model not in (config.device, None):
-            raise KeyringError(
-                'keyring model mismatch; wanted: {}, got: {}'.format(
-                    config.device, json_model))
-        expiry = data.get('expiry')
-        if expiry is not None:
-            # Get our current timestamp in UTC.
-            timestamp = datetime.now(tz=timezone.utc).timestamp()
-            if expiry < timestamp:
-                # We've passed the expiration date for this keyring.
-                raise KeyringError('expired keyring timestamp')
+        # The signature is good, so now verify the contents of the keyring.
+        info = check_keyring(tarxz_dst, keyring_type, config.device)
         # Everything checks out.  We now have the generic keyring.tar.xz and
         # keyring.tar.xz.asc files inside the cache (or data, in the case of
         # the blacklist) partition, which is where they need to be for
@@ -165,4 +176,4 @@ def get_keyring(keyring_type, urls, sigkr, blacklist=None):
         # will always fallback to this path to avoid unpacking the .tar.xz
         # file every single time.
         gpg_path = os.path.join(config.tempdir, keyring_type + '.gpg')
-        shutil.copy(keyring_gpg, gpg_path)
+        shutil.copy(info.gpg_path, gpg_path)
@@ -16,26 +16,41 @@
 """Set up logging, both for main script execution and the test suite."""
 
 __all__ = [
+    'BatchingQueueHandler',
     'debug_logging',
     'initialize',
     'make_handler',
     ]
 
 
+import os
 import sys
+import gzip
 import stat
+import atexit
+import shutil
 import logging
 
 from contextlib import contextmanager, suppress
+from logging.handlers import QueueHandler, RotatingFileHandler
 from pathlib import Path
+from queue import Empty, Queue
 from systemimage.config import config
 from systemimage.helpers import DEFAULT_DIRMODE
+from threading import Thread
 from xdg.BaseDirectory import xdg_cache_home
 
 
 DATE_FMT = '%b %d %H:%M:%S %Y'
 MSG_FMT = '[{name}] {asctime} ({process:d}) {message}'
 LOGFILE_PERMISSIONS = stat.S_IRUSR | stat.S_IWUSR
+# The most records the background writer will write before flushing.
+BATCH_SIZE = 100
+# Only used to format tracebacks before records are queued.
+_FORMATTER = logging.Formatter()
+# Arguments of these types can't change after they're logged, so messages
+# with only these can be left for the writer thread to format.
+_IMMUTABLE = (str, bytes, int, float, bool, type(None))
 
 
 # We want to support {}-style logging for all systemimage child loggers.  One
@@ -51,74 +66,280 @@ LOGFILE_PERMISSIONS = stat.S_IRUSR | stat.S_IWUSR
 # convenient to make the logging calls because you can't pass strings
 # directly.  One such suggestion at <http://tinyurl.com/pjjwjxq> is to import
 # the class as __ (i.e. double underscore) so your logging calls would look
-# like: log.error(__('Message with {} {}'), foo, bar)
+# like: log.error(__('Message with {} {}'), foo, bar).  Either way, the
+# message is only formatted when a handler emits the record, and then only
+# once, no matter how many handlers emit it.  Callers should pass the
+# arguments rather than calling .format() themselves, so that records which
+# no handler emits never get formatted at all.  (The one exception is the
+# BatchingQueueHandler, which formats messages whose arguments could change
+# before the writer thread gets to them, as they're queued.)
 
 class FormattingLogRecord(logging.LogRecord):
     def __init__(self, name, *args, **kws):
         logger_path = name.split('.')
         self._use_format = (logger_path[0] == 'systemimage')
+        self._formatted = None
         super().__init__(name, *args, **kws)
 
     def getMessage(self):
         if self._use_format:
-            msg = str(self.msg)
-            if self.args:
-                msg = msg.format(*self.args)
-            return msg
+            if self._formatted is None:
+                msg = str(self.msg)
+                if self.args:
+                    msg = msg.format(*self.args)
+                self._formatted = msg
+            return self._formatted
         else:                                       # pragma: no cover
             return super().getMessage()
 
 
-def make_handler(path):
+class _FileHandler(RotatingFileHandler):
+    """A log file handler with compressed, size-based rotation.
+
+    When the log file would grow past `max_bytes`, it is renamed to
+    `<name>.1` and a fresh log file is started.  `<name>.1` is then gzip'd to
+    `<name>.1.gz` in a background thread, so the thread doing the logging
+    doesn't have to wait for it.  At most `backup_count` compressed segments
+    are kept around.  A `max_bytes` of zero disables rotation.
+
+    It can also leave flushing until the end of a batch.
+    """
+
+    batching = False
+
+    def __init__(self, path, *, max_bytes, backup_count):
+        # The current size of the log file; set by _open().
+        self._size = 0
+        self._compressor = None
+        super().__init__(str(path), encoding='utf-8',
+                         maxBytes=max_bytes, backupCount=backup_count)
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+    def _open(self):
+        stream = super()._open()
+        self._size = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def emit(self, record):
+        # Keep track of the file size ourselves, rather than letting the base
+        # class seek to the end of the file on every record.  Seeking would
+        # flush the stream, defeating the batching.
+        try:
+            msg = self.format(record) + self.terminator
+            size = len(msg.encode('utf-8'))
+            if self.stream is None:
+                self.stream = self._open()
+            if (self.maxBytes > 0 and self._size > 0
+                    and self._size + size > self.maxBytes):
+                self.doRollover()
+            self.stream.write(msg)
+            self._size += size
+            self.flush()
+        except RecursionError:                      # pragma: no cover
+            raise
+        except Exception:                           # pragma: no cover
+            self.handleError(record)
+
+    def _segment(self, number):
+        return '{}.{}.gz'.format(self.baseFilename, number)
+
+    def doRollover(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        # The previous segment must be fully compressed before the segments
+        # get shifted down.  It's almost certainly long done by now.
+        if self._compressor is not None:
+            self._compressor.join()
+            self._compressor = None
+        if self.backupCount > 0:
+            with suppress(FileNotFoundError):
+                os.remove(self._segment(self.backupCount))
+            for number in range(self.backupCount - 1, 0, -1):
+                with suppress(FileNotFoundError):
+                    os.rename(self._segment(number),
+                              self._segment(number + 1))
+            uncompressed = self.baseFilename + '.1'
+            os.rename(self.baseFilename, uncompressed)
+            self._compressor = Thread(
+                target=_compress, args=(uncompressed, self._segment(1)),
+                name='system-image-logrotate', daemon=True)
+            self._compressor.start()
+        else:
+            os.remove(self.baseFilename)
+        Path(self.baseFilename).touch(LOGFILE_PERMISSIONS)
+        self.stream = self._open()
+
+    def close(self):
+        super().close()
+        if self._compressor is not None:
+            self._compressor.join()
+            self._compressor = None
+
+
+def _compress(src, dst):
+    # Write to a temporary file first so that a crash never leaves a
+    # truncated segment behind.
+    tmp = dst + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 LOGFILE_PERMISSIONS)
+    with open(src, 'rb') as in_fp, open(fd, 'wb') as raw:
+        with gzip.GzipFile(filename=os.path.basename(src),
+                           mode='wb', fileobj=raw) as out_fp:
+            shutil.copyfileobj(in_fp, out_fp)
+    os.rename(tmp, dst)
+    os.remove(src)
+
+
+class BatchingQueueHandler(QueueHandler):
+    """Hand records off to a background thread which writes them.
+
+    Logging calls usually only have to put the record on a queue, so they
+    never wait on the disk, and the message is formatted by the writer
+    thread.  The writer thread takes records
+    off the queue in batches of up to BATCH_SIZE, and has each of the wrapped
+    handlers emit the whole batch before flushing once.
+    """
+
+    def __init__(self, handlers):
+        super().__init__(Queue())
+        self._handlers = handlers
+        self._thread = Thread(
+            target=self._run, name='system-image-logging', daemon=True)
+        self._thread.start()
+        # Write out anything still queued before the process exits.
+        atexit.register(self.close)
+
+    def prepare(self, record):
+        # The record must say what its arguments were when it was logged,
+        # not when it gets written.  Strings and numbers can't change, so
+        # those messages are left for the writer thread to format.  Anything
+        # else, such as the state machine's lists, may be changed by the
+        # caller afterward, so those messages are formatted now, in the
+        # caller's thread.  So are tracebacks, which are rare.
+        if not (isinstance(record.args, tuple)
+                and all(isinstance(arg, _IMMUTABLE) for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            done = (batch[-1] is None)
+            if done:
+                batch.pop()
+            self._write(batch)
+            if done:
+                break
+
+    def _write(self, batch):
+        for handler in self._handlers:
+            handler.batching = True
+            try:
+                for record in batch:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                handler.batching = False
+            handler.flush()
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+            for handler in self._handlers:
+                handler.close()
+        super().close()
+
+
+def make_handler(path, *, max_bytes=None, backup_count=None):
+    """Return a handler which logs to the file at `path`.
+
+    The file is rotated once it reaches `max_bytes` in size, keeping
+    `backup_count` compressed old segments.  These default to the
+    `[system]logsize` and `[system]logcount` configuration variables.
+    """
+    if max_bytes is None:
+        max_bytes = config.system.logsize
+    if backup_count is None:
+        backup_count = config.system.logcount
     # issue21539 - mkdir(..., exist_ok=True)
     with suppress(FileExistsError):
         path.parent.mkdir(DEFAULT_DIRMODE, parents=True)
     path.touch(LOGFILE_PERMISSIONS)
     # Our handler will output in UTF-8 using {} style logging.
     formatter = logging.Formatter(style='{', fmt=MSG_FMT, datefmt=DATE_FMT)
-    handler = logging.FileHandler(bytes(path), encoding='utf-8')
+    handler = _FileHandler(
+        path, max_bytes=max_bytes, backup_count=backup_count)
     handler.setFormatter(formatter)
     return handler
 
 
-def initialize(*, verbosity=0):
-    """Initialize the loggers."""
+def initialize(*, verbosity=0, queue=False):
+    """Initialize the loggers.
+
+    :param verbosity: How much logging to also send to stderr.
+    :param queue: If true, records are written to the log file by a
+        background thread, so that logging never blocks the caller.  This
+        is meant for long-running processes such as the D-Bus service.
+    """
     main, dbus = config.system.loglevel
-    for name, loglevel in (('systemimage', main),
-                           ('systemimage.dbus', dbus),
-                           ('dbus.proxies', dbus)):
-        level = {
-            0: logging.ERROR,
-            1: logging.INFO,
-            2: logging.DEBUG,
-            3: logging.CRITICAL,
-            }.get(verbosity, logging.ERROR)
-        level = min(level, loglevel)
-        # Make sure our library's logging uses {}-style messages.
-        logging.setLogRecordFactory(FormattingLogRecord)
+    verbosity_level = {
+        0: logging.ERROR,
+        1: logging.INFO,
+        2: logging.DEBUG,
+        3: logging.CRITICAL,
+        }.get(verbosity, logging.ERROR)
+    loggers = [(name, min(verbosity_level, loglevel))
+               for name, loglevel in (('systemimage', main),
+                                      ('systemimage.dbus', dbus),
+                                      ('dbus.proxies', dbus))]
+    # Make sure our library's logging uses {}-style messages.
+    logging.setLogRecordFactory(FormattingLogRecord)
+    # All the loggers share one handler for the log file.  Only it can rotate
+    # the file safely, since any other handler would keep writing to the
+    # renamed segment.  The handlers pass everything the loggers let
+    # through, and each logger's level is set below.
+    lowest = min(level for name, level in loggers)
+    handlers = []
+    try:
+        handler = make_handler(Path(config.system.logfile))
+    except PermissionError:
+        handler = make_handler(
+            Path(xdg_cache_home) / 'system-image' / 'client.log')
+    handler.setLevel(lowest)
+    handlers.append(handler)
+    # If we want more verbosity, add a stream handler.
+    if verbosity != 0:                              # pragma: no cover
+        handler = logging.StreamHandler(stream=sys.stderr)
+        handler.setLevel(lowest)
+        formatter = logging.Formatter(
+            style='{', fmt=MSG_FMT, datefmt=DATE_FMT)
+        handler.setFormatter(formatter)
+        handlers.append(handler)
+    # Likewise, there's only one queue and writer thread for all of them.
+    if queue:
+        handlers = [BatchingQueueHandler(handlers)]
+    for name, level in loggers:
         # Now configure the application level logger based on the ini file.
         log = logging.getLogger(name)
-        try:
-            handler = make_handler(Path(config.system.logfile))
-        except PermissionError:
-            handler = make_handler(
-                Path(xdg_cache_home) / 'system-image' / 'client.log')
-        handler.setLevel(level)
-        log.addHandler(handler)
         log.propagate = False
-        # If we want more verbosity, add a stream handler.
-        if verbosity == 0:                          # pragma: no branch
-            # Set the log level.
-            log.setLevel(level)
-        else:                                       # pragma: no cover
-            handler = logging.StreamHandler(stream=sys.stderr)
-            handler.setLevel(level)
-            formatter = logging.Formatter(
-                style='{', fmt=MSG_FMT, datefmt=DATE_FMT)
-            handler.setFormatter(formatter)
+        log.setLevel(level)
+        for handler in handlers:
             log.addHandler(handler)
-            # Set the overall level on the log object to the minimum level.
-            log.setLevel(level)
     # Please be quiet gnupg.
     gnupg_log = logging.getLogger('gnupg')
     gnupg_log.propagate = False
@@ -22,25 +22,18 @@ __all__ = [
 
 
 import sys
-import json
-import logging
 import argparse
 
-from dbus.mainloop.glib import DBusGMainLoop
-from pkg_resources import resource_string as resource_bytes
-from systemimage.apply import factory_reset, production_reset
-from systemimage.candidates import delta_filter, full_filter, version_filter
 from systemimage.config import config
-from systemimage.helpers import (
-    last_update_date, makedirs, phased_percentage, version_detail)
-from systemimage.logging import initialize
-from systemimage.settings import Settings
-from systemimage.state import State
-from textwrap import dedent
+from systemimage.helpers import package_version
 
 
-__version__ = resource_bytes(
-    'systemimage', 'version.txt').decode('utf-8').strip()
+# The settings UI and scripts run system-image-cli --info, --get, and
+# --show-settings all the time, so only the modules that are needed by all
+# the options are imported here.  Everything else, e.g. the state machine
+# with its gpg, tarfile, and D-Bus imports, is imported by the code paths
+# which use it.  test_main.TestImportTime keeps it this way.
+__version__ = package_version()
 
 DEFAULT_CONFIG_D = '/etc/system-image/config.d'
 COLON = ':'
@@ -71,8 +64,43 @@ class _LogfileProgress:
         self._log.debug('received: {} of {} bytes', received, total)
 
 
+def _finish_run(args):
+    # Called whether the state machine succeeded or not.  The statistics are
+    # always saved, and the trace is written for --trace, since the trace of
+    # a failed run is the interesting one.
+    from systemimage.statistics import statistics
+    from systemimage.trace import tracer
+    statistics.save()
+    if args.trace is None:
+        return
+    # Don't let a bad --trace path hide how the run went.
+    try:
+        with open(args.trace, 'w', encoding='utf-8') as fp:
+            fp.write(tracer.as_chrome_trace())
+    except OSError as error:
+        print('Cannot write the trace: {}'.format(error), file=sys.stderr)
+
+
+def _print_statistics():
+    # For use with --stats.
+    from systemimage.statistics import statistics
+    snapshot = statistics.as_dict()
+    for name, value in snapshot['counters'].items():
+        print('{}={}'.format(name, value))
+    for name, value in sorted(snapshot['failures'].items()):
+        print('failures.{}={}'.format(name, value))
+    throughput = snapshot['throughput']
+    bounds = [str(bound) for bound in throughput['buckets']] + ['inf']
+    for bound, count in zip(bounds, throughput['counts']):
+        print('throughput.le_{}={}'.format(bound, count))
+    print('throughput.sum={}'.format(throughput['sum']))
+    if throughput['estimate'] is not None:
+        print('throughput.estimate={:.0f}'.format(throughput['estimate']))
+
+
 def _json_progress(received, total):
     # For use with --progress=json output.  LP: #1423622
+    import json
     message = json.dumps(dict(
         type='progress',
         now=received,
@@ -149,6 +177,37 @@ def main():
     parser.add_argument('--list-channels',
                         default=False, action='store_true',
                         help="""List all available channels, then exit""")
+    parser.add_argument('--plan',
+                        default=None, action='store', metavar='FILE',
+                        help="""Print the upgrade paths, as JSON, for every
+                                device, channel, and build listed in FILE,
+                                then exit.  FILE is either a CSV file with
+                                device, channel, and build columns, or a JSON
+                                list of objects with those keys.""")
+    parser.add_argument('--mirror',
+                        default=None, action='store', metavar='DIR',
+                        help="""Download the keyrings, channels.json, the
+                                indexes, and all the update files of the
+                                channel and device into DIR, laid out like the
+                                server, then exit.  Files already in DIR are
+                                only downloaded again if they changed.""")
+    parser.add_argument('--export',
+                        default=None, action='store', metavar='FILE',
+                        help="""Download and verify everything needed to
+                                upgrade along the winning path, and write it
+                                to the offline update bundle FILE, then exit.
+                                """)
+    parser.add_argument('--sideload',
+                        default=None, action='store', metavar='FILE',
+                        help="""Upgrade from the offline update bundle FILE
+                                instead of the network.  Unless -c is given,
+                                the bundle's channel is used.""")
+    parser.add_argument('--jobs',
+                        default=None, action='store', type=int, metavar='N',
+                        help="""With --plan, calculate the upgrade paths in
+                                N processes.  The default is one per CPU.
+                                With --mirror, download N files at once.  The
+                                default is 16.""")
     parser.add_argument('--factory-reset',
                         default=False, action='store_true',
                         help="""Perform a destructive factory reset and
@@ -169,6 +228,10 @@ def main():
                         default=False, action='store_true',
                         help="""Show all settings as key=value pairs,
                                 then exit""")
+    parser.add_argument('--stats',
+                        default=False, action='store_true',
+                        help="""Show the update statistics kept across runs
+                                as key=value pairs, then exit""")
     parser.add_argument('--set',
                         default=[], action='append', metavar='KEY=VAL',
                         help="""Set a key and value in the settings, adding
@@ -193,6 +256,12 @@ def main():
                                 to temporarily override the update restriction.
                                 This switch has no effect when using the cURL
                                 based downloader.""")
+    parser.add_argument('--trace',
+                        default=None, action='store',
+                        metavar='FILE',
+                        help="""Write the timings of the state machine steps,
+                                and of the operations within them, to FILE in
+                                Chrome trace-event JSON format.""")
     # Hidden system-image-cli only feature for testing purposes.  LP: #1333414
     parser.add_argument('--skip-gpg-verification',
                         default=False, action='store_true',
@@ -216,22 +285,30 @@ Your upgrades are INSECURE.""", file=sys.stderr)
 
     # Perform factory and production resets.
     if args.factory_reset:
+        from systemimage.apply import factory_reset
         factory_reset()
         # We should never get here, except possibly during the testing
         # process, so just return as normal.
         return 0
     if args.production_reset:
+        from systemimage.apply import production_reset
         production_reset()
         # We should never get here, except possibly during the testing
         # process, so just return as normal.
         return 0
 
+    if args.stats:
+        _print_statistics()
+        return 0
+
     # Handle all settings arguments.  They are mutually exclusive.
     if sum(bool(arg) for arg in
            (args.set, args.get, args.delete, args.show_settings)) > 1:
         parser.error('Cannot mix and match settings arguments')
         assert 'parser.error() does not return' # pragma: no cover
 
+    if args.show_settings or args.get or args.set or args.delete:
+        from systemimage.settings import Settings
     if args.show_settings:
         rows = sorted(Settings())
         for row in rows:
@@ -254,6 +331,8 @@ Your upgrades are INSECURE.""", file=sys.stderr)
             settings.delete(key)
         return 0
 
+    from systemimage.candidates import (
+        delta_filter, full_filter, version_filter)
     # Sanity check -f/--filter.
     if args.filter is None:
         candidate_filter = None
@@ -265,6 +344,9 @@ Your upgrades are INSECURE.""", file=sys.stderr)
         parser.error('Bad filter type: {}'.format(args.filter))
         assert 'parser.error() does not return' # pragma: no cover
 
+    import logging
+    from systemimage.helpers import makedirs
+    from systemimage.logging import initialize
     # Create the temporary directory if it doesn't exist.
     makedirs(config.system.tempdir)
     # Initialize the loggers.
@@ -293,6 +375,8 @@ Your upgrades are INSECURE.""", file=sys.stderr)
         config.phase_override = args.percentage
 
     if args.info:
+        from systemimage.helpers import last_update_date, version_detail
+        from textwrap import dedent
         alias = getattr(config.service, 'channel_target', None)
         kws = dict(
             build_number=config.build_number,
@@ -323,6 +407,10 @@ Your upgrades are INSECURE.""", file=sys.stderr)
             print('version {}: {}'.format(key, details[key]))
         return 0
 
+    from dbus.mainloop.glib import DBusGMainLoop
+    from systemimage.helpers import phased_percentage
+    from systemimage.state import State
+    from systemimage.statistics import statistics
     DBusGMainLoop(set_as_default=True)
 
     if args.list_channels:
@@ -335,6 +423,8 @@ Your upgrades are INSECURE.""", file=sys.stderr)
                   file=sys.stderr)
             log.exception('system-image-cli exception')
             return 1
+        finally:
+            _finish_run(args)
         print('Available channels:')
         for key in sorted(state.channels):
             alias = state.channels[key].get('alias')
@@ -344,8 +434,76 @@ Your upgrades are INSECURE.""", file=sys.stderr)
                 print('    {} (alias for: {})'.format(key, alias))
         return 0
 
+    if args.plan is not None:
+        import json
+        from systemimage.planning import plan, read_targets
+        try:
+            targets = read_targets(args.plan)
+        except (OSError, ValueError) as error:
+            parser.error('Cannot read {}: {}'.format(args.plan, error))
+            assert 'parser.error() does not return' # pragma: no cover
+        try:
+            report = plan(targets, jobs=args.jobs)
+        except Exception:
+            print('Exception occurred during planning; '
+                  'see log file for details',
+                  file=sys.stderr)
+            log.exception('system-image-cli exception')
+            return 1
+        finally:
+            _finish_run(args)
+        print(json.dumps(report, indent=4))
+        return 0
+
+    if args.mirror is not None:
+        from systemimage.mirror import mirror
+        try:
+            count = mirror(args.mirror, connections=args.jobs)
+        except Exception:
+            print('Exception occurred during mirroring; '
+                  'see log file for details',
+                  file=sys.stderr)
+            log.exception('system-image-cli exception')
+            return 1
+        finally:
+            _finish_run(args)
+        print('Mirrored {} images of {}/{} into {}'.format(
+            count, config.channel, config.device, args.mirror))
+        return 0
+
+    if args.export is not None:
+        from systemimage.bundle import export
+        try:
+            winner = export(args.export)
+        except Exception:
+            print('Exception occurred during export; '
+                  'see log file for details',
+                  file=sys.stderr)
+            log.exception('system-image-cli exception')
+            return 1
+        finally:
+            _finish_run(args)
+        if len(winner) == 0:
+            print('Already up-to-date')
+        else:
+            print('Exported upgrade path {} to {}'.format(
+                ':'.join(str(image.version) for image in winner),
+                args.export))
+        return 0
+
+    if args.sideload is not None:
+        from systemimage.bundle import BundleReader
+        try:
+            config.sideload_bundle = BundleReader(args.sideload)
+        except (OSError, ValueError) as error:
+            parser.error('Cannot read {}: {}'.format(args.sideload, error))
+            assert 'parser.error() does not return' # pragma: no cover
+        if args.channel is None and args.switch is None:
+            config.channel = config.sideload_bundle.manifest['channel']
+
     state = State()
     state.candidate_filter = candidate_filter
+    statistics.increment('checks')
     if args.maximage is not None:
         state.winner_filter = version_filter(args.maximage)
 
@@ -363,12 +521,15 @@ Your upgrades are INSECURE.""", file=sys.stderr)
     if args.dry_run:
         try:
             state.run_until('download_files')
-        except Exception:
+        except Exception as error:
             print('Exception occurred during dry-run; '
                   'see log file for details',
                   file=sys.stderr)
             log.exception('system-image-cli exception')
+            statistics.failure(type(error).__name__)
             return 1
+        finally:
+            _finish_run(args)
         # Say -c <no-such-channel> was given.  This will fail.
         if state.winner is None or len(state.winner) == 0:
             print('Already up-to-date')
@@ -406,18 +567,21 @@ Your upgrades are INSECURE.""", file=sys.stderr)
             print('Exception occurred during update; see log file for details',
                   file=sys.stderr)
             log.exception('system-image-cli exception')
+            statistics.failure(type(error).__name__)
             # This is a little bit of a hack because it's not generalized to
             # all values of --progress.  But OTOH, we always want to log the
             # error, so --progress=logfile is redundant, and --progress=dots
             # doesn't make much sense either.  Just just include some JSON
             # output if --progress=json was specified.
             if 'json' in args.progress:
+                import json
                 print(json.dumps(dict(type='error', msg=str(error))))
             return 1
         else:
             return 0
         finally:
             log.info('state machine finished')
+            _finish_run(args)
 
 
 if __name__ == '__main__':                          # pragma: no cover
@@ -0,0 +1,289 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Mirror a channel's files into a local directory.
+
+The mirror tree has the same layout as the server, so it can be served as
+is, with both the `https_base` and `http_base` of the clients pointing at
+it.  It holds the keyrings, channels.json, the device's indexes, and every
+file the index refers to, along with all their signatures.
+
+Everything is verified just like on a device.  Files which are already in
+the mirror with the right checksum and a good signature aren't downloaded
+again.  Everything else is downloaded and verified in a staging directory
+first, and only moved into the mirror once it all checks out: the new files
+first, then the new metadata which refers to them.  So a mirror being
+updated is always consistent.
+"""
+
+__all__ = [
+    'MANIFEST_FILE',
+    'mirror',
+    ]
+
+
+import os
+import json
+import shutil
+import logging
+
+from contextlib import suppress
+from systemimage.channel import Channels
+from systemimage.config import config
+from systemimage.download import Record
+from systemimage.gpg import Context, verify_file
+from systemimage.helpers import atomic, calculate_signature, makedirs
+from systemimage.index import Index
+from systemimage.keyring import check_keyring
+from systemimage.state import ChecksumError, State
+from urllib.parse import urljoin
+
+
+log = logging.getLogger('systemimage')
+
+# The checksum and stat of every verified file in the mirror are recorded in
+# this file, so that files which haven't changed since the last run don't
+# have to be checksummed again.
+MANIFEST_FILE = '.manifest.json'
+# New files and metadata are downloaded and verified here before they
+# replace the old.
+STAGING_DIR = '.staging'
+# How many files to download at once, by default.
+MAX_CONNECTIONS = 16
+
+
+def _local(directory, path):
+    # The local path of a server path, which must be inside the mirror.
+    local = os.path.normpath(os.path.join(directory, path.lstrip('/')))
+    if os.path.commonpath([directory, local]) != directory:
+        raise ValueError('Path outside of the mirror: {}'.format(path))
+    return local
+
+
+def _stat(path):
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+
+class _Mirror:
+    def __init__(self, directory, connections):
+        self.directory = os.path.abspath(directory)
+        self.staging = os.path.join(self.directory, STAGING_DIR)
+        self.state = State()
+        self.state.downloader.max_connections = connections
+        # These aren't the device's own downloads.
+        self.state.downloader.record_statistics = False
+        self.manifest_path = os.path.join(self.directory, MANIFEST_FILE)
+        self.manifest = {}
+        with suppress(FileNotFoundError, ValueError):
+            with open(self.manifest_path, encoding='utf-8') as fp:
+                self.manifest = json.load(fp)
+        # Map the staged metadata and update files to where they go in the
+        # mirror.  The update files go in first.
+        self.staged = []
+        self.staged_files = []
+        # The manifest entries of the staged update files.
+        self.staged_manifest = {}
+
+    def _stage(self, paths, keyrings):
+        # Download and verify metadata files, by their server paths.
+        downloads = []
+        for path in paths:
+            staged = _local(self.staging, path)
+            makedirs(os.path.dirname(staged))
+            for suffix in ('', '.asc'):
+                downloads.append((
+                    urljoin(config.https_base, path + suffix),
+                    staged + suffix))
+        self.state.downloader.get_files(downloads)
+        with Context(*keyrings, blacklist=self.state.blacklist) as ctx:
+            for path in paths:
+                staged = _local(self.staging, path)
+                ctx.validate(staged + '.asc', staged)
+        for path in paths:
+            staged = _local(self.staging, path)
+            for suffix in ('', '.asc'):
+                self.staged.append((
+                    staged + suffix, _local(self.directory, path + suffix)))
+
+    def _stage_optional(self, paths, keyrings):
+        # Like _stage(), but skip any files missing from the server.  The
+        # state machine falls back to the full index when the incremental or
+        # compressed ones are missing, so the mirror can do without them.
+        for path in paths:
+            try:
+                self._stage([path], keyrings)
+            except FileNotFoundError:
+                log.info('Not mirroring missing index: {}', path)
+
+    def _stage_keyring(self, keyring, path):
+        # The keyrings are already verified and installed locally.
+        for src, dst in ((keyring, path), (keyring + '.asc', path + '.asc')):
+            staged = _local(self.staging, dst)
+            makedirs(os.path.dirname(staged))
+            shutil.copy(src, staged)
+            self.staged.append((staged, _local(self.directory, dst)))
+
+    def _stage_device_keyring(self, keyring):
+        # Download and verify the device's signing keyring into the staging
+        # directory.  Unlike on a device, it must not be installed, since
+        # that would replace this host's own device signing keyring.
+        staged = _local(self.staging, keyring.path)
+        staged_asc = _local(self.staging, keyring.signature)
+        for path in (staged, staged_asc):
+            makedirs(os.path.dirname(path))
+        self.state.downloader.get_files([
+            (urljoin(config.https_base, keyring.path), staged),
+            (urljoin(config.https_base, keyring.signature), staged_asc),
+            ])
+        with Context(config.gpg.image_signing,
+                     blacklist=self.state.blacklist) as ctx:
+            ctx.validate(staged_asc, staged)
+        check_keyring(staged, 'device-signing', config.device)
+        self.staged.append((staged, _local(self.directory, keyring.path)))
+        self.staged.append(
+            (staged_asc, _local(self.directory, keyring.signature)))
+        return staged
+
+    def _is_current(self, filerec, keyrings):
+        # Is this file, and its signature, already in the mirror?
+        dst = _local(self.directory, filerec.path)
+        asc = _local(self.directory, filerec.signature)
+        entry = self.manifest.get(filerec.path)
+        with suppress(FileNotFoundError):
+            if (entry is not None
+                    and entry[0] == filerec.checksum
+                    and entry[1:] == _stat(dst)
+                    and os.path.exists(asc)):
+                return True
+        if verify_file(dst, asc, keyrings, filerec.checksum,
+                       self.state.blacklist):
+            self.manifest[filerec.path] = [filerec.checksum] + _stat(dst)
+            return True
+        return False
+
+    def _get_files(self, index, keyrings):
+        # Download and verify the new update files into the staging
+        # directory.
+        downloads = []
+        checksums = []
+        seen = set()
+        for image in index.images:
+            for filerec in image.files:
+                # The same file may be in more than one image.
+                if filerec.path in seen:
+                    continue
+                seen.add(filerec.path)
+                if self._is_current(filerec, keyrings):
+                    continue
+                self.manifest.pop(filerec.path, None)
+                files = []
+                for path in (filerec.path, filerec.signature):
+                    staged = _local(self.staging, path)
+                    makedirs(os.path.dirname(staged))
+                    files.append(staged)
+                    self.staged_files.append(
+                        (staged, _local(self.directory, path)))
+                dst, asc = files
+                downloads.append(Record(
+                    urljoin(config.http_base, filerec.path),
+                    dst, filerec.checksum))
+                downloads.append(Record(
+                    urljoin(config.http_base, filerec.signature), asc))
+                checksums.append((filerec, dst, asc))
+        log.info('Mirroring {} new files', len(checksums))
+        self.state.downloader.get_files(downloads, pausable=True)
+        with Context(*keyrings, blacklist=self.state.blacklist) as ctx:
+            for filerec, dst, asc in checksums:
+                ctx.validate(asc, dst)
+        for filerec, dst, asc in checksums:
+            with open(dst, 'rb') as fp:
+                got = calculate_signature(fp)
+            if got != filerec.checksum:
+                raise ChecksumError(dst, got, filerec.checksum)
+        # Moving the file into the mirror won't change its stat.
+        for filerec, dst, asc in checksums:
+            self.staged_manifest[filerec.path] = (
+                [filerec.checksum] + _stat(dst))
+
+    def run(self):
+        # Get the keyrings, and the blacklist if there is one.
+        self.state.run_thru('get_channel')
+        shutil.rmtree(self.staging, ignore_errors=True)
+        makedirs(self.staging)
+        self._stage_keyring(
+            config.gpg.image_master, 'gpg/image-master.tar.xz')
+        self._stage_keyring(
+            config.gpg.image_signing, 'gpg/image-signing.tar.xz')
+        if self.state.blacklist is not None:
+            self._stage_keyring(self.state.blacklist, 'gpg/blacklist.tar.xz')
+        # Mirror the channels.json file we get now, rather than the one the
+        # state machine got, in case it just changed.
+        self._stage(['channels.json'], [config.gpg.image_signing])
+        with open(_local(self.staging, 'channels.json'),
+                  encoding='utf-8') as fp:
+            channels = Channels.from_json(fp.read())
+        device = channels[config.channel].devices[config.device]
+        keyrings = [config.gpg.image_signing]
+        keyring = getattr(device, 'keyring', None)
+        if keyring is not None:
+            keyrings.append(self._stage_device_keyring(keyring))
+        # The full index says which files to mirror.  Any incremental or
+        # compressed indexes are just copied, if they're there.
+        self._stage([device.index], keyrings)
+        indexes = [device.index]
+        indexes.extend(
+            entry.index for entry in getattr(device, 'incremental', []))
+        compression = getattr(device, 'compression', None)
+        if compression is not None:
+            indexes.extend(
+                '{}.{}'.format(path, compression) for path in list(indexes))
+        self._stage_optional(indexes[1:], keyrings)
+        with open(_local(self.staging, device.index), encoding='utf-8') as fp:
+            index = Index.from_json(fp.read())
+        try:
+            self._get_files(index, keyrings)
+        finally:
+            # Remember the files which were found to be current, even if
+            # something went wrong.
+            with atomic(self.manifest_path) as fp:
+                json.dump(self.manifest, fp, indent=4, sort_keys=True)
+        # Everything checks out, so the new files can go in, followed by
+        # the new metadata which refers to them, with channels.json last.
+        self.staged.sort(
+            key=lambda item: os.path.basename(item[1]).startswith('channels.'))
+        for staged, path in self.staged_files + self.staged:
+            makedirs(os.path.dirname(path))
+            os.replace(staged, path)
+        self.manifest.update(self.staged_manifest)
+        with atomic(self.manifest_path) as fp:
+            json.dump(self.manifest, fp, indent=4, sort_keys=True)
+        shutil.rmtree(self.staging, ignore_errors=True)
+        return len(index.images)
+
+
+def mirror(directory, *, connections=None):
+    """Mirror the configured channel and device into a directory.
+
+    :param directory: The root of the mirror tree.  It is created if it
+        doesn't exist.
+    :param connections: The most files to download at once.
+    :return: The number of images in the mirrored index.
+    :raises KeyError: when the channel or device isn't in channels.json.
+    """
+    if connections is None:
+        connections = MAX_CONNECTIONS
+    makedirs(directory)
+    return _Mirror(directory, connections).run()
@@ -0,0 +1,246 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Plan the upgrades of many devices at once.
+
+Before a rollout, it's useful to know which upgrade path every device, on
+every channel, at every build, is going to take.  Running a dry run for each
+of them would download and verify the keyrings, channels.json, and the
+index over and over again.  Instead, the keyrings and channels.json are
+verified once, each distinct index is downloaded once, all of them in
+parallel, and the upgrade paths are calculated in a pool of processes.
+"""
+
+__all__ = [
+    'Target',
+    'plan',
+    'read_targets',
+    ]
+
+
+import os
+import csv
+import sys
+import json
+import logging
+import multiprocessing
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from systemimage.candidates import iter_candidates
+from systemimage.config import config
+from systemimage.gpg import Context
+from systemimage.helpers import temporary_directory
+from systemimage.index import Index
+from urllib.parse import urljoin
+
+
+log = logging.getLogger('systemimage')
+
+# Each device, channel, and build to plan the upgrade of.
+Target = namedtuple('Target', 'device channel build')
+
+# The parsed indexes, by (channel, device).  These are set in the parent
+# process before the worker processes are forked, so the workers inherit
+# them instead of having them pickled over for every task.
+_indexes = {}
+
+
+def read_targets(path):
+    """Read the devices, channels, and builds to plan for.
+
+    The file is either CSV, with a header row naming the `device`,
+    `channel`, and `build` columns, or if its name doesn't end in .csv, a
+    JSON list of objects with those keys.
+
+    :param path: The path to the file.
+    :return: The list of `Target`s.
+    :raises ValueError: when the file is missing a key, or a build is not an
+        integer.
+    """
+    with open(path, encoding='utf-8', newline='') as fp:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(fp))
+        else:
+            rows = json.load(fp)
+    targets = []
+    for row in rows:
+        try:
+            targets.append(Target(
+                row['device'], row['channel'], int(row['build'])))
+        except KeyError as error:
+            raise ValueError('Missing {}: {}'.format(error, row)) from None
+    return targets
+
+
+def _get_channels():
+    # Run the state machine just far enough to get the keyrings and a
+    # verified channels.json file.
+    from systemimage.state import State
+    state = State()
+    while state.channels is None:
+        next(state)
+    return state
+
+
+def _get_device_keyrings(state, pairs, tmpdir):
+    # Download and verify each device's signing keyring into the temporary
+    # directory.  Unlike on a device, they must not be installed, since that
+    # would replace this host's own device signing keyring.
+    from systemimage.keyring import check_keyring
+    downloads = []
+    keyrings = {}
+    for i, (channel, device) in enumerate(sorted(pairs)):
+        keyring = getattr(
+            state.channels[channel].devices[device], 'keyring', None)
+        if keyring is None:
+            continue
+        path = os.path.join(tmpdir, 'device-signing-{}.tar.xz'.format(i))
+        downloads.append((urljoin(config.https_base, keyring.path), path))
+        downloads.append(
+            (urljoin(config.https_base, keyring.signature), path + '.asc'))
+        keyrings[channel, device] = path
+    state.downloader.get_files(downloads)
+    with Context(config.gpg.image_signing, blacklist=state.blacklist) as ctx:
+        for path in keyrings.values():
+            ctx.validate(path + '.asc', path)
+    for (channel, device), path in keyrings.items():
+        check_keyring(path, 'device-signing', device)
+    return keyrings
+
+
+def _get_indexes(state, pairs, tmpdir):
+    # Download all the indexes at once, then verify and parse them.
+    keyrings = _get_device_keyrings(state, pairs, tmpdir)
+    downloads = []
+    paths = {}
+    for i, (channel, device) in enumerate(sorted(pairs)):
+        url = urljoin(config.https_base,
+                      state.channels[channel].devices[device].index)
+        path = os.path.join(tmpdir, 'index-{}.json'.format(i))
+        downloads.append((url, path))
+        downloads.append((url + '.asc', path + '.asc'))
+        paths[channel, device] = path
+    state.downloader.get_files(downloads)
+    indexes = {}
+    for pair, path in paths.items():
+        signing_keyrings = [config.gpg.image_signing]
+        if pair in keyrings:
+            signing_keyrings.append(keyrings[pair])
+        with Context(*signing_keyrings, blacklist=state.blacklist) as ctx:
+            ctx.validate(path + '.asc', path)
+        with open(path, encoding='utf-8') as fp:
+            indexes[pair] = Index.from_json(fp.read())
+    return indexes
+
+
+def _image_plan(image):
+    return OrderedDict((
+        ('version', image.version),
+        ('type', image.type),
+        ('base', getattr(image, 'base', None)),
+        ('size', sum(filerec.size for filerec in image.files)),
+        ('phased_percentage', image.phased_percentage),
+        ))
+
+
+def _plan_builds(channel, device, builds):
+    # Run in the worker processes.
+    index = _indexes[channel, device]
+    scorer = config.hooks.scorer()
+    plans = []
+    for build in builds:
+        winner = scorer.choose(
+            iter_candidates(index, build, score=scorer.running_score),
+            channel)
+        path = [_image_plan(image) for image in winner]
+        plans.append(OrderedDict((
+            ('target', path[-1]['version'] if len(path) > 0 else None),
+            ('size', sum(image['size'] for image in path)),
+            ('phased_percentage',
+             path[-1]['phased_percentage'] if len(path) > 0 else None),
+            ('path', path),
+            )))
+    return plans
+
+
+def plan(targets, *, jobs=None):
+    """Plan the upgrades of the targets.
+
+    Unless a phased percentage is given with `config.phase_override`, the
+    paths are planned as for a device which is first in line for every
+    phased update.  Each target image's phased percentage is reported, so
+    it's clear how much of the fleet it will go to.
+
+    :param targets: The `Target`s to plan the upgrades of.
+    :param jobs: The number of worker processes, by default one per CPU.
+    :return: The report, as a list of dictionaries, one for each target in
+        the same order, with the target's device, channel, and build, and
+        either an `error`, or the `target` build, the total download `size`,
+        the target image's `phased_percentage`, and the upgrade `path` with
+        the version, type, base, size, and phased percentage of each image.
+    """
+    global _indexes
+    state = _get_channels()
+    # Group the builds by index.
+    builds = OrderedDict()
+    errors = {}
+    for target in targets:
+        channel = state.channels.get(target.channel)
+        if channel is None:
+            errors[target] = 'No such channel: {}'.format(target.channel)
+        elif target.device not in channel.devices:
+            errors[target] = 'No such device: {}'.format(target.device)
+        else:
+            builds.setdefault(
+                (target.channel, target.device), set()).add(target.build)
+    with ExitStack() as resources:
+        tmpdir = resources.enter_context(temporary_directory())
+        _indexes = _get_indexes(state, builds, tmpdir)
+        resources.callback(_indexes.clear)
+        if config.phase_override is None:
+            config.phase_override = 0
+            resources.callback(delattr, config, 'phase_override')
+        # The workers must be forked, so that they inherit the indexes.
+        # That's the default on Linux, but newer Pythons can be asked to
+        # make sure of it, and some default to another start method.
+        options = {}
+        if sys.version_info >= (3, 7):
+            options['mp_context'] = multiprocessing.get_context('fork')
+        executor = resources.enter_context(ProcessPoolExecutor(
+            max_workers=jobs, **options))
+        futures = OrderedDict(
+            (pair, executor.submit(_plan_builds, *pair, sorted(pair_builds)))
+            for pair, pair_builds in builds.items())
+        plans = {}
+        for (channel, device), future in futures.items():
+            for build, build_plan in zip(
+                    sorted(builds[channel, device]), future.result()):
+                plans[channel, device, build] = build_plan
+    report = []
+    for target in targets:
+        entry = OrderedDict((
+            ('device', target.device),
+            ('channel', target.channel),
+            ('build', target.build),
+            ))
+        if target in errors:
+            entry['error'] = errors[target]
+        else:
+            entry.update(plans[target.channel, target.device, target.build])
+        report.append(entry)
+    log.info('Planned {} upgrades from {} indexes', len(report), len(builds))
+    return report
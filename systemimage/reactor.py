@@ -19,6 +19,7 @@ import os
 import logging
 
 from gi.repository import GLib
+from threading import Event, current_thread, main_thread
 
 log = logging.getLogger('systemimage')
 
@@ -42,6 +43,8 @@ class Reactor:
     def __init__(self, bus):
         self._bus = bus
         self._loop = None
+        # Used instead of the loop when running outside the main thread.
+        self._done = Event()
         # Keep track of the GLib handles to the loop-quitting callback, and
         # all the signal matching callbacks.  Once the reactor run loop quits,
         # we want to remove all callbacks so they can't accidentally be called
@@ -90,13 +93,28 @@ class Reactor:
         GLib.timeout_add(milliseconds, method)
 
     def run(self, timeout=None):
+        # The reactor may be run again after it quits, e.g. when the worker
+        # thread reuses it, so forget the last run's quitting.
+        self._done.clear()
+        self._loop = None
+        self.timed_out = False
         self._active_timeout = (self.timeout if timeout is None else timeout)
-        self._loop = GLib.MainLoop()
         self._reset_timeout()
-        self._loop.run()
+        if current_thread() is main_thread():
+            self._loop = GLib.MainLoop()
+            self._loop.run()
+        else:
+            # We're running in the D-Bus service's worker thread.  The main
+            # loop in the main thread dispatches the signals and timeouts
+            # we're reacting to, so all we have to do is wait for one of them
+            # to quit the reactor.
+            self._done.wait()
 
     def quit(self):
-        self._loop.quit()
+        if self._loop is None:
+            self._done.set()
+        else:
+            self._loop.quit()
         for match in self._signal_matches:
             match.remove()
         del self._signal_matches[:]
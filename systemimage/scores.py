@@ -19,24 +19,43 @@ Choose which upgrade path to use based on the available candidates.
 """
 
 __all__ = [
+    'CacheAwareScorer',
+    'Cost',
     'Scorer',
+    'TimeScorer',
     'WeightedScorer',
     ]
 
 
 import logging
 
+from collections import namedtuple
 from itertools import count
-from systemimage.helpers import MiB, phased_percentage
+from systemimage.config import config
+from systemimage.helpers import GiB, MiB, phased_percentage
+from systemimage.statistics import statistics
+from systemimage.trace import traced
 
 
 log = logging.getLogger('systemimage')
 COLON = ':'
 
 
+_Rates = namedtuple('_Rates', 'throughput verify apply reboot')
+
+
 class Scorer:
-    """Abstract base class providing an API for candidate selection."""
+    """Abstract base class providing an API for candidate selection.
+
+    Before choosing, the state machine sets `cache` to a view of the update
+    files already downloaded and verified in the cache partition, e.g. by an
+    interrupted update.  `filerec in scorer.cache` is true for those files.
+    Scorers are free to ignore it, and it is None when there is no view.
+    """
+
+    cache = None
 
+    @traced('Scorer.choose', 'candidates')
     def choose(self, candidates, channel):
         """Choose the candidate upgrade paths.
 
@@ -44,14 +63,22 @@ class Scorer:
 
         :param candidates: A list of lists of image records needed to upgrade
             the device from the current version to the latest version, sorted
-            in order from oldest verson to newest.
-        :type candidates: list of lists
+            in order from oldest verson to newest.  This can also be an
+            iterator, e.g. from `iter_candidates()`, but it is read into a
+            list before any path is scored.
+        :type candidates: iterable of lists
         :param channel: The channel being upgraded to.  This is used in the
             phased update calculate.
         :type channel: str
         :return: The chosen path.
         :rtype: list
         """
+        # Scores are relative to the other paths, e.g. to the smallest
+        # download and the highest build, and the paths are then tried in
+        # order of their score, so they all have to be seen first.  The
+        # generator's path limit keeps this list bounded.
+        candidates = list(candidates)
+        log.debug('{} candidate paths', len(candidates))
         if len(candidates) == 0:
             log.debug('No candidates, so no winner')
             return []
@@ -80,15 +107,18 @@ class Scorer:
             max_target_number = max(max_target_number, path[-1].version)
         assert max_target_number != -1, 'No max target version?'
         device_percentage = phased_percentage(channel, max_target_number)
-        log.debug('Device phased percentage: {}%'.format(device_percentage))
-        log.debug('{} path scores:'.format(self.__class__.__name__))
-        # Log the candidate paths, their scores, and their phases.
-        for score, i, path in reversed(scores):
-            log.debug('\t[{:4d}] -> {} ({}%)'.format(
-                score,
-                COLON.join(str(image.version) for image in path),
-                (path[-1].phased_percentage if len(path) > 0 else '--')
-                ))
+        log.debug('Device phased percentage: {}%', device_percentage)
+        # Log the candidate paths, their scores, and their phases.  There can
+        # be a lot of these, so don't even build the messages unless they'll
+        # be logged.
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('{} path scores:', self.__class__.__name__)
+            for score, i, path in reversed(scores):
+                log.debug('\t[{:4d}] -> {} ({}%)',
+                          score,
+                          COLON.join(str(image.version) for image in path),
+                          (path[-1].phased_percentage
+                           if len(path) > 0 else '--'))
         for score, i, path in scores:
             image_percentage = path[-1].phased_percentage
             # An image percentage of 0 means that it's been pulled.
@@ -112,6 +142,25 @@ class Scorer:
         """
         raise NotImplementedError
 
+    def running_score(self, image):
+        """Score one image, for pruning candidates as they're generated.
+
+        `iter_candidates()` adds up these scores along each path, and when
+        it has to drop paths, the ones with the highest running score go
+        first.  Subclasses should return what the image adds to the score of
+        any path it's in, as far as that can be known without seeing the
+        rest of the path.  By default, every image scores 0.
+
+        :param image: The image record.
+        :return: The image's contribution to the score.
+        """
+        return 0
+
+    def _uncached_size(self, image):
+        # The number of bytes of the image which aren't already in the cache.
+        return sum(filerec.size for filerec in image.files
+                   if self.cache is None or filerec not in self.cache)
+
 
 class WeightedScorer(Scorer):
     """Use the following inputs and weights. Lowest score wins.
@@ -138,6 +187,14 @@ class WeightedScorer(Scorer):
 
     Path B wins.
     """
+    def _download_size(self, image):
+        # The number of bytes charged for downloading the image.
+        return sum(filerec.size for filerec in image.files)
+
+    def running_score(self, image):
+        return (100 * getattr(image, 'bootme', False)
+                + self._download_size(image) // MiB)
+
     def score(self, candidates):
         # Iterate over every path, calculating the total download size of the
         # path, the number of extra reboots required, and the destination
@@ -150,8 +207,7 @@ class WeightedScorer(Scorer):
             build = path[-1].version
             size = 0
             for image in path:
-                image_size = sum(filerec.size for filerec in image.files)
-                size += image_size
+                size += self._download_size(image)
             reboots = sum(1 for image in path
                           if getattr(image, 'bootme', False))
             candidate_data.append((build, size, reboots, path))
@@ -162,6 +218,7 @@ class WeightedScorer(Scorer):
         # maximum build number gets a ridiculously high score so it won't
         # possibly be chosen.
         scores = []
+        explain = log.isEnabledFor(logging.DEBUG)
         for build, size, reboots, path in candidate_data:
             score = (100 * reboots) + ((size - min_size) // MiB)
             # If the path does not leave you at the maximum build number, add
@@ -170,4 +227,128 @@ class WeightedScorer(Scorer):
             distance = max_build - build
             score += (9000 * distance) + distance
             scores.append(score)
+            if explain:
+                log.debug('{} scores {}: {} extra reboots * 100 '
+                          '+ {} MiB to download - {} MiB smallest '
+                          '+ {} builds short * 9001',
+                          COLON.join(str(image.version) for image in path),
+                          score, reboots, size // MiB, min_size // MiB,
+                          distance)
         return scores
+
+
+class CacheAwareScorer(WeightedScorer):
+    """Like `WeightedScorer`, but only count the bytes still to download.
+
+    Update files which are already downloaded and verified in the cache
+    partition are free, so a path which is mostly downloaded already isn't
+    beaten by a path which is smaller, but which has to be downloaded from
+    scratch.  Without a view of the cache, this is the same as the
+    `WeightedScorer`.
+    """
+    def _download_size(self, image):
+        return self._uncached_size(image)
+
+
+class Cost(namedtuple('Cost', 'download verify apply reboot short')):
+    """The estimated seconds spent in each part of an upgrade along a path."""
+
+    __slots__ = ()
+
+    @property
+    def total(self):
+        return sum(self)
+
+
+class TimeScorer(Scorer):
+    """Estimate how long each path takes to reach its target.  Fastest wins.
+
+    download - the bytes still to download, i.e. those not already in the
+        cache, at this device's estimated throughput.  Until this device has
+        downloaded any update files, `[updater]throughput` is assumed.
+
+    verify - `[updater]verify_cost` for every GiB downloaded.
+
+    apply - `[updater]apply_cost` for every image in the path.
+
+    reboot - `[updater]reboot_cost` for every reboot, including the one at
+        the end of the update.
+
+    A path which doesn't leave you at the highest available build gets a
+    year added for every build it falls short, so that it can't win.
+    """
+
+    SHORT_PENALTY = 365 * 24 * 60 * 60
+
+    # The rates in effect while choosing, so that they're only looked up once
+    # per choice, not once for every image the candidates are pruned by.
+    _rates = None
+
+    def _get_rates(self):
+        if self._rates is not None:
+            return self._rates
+        throughput = statistics.estimated_throughput()
+        if throughput is None:
+            throughput = config.updater.throughput
+        return _Rates(
+            throughput=throughput,
+            verify=config.updater.verify_cost.total_seconds(),
+            apply=config.updater.apply_cost.total_seconds(),
+            reboot=config.updater.reboot_cost.total_seconds(),
+            )
+
+    def choose(self, candidates, channel):
+        self._rates = self._get_rates()
+        try:
+            return super().choose(candidates, channel)
+        finally:
+            self._rates = None
+
+    def running_score(self, image):
+        # Everything but the reboots, which depend on where the image is in
+        # the path, and the shortfall, which depends on the other paths.
+        rates = self._get_rates()
+        size = self._uncached_size(image)
+        return (size / rates.throughput
+                + size / GiB * rates.verify
+                + rates.apply)
+
+    def costs(self, candidates):
+        """Like `score()` except returns the cost breakdown of each path.
+
+        :param candidates: A list of lists of image records.
+        :return: A list of `Cost`s, in seconds, the same size as the list of
+            paths in `candidates`.
+        """
+        rates = self._get_rates()
+        max_build = max((path[-1].version for path in candidates), default=0)
+        costs = []
+        for path in candidates:
+            size = sum(self._uncached_size(image) for image in path)
+            # Every image marked bootme needs a reboot before the next one is
+            # applied, and there's always a reboot at the end.
+            reboots = 1 + sum(1 for image in path[:-1]
+                              if getattr(image, 'bootme', False))
+            costs.append(Cost(
+                download=size / rates.throughput,
+                verify=size / GiB * rates.verify,
+                apply=len(path) * rates.apply,
+                reboot=reboots * rates.reboot,
+                short=(max_build - path[-1].version) * self.SHORT_PENALTY,
+                ))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Estimated throughput: {:.0f} bytes/s',
+                      rates.throughput)
+            for path, cost in zip(candidates, costs):
+                log.debug('{} takes {:.0f}s: {:.0f}s download + {:.0f}s '
+                          'verify + {:.0f}s apply + {:.0f}s reboot '
+                          '+ {}s short',
+                          COLON.join(str(image.version) for image in path),
+                          cost.total, cost.download, cost.verify, cost.apply,
+                          cost.reboot, cost.short)
+        return costs
+
+    def score(self, candidates):
+        # Round up to whole seconds.  Any path's estimate is rough enough
+        # that a fraction of a second shouldn't decide between them.
+        return [-int(-cost.total // 1) for cost in self.costs(candidates)]
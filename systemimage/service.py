@@ -26,11 +26,10 @@ import logging
 import argparse
 
 from contextlib import ExitStack
-from dbus.mainloop.glib import DBusGMainLoop
-from pkg_resources import resource_string as resource_bytes
+from dbus.mainloop.glib import DBusGMainLoop, threads_init
 from systemimage.config import config
 from systemimage.dbus import Loop
-from systemimage.helpers import makedirs
+from systemimage.helpers import makedirs, package_version
 from systemimage.logging import initialize
 from systemimage.main import DEFAULT_CONFIG_D
 
@@ -45,8 +44,7 @@ except ImportError: # pragma: no cover
     get_service = None
 
 
-__version__ = resource_bytes(
-    'systemimage', 'version.txt').decode('utf-8').strip()
+__version__ = package_version()
 
 
 def main():
@@ -84,10 +82,14 @@ def main():
 
     # Create the temporary directory if it doesn't exist.
     makedirs(config.system.tempdir)
-    # Initialize the loggers.
-    initialize(verbosity=args.verbose)
+    # Initialize the loggers.  The service is long-running and logs from its
+    # main loop, so never let a slow disk hold that up.
+    initialize(verbosity=args.verbose, queue=True)
     log = logging.getLogger('systemimage')
 
+    # Checks and downloads run in a worker thread, which makes D-Bus calls
+    # of its own, so make sure libdbus is thread-aware.
+    threads_init()
     DBusGMainLoop(set_as_default=True)
 
     system_bus = dbus.SystemBus()
@@ -20,16 +20,123 @@ __all__ = [
     ]
 
 
+import os
 import sqlite3
 
 from contextlib import contextmanager
 from pathlib import Path
 from systemimage.config import config
+from threading import Lock
 from xdg.BaseDirectory import xdg_cache_home
 
-SCHEMA_VERSION = '1'
+# Schema version 1 was an unkeyed (key, value) table, with a new __version__
+# row inserted every time a Settings object was created.  Version 2 keys the
+# table on `key`.  The version is recorded both in SQLite's user_version
+# pragma, which is cheap to check, and in the __version__ row for the benefit
+# of anything poking at the database by hand.
+SCHEMA_VERSION = '2'
 AUTO_DOWNLOAD_DEFAULT = '1'
 
+# INSERT ... ON CONFLICT DO UPDATE (i.e. upsert) appeared in SQLite 3.24.0.
+# Older SQLites get INSERT OR REPLACE, which has the same effect on a table
+# with nothing but a primary key and a value.
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    UPSERT = ('insert into settings (key, value) values (?, ?) '
+              'on conflict (key) do update set value = excluded.value')
+else:                                               # pragma: no cover
+    UPSERT = 'insert or replace into settings (key, value) values (?, ?)'
+
+
+class _Database:
+    """A long-lived connection to a settings database.
+
+    Settings objects are created on nearly every D-Bus call, so they share
+    one connection per database file rather than connecting, probing the
+    schema, and writing every time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The connection gets used from both the D-Bus main loop and its
+        # worker thread, so serialize access to it ourselves.
+        self.lock = Lock()
+        # The database is left in SQLite's default rollback journal mode.
+        # Write-ahead logging would be recorded in the file itself, and then
+        # processes without write access to its directory (e.g. non-root
+        # users of system-image-cli) couldn't open it unless a writer
+        # happened to have it open at the time.
+        self.connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False)
+        try:
+            self.inode = os.stat(path).st_ino
+            self._migrate()
+        except:
+            self.connection.close()
+            raise
+
+    def _migrate(self):
+        c = self.connection.cursor()
+        if c.execute('pragma user_version').fetchone()[0] >= 2:
+            return
+        # Take the write lock before looking, since another process could be
+        # migrating the same database.
+        c.execute('begin immediate')
+        try:
+            if c.execute('pragma user_version').fetchone()[0] < 2:
+                c.execute("""select 1 from sqlite_master
+                             where type = 'table' and name = 'settings'""")
+                exists = c.fetchone() is not None
+                c.execute("""create table settings_v2 (
+                                 key text primary key,
+                                 value text)""")
+                if exists:
+                    # Collapse any duplicate rows, keeping the value most
+                    # recently inserted for each key.  This gets rid of all
+                    # but one of the accumulated __version__ rows.
+                    c.execute("""insert into settings_v2 (key, value)
+                                 select key, value from settings
+                                 where rowid in (select max(rowid)
+                                                 from settings
+                                                 group by key)""")
+                    c.execute('drop table settings')
+                c.execute('alter table settings_v2 rename to settings')
+                c.execute(UPSERT, ('__version__', SCHEMA_VERSION))
+                c.execute('pragma user_version = 2')
+        except:
+            c.execute('rollback')
+            raise
+        else:
+            c.execute('commit')
+
+    def is_current(self):
+        # The database file may have been removed or replaced (e.g. by the
+        # test suite, or by a factory reset) since we connected to it.
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except FileNotFoundError:
+            return False
+
+
+_databases = {}
+_databases_lock = Lock()
+
+
+def _get_database(path):
+    path = str(path)
+    with _databases_lock:
+        database = _databases.get(path)
+        if database is None or not database.is_current():
+            if database is not None:
+                database.connection.close()
+            database = _databases[path] = _Database(path)
+        return database
+
+
+def _default(key):
+    if key == 'auto_download':
+        return AUTO_DOWNLOAD_DEFAULT
+    return ''
+
 
 class Settings:
     def __init__(self, use_config=None):
@@ -44,15 +151,6 @@ class Settings:
                 pass             # pragma: no branch
         except sqlite3.OperationalError:
             self._check_fallback()
-        with self._cursor() as c:
-            c.execute('select tbl_name from sqlite_master')
-            if len(c.fetchall()) == 0:
-                # The database file has no tables.
-                c.execute('create table settings (key, value)''')
-            # Hopefully we won't ever need to migrate this schema, but just in
-            # case we do, set a version value.
-            c.execute('insert into settings values ("__version__", ?)',
-                      (SCHEMA_VERSION,))
 
     def _check_fallback(self):
         # This is refactored into a separate method for testing purposes.
@@ -66,42 +164,76 @@ class Settings:
             pass
 
     @contextmanager
-    def _cursor(self):
+    def _database(self):
         if self._dbpath is None:
             self._dbpath = (config.system.settings_db
                             if self._use_config is None
                             else self._use_config.system.settings_db)
-        with sqlite3.connect(str(self._dbpath)) as conn:
-            yield conn.cursor()
+        database = _get_database(self._dbpath)
+        with database.lock:
+            yield database
 
-    def set(self, key, value):
-        with self._cursor() as c:
-            c.execute('select value from settings where key = ?', (key,))
-            row = c.fetchone()
-            if row is None:
-                c.execute('insert into settings values (?, ?)',
-                          (key, value))
+    @contextmanager
+    def _cursor(self, *, write=False):
+        with self._database() as database:
+            c = database.connection.cursor()
+            if not write:
+                yield c
+                return
+            c.execute('begin immediate')
+            try:
+                yield c
+            except:
+                c.execute('rollback')
+                raise
             else:
-                c.execute('update settings set value = ? where key = ?',
-                          (value, key))
+                c.execute('commit')
+
+    def set(self, key, value):
+        with self._cursor(write=True) as c:
+            c.execute(UPSERT, (key, value))
+
+    def set_many(self, settings):
+        """Set several key/value pairs in a single transaction.
+
+        :param settings: A mapping of keys to values.
+        """
+        with self._cursor(write=True) as c:
+            c.executemany(UPSERT, settings.items())
 
     def get(self, key):
         with self._cursor() as c:
             c.execute('select value from settings where key = ?', (key,))
             row = c.fetchone()
             if row is None:
-                if key == 'auto_download':
-                    return AUTO_DOWNLOAD_DEFAULT
-                return ''
+                return _default(key)
             return row[0]
 
-    def delete(self, key):
+    def get_many(self, keys):
+        """Get the values of several keys with a single query.
+
+        :param keys: A sequence of keys.
+        :return: A dictionary mapping each key to its value, or its default
+            value if it has never been set.
+        """
+        keys = list(keys)
+        values = {key: _default(key) for key in keys}
+        if len(keys) == 0:
+            return values
+        query = 'select key, value from settings where key in ({})'.format(
+            ', '.join('?' * len(keys)))
         with self._cursor() as c:
+            values.update(c.execute(query, keys))
+        return values
+
+    def delete(self, key):
+        with self._cursor(write=True) as c:
             c.execute('delete from settings where key = ?', (key,))
 
     def __iter__(self):
         # Iterate over all rows, ignoring implementation details.
         with self._cursor() as c:
-            for row in c.execute('select * from settings'):
-                if not row[0].startswith('_'):
-                    yield row
+            rows = c.execute('select key, value from settings').fetchall()
+        for row in rows:
+            if not row[0].startswith('_'):
+                yield row
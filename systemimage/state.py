@@ -16,31 +16,39 @@
 """Manage state transitions for updates."""
 
 __all__ = [
+    'CHECK_FILE',
     'ChecksumError',
     'State',
     ]
 
 
 import os
+import gzip
 import json
+import hashlib
+import lzma
 import shutil
 import logging
-import tarfile
 
 from collections import deque
 from contextlib import ExitStack
 from datetime import datetime, timezone
 from functools import partial
 from itertools import islice
-from systemimage.candidates import get_candidates, iter_path
+from systemimage.bag import Bag
+from systemimage.candidates import iter_candidates, iter_path
 from systemimage.channel import Channels
 from systemimage.config import config
 from systemimage.download import Record, get_download_manager
-from systemimage.gpg import Context, SignatureError
+from systemimage.gpg import (
+    Context, SignatureError, keyring_index, verify_file)
 from systemimage.helpers import (
-    atomic, calculate_signature, makedirs, safe_remove, temporary_directory)
+    atomic, calculate_signature, makedirs, safe_remove)
+from systemimage.image import Image
 from systemimage.index import Index
 from systemimage.keyring import KeyringError, get_keyring
+from systemimage.statistics import statistics
+from systemimage.trace import tracer
 from urllib.parse import urljoin
 
 
@@ -48,6 +56,100 @@ log = logging.getLogger('systemimage')
 COMMASPACE = ', '
 COLON = ':'
 
+# The compressed index formats, by file extension, and how to open them.
+DECOMPRESSORS = dict(
+    gz=gzip.open,
+    xz=lzma.open,
+    )
+
+# The result of the last check is saved in this file in the data partition,
+# so that a later process can resume from it.  Bump the version whenever its
+# layout changes.
+CHECK_FILE = 'last_check.json'
+CHECK_VERSION = 1
+
+
+def _digest(path):
+    with open(path, 'rb') as fp:
+        return calculate_signature(fp)
+
+
+def _stat(path):
+    # Just enough of a file's stat to tell whether it changed.
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return [info.st_ino, info.st_mtime_ns, info.st_size]
+
+
+def _updater_digest():
+    # The [updater] settings can change how the paths are scored, e.g. the
+    # TimeScorer's costs, so a check is only good for the same settings.
+    settings = sorted((key, str(value))
+                      for key, value in vars(config.updater).items()
+                      if not key.startswith('_'))
+    return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()
+
+
+def _forget_check():
+    safe_remove(os.path.join(config.updater.data_partition, CHECK_FILE))
+
+
+def _check_key():
+    # Everything a saved check depends on locally.  If any of it changes, the
+    # check has to be done again.
+    return dict(
+        channel=config.channel,
+        device=config.device,
+        build_number=config.build_number,
+        channel_target=getattr(config.service, 'channel_target', None),
+        phase_override=config.phase_override,
+        http_base=config.http_base,
+        https_base=config.https_base,
+        # The scorer's dotted path, without importing or instantiating it.
+        scorer=str(config.hooks.scorer),
+        updater=_updater_digest(),
+        keyrings=[_stat(path) for path in (config.gpg.image_master,
+                                           config.gpg.image_signing,
+                                           config.gpg.device_signing)],
+        )
+
+
+def _expired_keyring():
+    # Return the first of the installed keyrings which has expired, or None.
+    # Their stat can't tell, but the keyring index remembers their expiry, so
+    # they usually don't have to be unpacked to find out.
+    timestamp = datetime.now(tz=timezone.utc).timestamp()
+    for path in (config.gpg.image_master,
+                 config.gpg.image_signing,
+                 config.gpg.device_signing):
+        try:
+            expiry = keyring_index.lookup(path).expiry
+        except FileNotFoundError:
+            continue
+        if expiry is not None and expiry <= timestamp:
+            return path
+    return None
+
+
+def _image_to_json(image):
+    data = {key: image[key] for key in image
+            if key not in ('files', 'descriptions')}
+    data.update(image.descriptions)
+    data['files'] = [{key: filerec[key] for key in filerec}
+                     for filerec in image.files]
+    return data
+
+
+def _image_from_json(data):
+    # Like Index.from_json(), for one image.
+    data = dict(data)
+    descriptions = {key: data.pop(key) for key in list(data)
+                    if key.startswith('description')}
+    files = [Bag(**filerec) for filerec in data.pop('files')]
+    return Image(files=files, descriptions=descriptions, **data)
+
 
 class ChecksumError(Exception):
     """Exception raised when a file's checksum does not match."""
@@ -68,31 +170,38 @@ def _copy_if_missing(src, dstdir):
         shutil.copy(src, dstdir)
 
 
-def _use_cached(txt, asc, keyrings, checksum=None, blacklist=None):
-    if not os.path.exists(txt) or not os.path.exists(asc):
-        return False
-    with Context(*keyrings, blacklist=blacklist) as ctx:
-        if not ctx.verify(asc, txt):
-            return False
-    if checksum is None:
-        return True
-    with open(txt, 'rb') as fp:
-        got = calculate_signature(fp)
-        return got == checksum
+class _CacheView:
+    """The update files already downloaded and verified in the cache.
+
+    `filerec in view` is true for those files.  Each file is only checked
+    once, when it's first asked about.
+    """
+
+    def __init__(self, keyrings, blacklist):
+        self._keyrings = keyrings
+        self._blacklist = blacklist
+        self._verified = {}
+
+    def __contains__(self, filerec):
+        verified = self._verified.get(filerec.path)
+        if verified is None:
+            cache_dir = config.updater.cache_partition
+            verified = verify_file(
+                os.path.join(cache_dir, os.path.basename(filerec.path)),
+                os.path.join(cache_dir, os.path.basename(filerec.signature)),
+                self._keyrings, filerec.checksum, self._blacklist)
+            self._verified[filerec.path] = verified
+        return verified
 
 
 def _use_cached_keyring(txz, asc, signing_key):
-    if not _use_cached(txz, asc, (signing_key,)):
+    if not verify_file(txz, asc, (signing_key,)):
         return False
-    # Do one additional check: unpack the .tar.xz file, grab the keyring.json
-    # and if it has an expiry key, make sure that the keyring has not expired.
-    with temporary_directory(dir=config.tempdir) as tmp:
-        with tarfile.open(txz, 'r:xz') as tf:
-            tf.extractall(tmp)
-        json_path = os.path.join(tmp, 'keyring.json')
-        with open(json_path, 'r', encoding='utf-8') as fp:
-            data = json.load(fp)
-    expiry = data.get('expiry')
+    # Do one additional check: if the keyring.json file inside the .tar.xz
+    # has an expiry key, make sure that the keyring has not expired.  The
+    # keyring index remembers this, so we usually don't have to unpack the
+    # tarball to find out.
+    expiry = keyring_index.lookup(txz).expiry
     timestamp = datetime.now(tz=timezone.utc).timestamp()
     # We can use this keyring if it never expires, or if the expiration date
     # is some time in the future.
@@ -113,9 +222,14 @@ class State:
         self.winner = None
         self.files = []
         self.channel_switch = None
+        # What the check was derived from, for save_check().
+        self._channels_digest = None
+        self._index_asc = None
         # Other public attributes.
         self.downloader = get_download_manager()
         self._next.append(self._cleanup)
+        # Each new state machine starts a new trace.
+        tracer.reset()
 
     def __iter__(self):
         return self
@@ -127,11 +241,15 @@ class State:
         log.debug('-> [{:2}] {}'.format(self._debug_step, name))
         return step, name
 
+    def _run(self, step, name):
+        with tracer.span(name.lstrip('_'), 'state'):
+            step()
+        self._debug_step += 1
+
     def __next__(self):
         try:
             step, name = self._pop()
-            step()
-            self._debug_step += 1
+            self._run(step, name)
         except IndexError:
             # Do not chain the exception.
             raise StopIteration from None
@@ -152,8 +270,7 @@ class State:
             except (StopIteration, IndexError):
                 # We're done.
                 break
-            step()
-            self._debug_step += 1
+            self._run(step, name)
             if name[1:] == stop_after:
                 break
 
@@ -176,8 +293,128 @@ class State:
                 # skip this step.
                 self._next.appendleft(step)
                 break
-            step()
-            self._debug_step += 1
+            self._run(step, name)
+
+    def save_check(self):
+        """Save the result of the check, for `resume_check()`.
+
+        Call this once the state machine has run through calculating the
+        winner.  If there is no winner, any previously saved check is
+        forgotten.
+        """
+        path = os.path.join(config.updater.data_partition, CHECK_FILE)
+        if (not self.winner
+                or self._channels_digest is None
+                or self._index_asc is None):
+            _forget_check()
+            return
+        saved = dict(
+            version=CHECK_VERSION,
+            key=_check_key(),
+            channels=self._channels_digest,
+            index=list(self._index_asc),
+            blacklist=self.blacklist,
+            channel_switch=self.channel_switch,
+            winner=[_image_to_json(image) for image in self.winner],
+            )
+        try:
+            with atomic(path) as fp:
+                json.dump(saved, fp)
+        except OSError:
+            log.exception('Cannot save the check: {}', path)
+
+    def resume_check(self):
+        """Resume from the check saved by an earlier process.
+
+        The saved check is only used if it was made with the same
+        configuration, build number, and keyrings, if none of those keyrings
+        has since expired, and if channels.json and the signatures of the
+        index and the blacklist are unchanged on the server.  Only those
+        small files are downloaded, and since they're compared against what
+        was verified at the time, gpg isn't needed.  If the check can be
+        resumed, the state machine carries on from downloading the winning
+        path's files, exactly as after a full check.
+
+        This must be called before the state machine is run.
+
+        :return: True if the check was resumed.  Otherwise, the state
+            machine is left as it was and False is returned.
+        """
+        path = os.path.join(config.updater.data_partition, CHECK_FILE)
+        try:
+            with open(path, encoding='utf-8') as fp:
+                saved = json.load(fp)
+            fresh = (saved['version'] == CHECK_VERSION
+                     and saved['key'] == _check_key())
+            index_asc_url, index_asc_digest = saved['index']
+            winner = [_image_from_json(image) for image in saved['winner']]
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            log.exception('Ignoring unreadable saved check: {}', path)
+            return False
+        if not fresh:
+            log.info('Saved check is for a different configuration')
+            return False
+        # The full check replaces expired keyrings.
+        expired = _expired_keyring()
+        if expired is not None:
+            log.info('Saved check is stale: expired keyring {}', expired)
+            return False
+        blacklist = saved['blacklist']
+        channels_path = os.path.join(config.tempdir, 'channels.json')
+        index_asc_path = os.path.join(config.tempdir, 'index.json.asc')
+        blacklist_asc_path = os.path.join(
+            config.tempdir, 'blacklist.tar.xz.asc')
+        with ExitStack() as stack:
+            for temporary in (channels_path, index_asc_path,
+                              blacklist_asc_path):
+                stack.callback(safe_remove, temporary)
+            try:
+                self.downloader.get_files([
+                    (urljoin(config.https_base, 'channels.json'),
+                     channels_path),
+                    (index_asc_url, index_asc_path),
+                    ])
+            except FileNotFoundError:
+                log.info('Saved check is stale: files are gone')
+                return False
+            try:
+                self.downloader.get_files([(
+                    urljoin(config.https_base, 'gpg/blacklist.tar.xz.asc'),
+                    blacklist_asc_path)])
+            except FileNotFoundError:
+                blacklist_asc_digest = None
+            else:
+                blacklist_asc_digest = _digest(blacklist_asc_path)
+            # The blacklist which was checked against must still be here, and
+            # still be the one on the server.
+            if blacklist is None:
+                blacklist_fresh = blacklist_asc_digest is None
+            else:
+                blacklist_fresh = (
+                    os.path.exists(blacklist)
+                    and os.path.exists(blacklist + '.asc')
+                    and _digest(blacklist + '.asc') == blacklist_asc_digest)
+            channels_digest = _digest(channels_path)
+            if (not blacklist_fresh
+                    or channels_digest != saved['channels']
+                    or _digest(index_asc_path) != index_asc_digest):
+                log.info('Saved check is stale')
+                return False
+            with open(channels_path, encoding='utf-8') as fp:
+                self.channels = Channels.from_json(fp.read())
+        self.blacklist = blacklist
+        self.winner = winner
+        if saved['channel_switch'] is not None:
+            self.channel_switch = tuple(saved['channel_switch'])
+        self._channels_digest = channels_digest
+        self._index_asc = (index_asc_url, index_asc_digest)
+        self._next.clear()
+        self._next.append(self._download_files)
+        log.info('Resumed the saved check, upgrade path is {}',
+                 COLON.join(str(image.version) for image in winner))
+        return True
 
     def _cleanup(self):
         """Clean up the destination directories.
@@ -311,6 +548,7 @@ class State:
             log.info('Local channels file: {}', channels_path)
             with open(channels_path, encoding='utf-8') as fp:
                 self.channels = Channels.from_json(fp.read())
+            self._channels_digest = _digest(channels_path)
         # Locate the index file for the channel/device.
         try:
             channel = self.channels[config.channel]
@@ -330,7 +568,68 @@ class State:
         keyring = getattr(device, 'keyring', None)
         if keyring:
             self._next.append(partial(self._get_device_keyring, keyring))
-        self._next.append(partial(self._get_index, device.index))
+        # The server may also publish compressed copies of the device's
+        # indexes.
+        compression = getattr(device, 'compression', None)
+        if compression is not None and compression not in DECOMPRESSORS:
+            log.info('unsupported index compression: {}', compression)
+            compression = None
+        get_full_index = partial(
+            self._get_index, device.index, compression=compression)
+        # If there's an incremental index covering our build, it's much
+        # smaller than the full index, so get that instead.
+        build_number = self._build_number(channel)[0]
+        incremental = self._incremental_index(device, build_number)
+        if incremental is None:
+            self._next.append(get_full_index)
+        else:
+            log.info('using incremental index since build {}: {}',
+                     incremental.since, incremental.index)
+            self._next.append(partial(
+                self._get_index, incremental.index, since=incremental.since,
+                compression=compression, fallback=get_full_index))
+
+    def _build_number(self, channel):
+        """Return the build number to upgrade from.
+
+        :param channel: The channel we're upgrading on.
+        :return: A 2-tuple of the build number and the channel switch, which
+            is None unless the channel alias has changed.
+        """
+        # If we were tracking a channel alias, and that channel alias has
+        # changed, squash the build number to 0 before calculating the
+        # winner.  Otherwise, trust the configured build number.
+        #
+        # channel_target is the channel we're on based on the alias mapping in
+        # our config files.  channel_alias is the alias mapping in the
+        # channel.json file, i.e. the channel an update will put us on.
+        channel_target = getattr(config.service, 'channel_target', None)
+        channel_alias = getattr(channel, 'alias', None)
+        if (    channel_alias is None or
+                channel_target is None or
+                channel_alias == channel_target):
+            return config.build_number, None
+        # This is a channel switch caused by a new alias.  Unless the build
+        # number has been explicitly overridden on the command line via
+        # --build/-b, use build number 0 to force a full update.
+        build_number = (config.build_number
+                        if config.build_number_override
+                        else 0)
+        return build_number, (channel_target, channel_alias)
+
+    def _incremental_index(self, device, build_number):
+        """Return the best incremental index for the build, or None.
+
+        An incremental index only has the images that matter to devices at or
+        above its `since` build, so the best one is the one with the highest
+        `since` that's still at or below our build.
+        """
+        best = None
+        for incremental in getattr(device, 'incremental', []):
+            if (incremental.since <= build_number and
+                    (best is None or incremental.since > best.since)):
+                best = incremental
+        return best
 
     def _get_device_keyring(self, keyring):
         keyring_url = urljoin(config.https_base, keyring.path)
@@ -359,6 +658,7 @@ class State:
         # Retry the previous step.
         log.info('Installing new image master key to: {}',
                  config.gpg.image_master)
+        statistics.increment('retries')
         self._next.appendleft(self._get_blacklist_2)
 
     def _get_signing_key(self):
@@ -378,19 +678,45 @@ class State:
             raise
         # Retry the previous step, but signal to _get_channel() that if the
         # signature fails this time, it's an error.
+        statistics.increment('retries')
         self._next.appendleft(partial(self._get_channel, 1))
 
-    def _get_index(self, index):
-        """Get and verify the index.json file."""
+    def _get_index(self, index, since=None, compression=None,
+                   fallback=None):
+        """Get and verify the index.json file.
+
+        If `compression` is given, the compressed copy of the index with that
+        file extension is downloaded, verified, and then decompressed as it's
+        parsed.  Its signature is over the compressed file.
+
+        For an incremental index, `since` is the build it covers devices
+        from.  `fallback` is the step to run instead if the index is missing,
+        or turns out not to cover our build.
+        """
+        not_found = fallback
+        filename = 'index.json'
+        if compression is not None:
+            # If the compressed index is missing, try the uncompressed one.
+            not_found = partial(
+                self._get_index, index, since=since, fallback=fallback)
+            index += '.' + compression
+            filename += '.' + compression
         index_url = urljoin(config.https_base, index)
         asc_url = index_url + '.asc'
-        index_path = os.path.join(config.tempdir, 'index.json')
+        index_path = os.path.join(config.tempdir, filename)
         asc_path = index_path + '.asc'
         with ExitStack() as stack:
-            self.downloader.get_files([
-                (index_url, index_path),
-                (asc_url, asc_path),
-                ])
+            try:
+                self.downloader.get_files([
+                    (index_url, index_path),
+                    (asc_url, asc_path),
+                    ])
+            except FileNotFoundError:
+                if not_found is None:
+                    raise
+                log.info('index not found, falling back: {}', index_url)
+                self._next.appendleft(not_found)
+                return
             stack.callback(os.remove, index_path)
             stack.callback(os.remove, asc_path)
             # Check the signature of the index.json file.  It may be signed by
@@ -402,40 +728,48 @@ class State:
             ctx = stack.enter_context(
                 Context(*keyrings, blacklist=self.blacklist))
             ctx.validate(asc_path, index_path)
-            # The signature was good.
-            with open(index_path, encoding='utf-8') as fp:
-                self.index = Index.from_json(fp.read())
+            self._index_asc = (asc_url, _digest(asc_path))
+            # The signature was good.  Compressed indexes are decompressed
+            # straight into the parser.  Count the bytes here, where they're
+            # read, rather than encoding the whole index again to count them.
+            opener = DECOMPRESSORS.get(compression, open)
+            with opener(index_path, 'rb') as fp:
+                data = fp.read()
+            tracer.add_bytes(len(data))
+            index = Index.from_json(data.decode('utf-8'))
+        if since is not None:
+            # Make sure the incremental index is the one channels.json says
+            # it is, and not e.g. one for a later build left on the server.
+            indexed_since = getattr(index.global_, 'since', None)
+            if indexed_since is None or indexed_since > since:
+                log.info('incremental index is for build {}, falling back',
+                         indexed_since)
+                self._next.appendleft(fallback)
+                return
+        self.index = index
         self._next.append(self._calculate_winner)
 
     def _calculate_winner(self):
         """Given an index, calculate the paths and score a winner."""
-        # If we were tracking a channel alias, and that channel alias has
-        # changed, squash the build number to 0 before calculating the
-        # winner.  Otherwise, trust the configured build number.
         channel = self.channels[config.channel]
-        # channel_target is the channel we're on based on the alias mapping in
-        # our config files.  channel_alias is the alias mapping in the
-        # channel.json file, i.e. the channel an update will put us on.
         channel_target = getattr(config.service, 'channel_target', None)
         channel_alias = getattr(channel, 'alias', None)
-        if (    channel_alias is None or
-                channel_target is None or
-                channel_alias == channel_target):
-            build_number = config.build_number
-        else:
-            # This is a channel switch caused by a new alias.  Unless the
-            # build number has been explicitly overridden on the command line
-            # via --build/-b, use build number 0 to force a full update.
-            build_number = (config.build_number
-                            if config.build_number_override
-                            else 0)
-            self.channel_switch = (channel_target, channel_alias)
-        candidates = get_candidates(self.index, build_number)
-        log.debug('Candidates from build# {}: {}'.format(
-            build_number, len(candidates)))
+        build_number, channel_switch = self._build_number(channel)
+        if channel_switch is not None:
+            self.channel_switch = channel_switch
+        # The scorer gets a view of what's already in the cache.  The view
+        # remembers what it has verified, so it's only good for this scoring;
+        # the files are verified again when they're about to be used.
+        scorer = config.hooks.scorer()
+        scorer.cache = _CacheView(self._signing_keyrings(), self.blacklist)
+        # The candidates are generated as the scorer consumes them, and
+        # pruned by its running score if there are too many.
+        log.debug('Candidates from build# {}', build_number)
+        candidates = iter_candidates(
+            self.index, build_number, score=scorer.running_score)
         if self.candidate_filter is not None:
             candidates = self.candidate_filter(candidates)
-        self.winner = config.hooks.scorer().choose(
+        self.winner = scorer.choose(
             candidates, (channel_target
                          if channel_alias is None
                          else channel_alias))
@@ -455,13 +789,17 @@ class State:
                 return
         self._next.append(self._download_files)
 
-    def _download_files(self):
-        """Download and verify all the winning upgrade path's files."""
+    def _signing_keyrings(self):
         # If there is a device-signing key, the files can be signed by either
         # that or the image-signing key.
         keyrings = [config.gpg.image_signing]
         if os.path.exists(config.gpg.device_signing):
             keyrings.append(config.gpg.device_signing)
+        return keyrings
+
+    def _download_files(self):
+        """Download and verify all the winning upgrade path's files."""
+        keyrings = self._signing_keyrings()
         # Now, go through all the file records in the winning upgrade path.
         # If the data file has already been downloaded and it has a valid
         # signature file, then we can save some bandwidth by not downloading
@@ -483,11 +821,14 @@ class State:
             checksum = filerec.checksum
             self.files.append((dst, (image_number, filerec.order)))
             self.files.append((asc, (image_number, filerec.order)))
-            # Check the existence and signature of the file.
-            if _use_cached(dst, asc, keyrings, checksum, self.blacklist):
+            # Check the existence and signature of the file.  Don't trust what
+            # the scorer saw, since the file could have changed since then.
+            if verify_file(dst, asc, keyrings, checksum, self.blacklist):
+                statistics.increment('cache_hits')
                 preserve.add(dst)
                 preserve.add(asc)
             else:
+                statistics.increment('cache_misses')
                 # Add the data file, which has a checksum.
                 downloads.append(Record(
                     urljoin(config.http_base, filerec.path),
@@ -537,6 +878,9 @@ class State:
             # Everything is fine so nothing needs to be cleared.
             stack.pop_all()
         log.info('all files available in {}', cache_dir)
+        # The saved check is only forgotten now, so that if the download
+        # fails or is canceled, a later process can still resume from it.
+        _forget_check()
         # Now, copy the files from the temporary directory into the location
         # for the upgrader.
         self._next.append(self._move_files)
@@ -0,0 +1,340 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counters and histograms which persist across restarts.
+
+The statistics live in a JSON file next to the settings database, and are
+saved after every check and download.  Optionally, they are also exported in
+the Prometheus textfile format.
+
+Both the D-Bus service and system-image-cli may be counting at the same
+time, so each process only adds what it counted itself to what's in the
+file when it saves, while holding a lock on the file.
+"""
+
+__all__ = [
+    'Statistics',
+    'statistics',
+    ]
+
+
+import os
+import json
+import fcntl
+import logging
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from systemimage.config import config
+from systemimage.helpers import atomic, safe_remove
+from threading import Lock
+from time import monotonic
+
+
+log = logging.getLogger('systemimage')
+
+STATISTICS_FILE = 'statistics.json'
+# Saving holds an exclusive lock on this file, next to the statistics file.
+LOCK_FILE = 'statistics.lock'
+PROMETHEUS_PREFIX = 'systemimage_'
+
+# The counters, and their descriptions for the Prometheus export.
+COUNTERS = OrderedDict((
+    ('checks', 'Update checks run.'),
+    ('metadata_bytes', 'Bytes of keyrings, channels, and indexes downloaded.'),
+    ('payload_bytes', 'Bytes of update files downloaded.'),
+    ('cache_hits', 'Files reused from the cache partition.'),
+    ('cache_misses', 'Files which could not be reused from the cache.'),
+    ('gpg_invocations', 'Invocations of gpg.'),
+    ('gpg_seconds', 'Total time spent in gpg.'),
+    ('retries', 'Steps retried after fetching a new signing key.'),
+    ('failures', 'Failed checks and downloads.'),
+    ))
+
+# The upper bounds of the download throughput histogram's buckets, in bytes
+# per second.  There's an implicit last bucket for everything faster.
+THROUGHPUT_BUCKETS = (
+    16 * 1024,
+    64 * 1024,
+    256 * 1024,
+    1024 * 1024,
+    4 * 1024 * 1024,
+    16 * 1024 * 1024,
+    64 * 1024 * 1024,
+    )
+# How much each new update file download moves the estimate of this device's
+# throughput.  Newer downloads count for more, since networks change.
+THROUGHPUT_WEIGHT = 0.3
+
+
+class Statistics:
+    """The process-wide statistics.
+
+    The statistics are loaded on first use from the directory containing the
+    configured settings database, and are reloaded if that changes.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._path = None
+        self._reset()
+
+    def _reset(self):
+        self._counters = OrderedDict((name, 0) for name in COUNTERS)
+        self._counters['gpg_seconds'] = 0.0
+        self._failures = {}
+        # One more bucket than there are bounds, for the overflow.
+        self._throughput = [0] * (len(THROUGHPUT_BUCKETS) + 1)
+        self._throughput_sum = 0.0
+        self._throughput_estimate = None
+        # The statistics as they were last loaded or saved, so that only
+        # what this process counted since then gets added when saving.
+        self._base = self._snapshot()
+
+    def _snapshot(self):
+        # Must be called with the lock held.
+        return dict(
+            counters=dict(self._counters),
+            failures=dict(self._failures),
+            throughput=dict(
+                buckets=list(THROUGHPUT_BUCKETS),
+                counts=list(self._throughput),
+                sum=self._throughput_sum,
+                estimate=self._throughput_estimate,
+                ),
+            )
+
+    def _read(self, path):
+        # Return the saved statistics, or None if there aren't any.
+        try:
+            with open(path, encoding='utf-8') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.exception('Ignoring unreadable statistics: {}', path)
+            return None
+
+    def _load(self):
+        # Must be called with the lock held.
+        path = os.path.join(
+            os.path.dirname(str(config.system.settings_db)), STATISTICS_FILE)
+        if path == self._path:
+            return
+        self._reset()
+        self._path = path
+        saved = self._read(path)
+        if saved is not None:
+            self._restore(saved)
+
+    def _restore(self, saved):
+        # Must be called with the lock held, after _reset().
+        for name, value in saved.get('counters', {}).items():
+            if name in self._counters:
+                self._counters[name] = value
+        self._failures.update(saved.get('failures', {}))
+        throughput = saved.get('throughput', {})
+        # Only keep the saved histogram if the buckets haven't changed.
+        if throughput.get('buckets') == list(THROUGHPUT_BUCKETS):
+            self._throughput = throughput['counts']
+            self._throughput_sum = throughput['sum']
+        self._throughput_estimate = throughput.get('estimate')
+        self._base = self._snapshot()
+
+    def _merged(self, saved):
+        # Must be called with the lock held.  Return the saved statistics
+        # plus whatever this process counted since it last loaded or saved.
+        ours = self._snapshot()
+        base = self._base
+        if saved is None:
+            saved = {}
+        merged = self._snapshot()
+        for key in ('counters', 'failures'):
+            theirs = saved.get(key, {})
+            merged[key] = {
+                name: (theirs.get(name, 0)
+                       + ours[key].get(name, 0) - base[key].get(name, 0))
+                for name in set(ours[key]) | set(theirs)
+                }
+        throughput = saved.get('throughput', {})
+        if throughput.get('buckets') == list(THROUGHPUT_BUCKETS):
+            counts = throughput['counts']
+            total = throughput['sum']
+        else:
+            counts = [0] * len(ours['throughput']['counts'])
+            total = 0.0
+        merged['throughput']['counts'] = [
+            theirs + mine - was for theirs, mine, was in zip(
+                counts,
+                ours['throughput']['counts'],
+                base['throughput']['counts'])]
+        merged['throughput']['sum'] = (
+            total + ours['throughput']['sum'] - base['throughput']['sum'])
+        # The estimate can't be added up.  Keep ours if we updated it.
+        if (ours['throughput']['estimate']
+                == base['throughput']['estimate']):
+            merged['throughput']['estimate'] = throughput.get('estimate')
+        return merged
+
+    def increment(self, name, amount=1):
+        """Add to one of the counters."""
+        with self._lock:
+            self._load()
+            self._counters[name] += amount
+
+    def failure(self, name):
+        """Count a failure, by the name of its exception class."""
+        with self._lock:
+            self._load()
+            self._counters['failures'] += 1
+            self._failures[name] = self._failures.get(name, 0) + 1
+
+    def throughput(self, received, seconds, *, payload=False):
+        """Record the throughput of a download.
+
+        :param received: The number of bytes downloaded.
+        :param seconds: How long the download took.
+        :param payload: True when update files were downloaded.  Only these
+            are big enough to say how fast this device downloads, so only
+            these update the throughput estimate.
+        """
+        if received <= 0 or seconds <= 0:
+            return
+        rate = received / seconds
+        for index, bound in enumerate(THROUGHPUT_BUCKETS):
+            if rate <= bound:
+                break
+        else:
+            index = len(THROUGHPUT_BUCKETS)
+        with self._lock:
+            self._load()
+            self._throughput[index] += 1
+            self._throughput_sum += rate
+            if payload:
+                if self._throughput_estimate is None:
+                    self._throughput_estimate = rate
+                else:
+                    self._throughput_estimate += THROUGHPUT_WEIGHT * (
+                        rate - self._throughput_estimate)
+
+    def estimated_throughput(self):
+        """Return this device's estimated download throughput.
+
+        :return: The estimate in bytes per second, or None if no update
+            files have been downloaded yet.
+        """
+        with self._lock:
+            self._load()
+            return self._throughput_estimate
+
+    @contextmanager
+    def gpg(self):
+        """Count and time a gpg invocation."""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            elapsed = monotonic() - start
+            with self._lock:
+                self._load()
+                self._counters['gpg_invocations'] += 1
+                self._counters['gpg_seconds'] += elapsed
+
+    def as_dict(self):
+        """Return a snapshot of the statistics."""
+        with self._lock:
+            self._load()
+            return self._snapshot()
+
+    def as_prometheus(self):
+        """Return the statistics in the Prometheus text exposition format."""
+        snapshot = self.as_dict()
+        lines = []
+        for name, help_text in COUNTERS.items():
+            metric = PROMETHEUS_PREFIX + name + '_total'
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} counter'.format(metric))
+            if name == 'failures':
+                for exception, value in sorted(snapshot['failures'].items()):
+                    lines.append('{}{{exception="{}"}} {}'.format(
+                        metric, exception, value))
+            else:
+                lines.append('{} {}'.format(
+                    metric, snapshot['counters'][name]))
+        metric = PROMETHEUS_PREFIX + 'download_throughput_bytes_per_second'
+        lines.append('# HELP {} Download throughput.'.format(metric))
+        lines.append('# TYPE {} histogram'.format(metric))
+        throughput = snapshot['throughput']
+        # Prometheus buckets are cumulative.
+        cumulative = 0
+        bounds = [str(bound) for bound in throughput['buckets']] + ['+Inf']
+        for bound, count in zip(bounds, throughput['counts']):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                metric, bound, cumulative))
+        lines.append('{}_sum {}'.format(metric, throughput['sum']))
+        lines.append('{}_count {}'.format(metric, cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forget all the statistics, including the saved ones."""
+        with self._lock:
+            self._load()
+            self._reset()
+            safe_remove(self._path)
+
+    def save(self):
+        """Save the statistics, and export them if so configured.
+
+        Whatever this process counted is added to the saved statistics, so
+        that other processes' counts aren't lost.  Nothing is saved if
+        nothing was counted.  Failures are logged, but otherwise ignored;
+        statistics aren't worth failing an update over.
+        """
+        with self._lock:
+            self._load()
+            if self._snapshot() == self._base:
+                return
+            lock_path = os.path.join(os.path.dirname(self._path), LOCK_FILE)
+            try:
+                with open(lock_path, 'a') as lock_fp:
+                    fcntl.flock(lock_fp, fcntl.LOCK_EX)
+                    snapshot = self._merged(self._read(self._path))
+                    with atomic(self._path) as fp:
+                        json.dump(snapshot, fp)
+            except (PermissionError, FileNotFoundError) as error:
+                # E.g. system-image-cli run by a user other than root, who
+                # can't write to the settings database's directory.
+                log.debug('Not saving statistics: {}', error)
+                return
+            except OSError:
+                log.exception('Cannot save statistics: {}', self._path)
+                return
+            self._reset()
+            self._restore(snapshot)
+        textfile = config.system.stats_textfile
+        if len(textfile) == 0:
+            return
+        try:
+            with atomic(textfile) as fp:
+                fp.write(self.as_prometheus())
+                # The exporter runs as some other user.
+                os.fchmod(fp.fileno(), 0o644)
+        except OSError:
+            log.exception('Cannot export statistics: {}', textfile)
+
+
+# The process-wide statistics.
+statistics = Statistics()
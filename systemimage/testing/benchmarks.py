@@ -0,0 +1,721 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Performance benchmarks.
+
+These aren't part of the test suite, since their results depend on the
+machine they're run on.  Run them with:
+
+    $ python3 -m systemimage.testing.benchmarks [name ...]
+
+To catch regressions, save the results of a known good tree as a baseline,
+then compare a later run against it:
+
+    $ python3 -m systemimage.testing.benchmarks --save baseline.json
+    $ python3 -m systemimage.testing.benchmarks --compare baseline.json
+
+The download benchmarks run a real threaded HTTPS server in a subprocess,
+so they need the port 8943 to be free, and gpg to sign the synthetic update.
+The server can simulate a slower network:
+
+    $ python3 -m systemimage.testing.benchmarks --network mobile --seed 7
+"""
+
+__all__ = [
+    'Bytes',
+    'Count',
+    'Rate',
+    'benchmark',
+    'main',
+    'measure',
+    'measure_memory',
+    ]
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import sqlite3
+import argparse
+import platform
+import resource
+import tracemalloc
+import multiprocessing
+
+from collections import OrderedDict
+from contextlib import ExitStack
+from pathlib import Path
+from systemimage.bag import Bag
+from systemimage.helpers import MiB, temporary_directory
+from time import perf_counter
+from unittest.mock import patch
+
+
+BENCHMARKS = OrderedDict()
+BASELINE_VERSION = 1
+# By default, a result more than this many times its baseline is reported as
+# a regression.
+DEFAULT_THRESHOLD = 1.25
+
+
+class Bytes(int):
+    """A benchmark result which is an amount of memory, not a time."""
+
+
+class Count(int):
+    """A benchmark result which counts events, e.g. system calls."""
+
+
+class Rate(float):
+    """A benchmark result which is a throughput in bytes per second.
+
+    Unlike all the other results, bigger is better.
+    """
+
+
+def benchmark(function):
+    """Register a benchmark function.
+
+    The function takes no arguments and returns a dictionary mapping the
+    names of the things it measured to their times in seconds, or to
+    `Bytes` for memory measurements.
+    """
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def measure(function, *args, repeat=5, number=1):
+    """Return the best time in seconds of `number` calls to `function`.
+
+    The calls are timed `repeat` times, and the fastest run is reported, as
+    it's the one least disturbed by everything else going on.
+    """
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        for j in range(number):
+            function(*args)
+        elapsed = (perf_counter() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def measure_memory(function, *args):
+    """Return the peak memory allocated by a call to `function`.
+
+    This is measured separately from the time, since tracing allocations
+    slows everything down.
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        return Bytes(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+
+# Settings.  Before schema version 2, every Settings() instantiation inserted
+# a __version__ row, and Information() alone creates one on every call.  A
+# settings UI polling every 30 seconds for a year leaves about a million rows
+# behind.
+YEAR_OF_ROWS = 365 * 24 * 60 * 2
+
+
+def _make_legacy_settings(path, rows=YEAR_OF_ROWS):
+    with sqlite3.connect(path) as conn:
+        conn.execute('create table settings (key, value)')
+        conn.executemany('insert into settings values ("__version__", "1")',
+                         ((),) * rows)
+        conn.executemany('insert into settings values (?, ?)', (
+            ('auto_download', '1'),
+            ('min_battery', '30'),
+            ('last_check_date', '2016-03-02 12:34:56'),
+            ))
+
+
+@benchmark
+def settings_year_of_duplicates():
+    from systemimage.settings import Settings
+    results = OrderedDict()
+    with temporary_directory() as tmpdir:
+        path = os.path.join(tmpdir, 'settings.db')
+        _make_legacy_settings(path)
+        # What every get used to cost: a full scan of the unkeyed table.
+        with sqlite3.connect(path) as conn:
+            results['legacy get'] = measure(
+                lambda: conn.execute(
+                    'select value from settings where key = ?',
+                    ('auto_download',)).fetchone())
+        use_config = Bag(system=Bag(settings_db=path))
+        results['migration'] = measure(Settings, use_config, repeat=1)
+        settings = Settings(use_config)
+        results['instantiate'] = measure(
+            Settings, use_config, number=1000)
+        results['get'] = measure(
+            settings.get, 'auto_download', number=1000)
+        results['set'] = measure(
+            settings.set, 'last_check_date', '2017-03-02 12:34:56',
+            number=100)
+        keys = ['auto_download', 'min_battery', 'last_check_date']
+        results['get_many'] = measure(settings.get_many, keys, number=1000)
+        results['version'] = measure(settings.version, number=1000)
+    return results
+
+
+# Logging.  Emulate slow flash by making every flush of the log file take a
+# couple of milliseconds, then see how long the logging calls made from the
+# main loop take.
+SLOW_FLUSH_SECONDS = 0.002
+
+
+class _SlowStream:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, data):
+        return self._stream.write(data)
+
+    def flush(self):
+        time.sleep(SLOW_FLUSH_SECONDS)
+        self._stream.flush()
+
+    def close(self):
+        self._stream.close()
+
+
+def _logging_latencies(tmpdir, queue, calls=1000):
+    from systemimage.logging import (
+        BatchingQueueHandler, FormattingLogRecord, make_handler)
+    log = logging.getLogger('systemimage.benchmarks')
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    with ExitStack() as resources:
+        old_factory = logging.getLogRecordFactory()
+        logging.setLogRecordFactory(FormattingLogRecord)
+        resources.callback(logging.setLogRecordFactory, old_factory)
+        handler = make_handler(Path(tmpdir) / 'client.log')
+        handler.stream = _SlowStream(handler.stream)
+        if queue:
+            handler = BatchingQueueHandler([handler])
+        log.addHandler(handler)
+        resources.callback(handler.close)
+        resources.callback(log.removeHandler, handler)
+        latencies = []
+        for i in range(calls):
+            # This is what log_and_exit() logs around every D-Bus method
+            # call, and the curl progress callback logs at DEBUG.
+            start = perf_counter()
+            log.info('>>> {}', 'Information')
+            log.debug('received: {} of {} bytes', i * 4096, calls * 4096)
+            log.info('<<< {}', 'Information')
+            latencies.append(perf_counter() - start)
+    latencies.sort()
+    return latencies
+
+
+@benchmark
+def logging_main_loop_latency():
+    results = OrderedDict()
+    with temporary_directory() as tmpdir:
+        for label, queue in (('sync', False), ('queue', True)):
+            latencies = _logging_latencies(tmpdir, queue)
+            results[label + ' mean'] = sum(latencies) / len(latencies)
+            results[label + ' p99'] = latencies[int(len(latencies) * 0.99)]
+            results[label + ' max'] = latencies[-1]
+    return results
+
+
+# Update planning.  These are the steps between downloading the channels and
+# index files and deciding what to download, run over synthetic server data
+# of various shapes.
+PLANNING_SCENARIOS = OrderedDict((
+    # About what a real device channel looks like.
+    ('typical', dict(fulls=2, delta_chain=10, fork_factor=1,
+                     files_per_image=3, locales=2)),
+    # Deltas from each of the two previous versions; thousands of candidates.
+    ('forked', dict(fulls=2, delta_chain=9, fork_factor=2,
+                    files_per_image=3, locales=2)),
+    # A long history of images.
+    ('long', dict(fulls=20, delta_chain=30, fork_factor=1,
+                  files_per_image=3, locales=10)),
+    # Lots of files and translations, for the parsers.
+    ('wide', dict(fulls=5, delta_chain=10, fork_factor=1,
+                  files_per_image=20, locales=60)),
+    ))
+PLANNING_CHANNEL = 'channel-0'
+
+
+def _planning(scenario):
+    from systemimage.candidates import (
+        delta_filter, full_filter, get_candidates, iter_path, version_filter)
+    from systemimage.channel import Channels
+    from systemimage.index import Index
+    from systemimage.scores import WeightedScorer
+    from systemimage.testing.synthetic import make_channels, make_index
+    index_json = make_index(**PLANNING_SCENARIOS[scenario])
+    channels_json = make_channels(channels=10, devices=50)
+    index = Index.from_json(index_json)
+    candidates = get_candidates(index, 1)
+    scorer = WeightedScorer()
+    winner = scorer.choose(candidates, PLANNING_CHANNEL)
+    cap = version_filter(winner[-1].version - 1)
+    operations = OrderedDict((
+        ('Index.from_json', (Index.from_json, index_json)),
+        ('Channels.from_json', (Channels.from_json, channels_json)),
+        ('get_candidates', (get_candidates, index, 1)),
+        ('choose', (scorer.choose, candidates, PLANNING_CHANNEL)),
+        ('iter_path', (lambda: list(iter_path(winner)),)),
+        ('full_filter', (full_filter, candidates)),
+        ('delta_filter', (delta_filter, candidates)),
+        ('version_filter', (cap, winner)),
+        ))
+    results = OrderedDict()
+    for label, (function, *args) in operations.items():
+        results[label] = measure(function, *args, repeat=3)
+        results[label + ' peak'] = measure_memory(function, *args)
+    return results
+
+
+def _planning_benchmark(scenario):
+    def run():
+        return _planning(scenario)
+    run.__name__ = 'planning_' + scenario
+    return benchmark(run)
+
+
+for _scenario in PLANNING_SCENARIOS:
+    _planning_benchmark(_scenario)
+
+
+# A channels.json file the size of a real one, with hundreds of devices.  A
+# client only ever looks up its own device in its own channel, and lists the
+# channels its device can be installed from.
+CHANNELS_DEVICES = 500
+
+
+@benchmark
+def channels_500():
+    from systemimage.channel import Channels
+    from systemimage.testing.synthetic import make_channels
+    channels_json = make_channels(channels=30, devices=CHANNELS_DEVICES)
+    device = 'device-{}'.format(CHANNELS_DEVICES - 1)
+    def lookup():
+        channels = Channels.from_json(channels_json)
+        return channels[PLANNING_CHANNEL].devices[device]
+    def listing():
+        channels = Channels.from_json(channels_json)
+        return [(channels[name].get('hidden'), channels[name].get('alias'))
+                for name in channels.installable(device)]
+    def everything():
+        # What parsing used to cost: every channel and every device.
+        channels = Channels.from_json(channels_json)
+        return [channels[name].devices[device_name]
+                for name in channels
+                for device_name in channels[name].devices]
+    operations = OrderedDict((
+        ('Channels.from_json', (Channels.from_json, channels_json)),
+        ('lookup', (lookup,)),
+        ('listing', (listing,)),
+        ('everything', (everything,)),
+        ))
+    results = OrderedDict()
+    results['file size'] = Bytes(len(channels_json))
+    for label, (function, *args) in operations.items():
+        results[label] = measure(function, *args, repeat=3)
+        results[label + ' peak'] = measure_memory(function, *args)
+    return results
+
+
+# Downloads.  A threaded, keep-alive HTTPS server supporting ranges and ETags
+# vends a signed synthetic update, and the client downloads it, both directly
+# through the download manager, and through the state machine with all its
+# signature checking.  Every scenario downloads the same total number of
+# bytes, in different numbers of files.
+DOWNLOAD_SCENARIOS = OrderedDict((
+    ('1x64MiB', (1, 64 * MiB)),
+    ('16x4MiB', (16, 4 * MiB)),
+    ('128x512KiB', (128, MiB // 2)),
+    ))
+DOWNLOAD_PORT = 8943
+# Simulated networks, as (path pattern, NetworkProfile arguments) pairs.
+# They're all slow but working ones, since a failed download has no
+# throughput to measure.
+NETWORKS = OrderedDict((
+    ('none', ()),
+    ('wifi', (
+        ('*', dict(latency=0.005, bandwidth=6 * MiB)),
+        )),
+    ('mobile', (
+        ('/pool/*', dict(latency=0.1, bandwidth=MiB, stalls=0.05,
+                         stall_seconds=2)),
+        ('*', dict(latency=0.1, bandwidth=MiB)),
+        )),
+    ))
+DEFAULT_NETWORK = 'none'
+# Set by the command line options.
+_network = dict(name=DEFAULT_NETWORK, seed=0)
+DOWNLOAD_INI = """\
+[service]
+base: localhost
+http_port: disabled
+https_port: {port}
+channel: benchmark
+device: benchmark
+build_number: 0
+
+[system]
+timeout: 1m
+tempdir: {tmpdir}/tmp
+logfile: {tmpdir}/client.log
+loglevel: error
+settings_db: {vardir}/settings.db
+
+[gpg]
+archive_master: {vardir}/etc/archive-master.tar.xz
+image_master: {vardir}/keyrings/image-master.tar.xz
+image_signing: {vardir}/keyrings/image-signing.tar.xz
+device_signing: {vardir}/keyrings/device-signing.tar.xz
+
+[updater]
+cache_partition: {vardir}/android/cache
+data_partition: {vardir}/ubuntu/cache
+
+[hooks]
+device: systemimage.device.SystemProperty
+scorer: systemimage.scores.WeightedScorer
+apply: systemimage.apply.Noop
+"""
+
+
+def _make_update(serverdir, files, size):
+    # Write a signed channels.json, index.json, keyrings, and a full update
+    # of `files` random (i.e. incompressible) files of `size` bytes each.
+    from systemimage.testing.helpers import setup_keyring_txz, sign
+    channels = dict(benchmark=dict(devices=dict(benchmark=dict(
+        index='/benchmark/benchmark/index.json'))))
+    records = []
+    os.makedirs(os.path.join(serverdir, 'pool'))
+    for order in range(1, files + 1):
+        path = '/pool/file-{}.bin'.format(order)
+        data = os.urandom(size)
+        with open(os.path.join(serverdir, path[1:]), 'wb') as fp:
+            fp.write(data)
+        sign(os.path.join(serverdir, path[1:]), 'image-signing.gpg')
+        records.append(dict(
+            checksum=hashlib.sha256(data).hexdigest(),
+            order=order,
+            path=path,
+            signature=path + '.asc',
+            size=size,
+            ))
+    index = dict(
+        images=[dict(type='full', version=1, description='Benchmark',
+                     files=records)],
+        **{'global': dict(generated_at='Mon Apr 29 18:45:27 UTC 2013')})
+    for path, contents in (('channels.json', channels),
+                           ('benchmark/benchmark/index.json', index)):
+        path = os.path.join(serverdir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as fp:
+            json.dump(contents, fp)
+        sign(path, 'image-signing.gpg')
+    for keyring, signing_keyring in (('image-master', 'archive-master'),
+                                     ('image-signing', 'image-master')):
+        setup_keyring_txz(
+            keyring + '.gpg', signing_keyring + '.gpg', dict(type=keyring),
+            os.path.join(serverdir, 'gpg', keyring + '.tar.xz'))
+    return records
+
+
+def _serve(serverdir, ready, stop):
+    # Run in a subprocess, so that the server's CPU time and system calls
+    # aren't charged to the client.
+    from systemimage.testing.helpers import (
+        NetworkConditions, NetworkProfile, make_http_server)
+    conditions = NetworkConditions(
+        [(pattern, NetworkProfile(**arguments))
+         for pattern, arguments in NETWORKS[_network['name']]],
+        seed=_network['seed'])
+    with make_http_server(serverdir, DOWNLOAD_PORT, 'cert.pem', 'key.pem',
+                          threaded=True, conditions=conditions):
+        ready.set()
+        stop.wait()
+
+
+def _syscalls():
+    # The read and write system calls made so far, which dominate a
+    # download.  Only Linux keeps count, and only of these.
+    try:
+        with open('/proc/self/io', encoding='utf-8') as fp:
+            counts = dict(line.split(':') for line in fp)
+    except OSError:
+        return 0
+    return int(counts['syscr']) + int(counts['syscw'])
+
+
+def _usage():
+    # Wall time, CPU time including gpg's, context switches (i.e. the
+    # process either blocking or being preempted; a good proxy for wakeups),
+    # and system calls.
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (perf_counter(),
+            own.ru_utime + own.ru_stime
+            + children.ru_utime + children.ru_stime,
+            own.ru_nvcsw + own.ru_nivcsw,
+            _syscalls())
+
+
+def _measure_download(function, total, repeat=3):
+    # Like measure(), but return the resource usage of the fastest run, and
+    # normalize it to the number of bytes downloaded.
+    best = None
+    for i in range(repeat):
+        before = _usage()
+        function()
+        usage = [after - before for before, after in zip(before, _usage())]
+        if best is None or usage[0] < best[0]:
+            best = usage
+    wall, cpu, wakeups, syscalls = best
+    gibs = total / 1024 ** 3
+    return OrderedDict((
+        ('MB/s', Rate(total / wall / 1e6)),
+        ('CPU s/GiB', cpu / gibs),
+        ('wakeups/GiB', Count(wakeups / gibs)),
+        ('syscalls/GiB', Count(syscalls / gibs)),
+        ))
+
+
+def _clear(*directories):
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def _download(scenario):
+    from systemimage.config import Configuration, config
+    from systemimage.download import Record, get_download_manager
+    from systemimage.state import State
+    from systemimage.testing.helpers import data_path, setup_keyrings
+    files, size = DOWNLOAD_SCENARIOS[scenario]
+    total = files * size
+    results = OrderedDict()
+    with ExitStack() as resources:
+        config_d = resources.enter_context(temporary_directory())
+        tmpdir = resources.enter_context(temporary_directory())
+        vardir = resources.enter_context(temporary_directory())
+        serverdir = resources.enter_context(temporary_directory())
+        with open(os.path.join(config_d, '00_benchmark.ini'), 'w',
+                  encoding='utf-8') as fp:
+            fp.write(DOWNLOAD_INI.format(
+                port=DOWNLOAD_PORT, tmpdir=tmpdir, vardir=vardir))
+        resources.enter_context(
+            patch('systemimage.config._config', Configuration(config_d)))
+        # Trust the server's self-signed certificate, and don't go looking
+        # for ubuntu-download-manager on the system bus.
+        def self_sign(c):
+            import pycurl
+            c.setopt(pycurl.CAINFO, data_path('cert.pem'))
+        resources.enter_context(
+            patch('systemimage.curl.make_testable', self_sign))
+        resources.enter_context(
+            patch.dict(os.environ, SYSTEMIMAGE_PYCURL='1'))
+        records = _make_update(serverdir, files, size)
+        setup_keyrings('archive-master')
+        context = multiprocessing.get_context('fork')
+        ready = context.Event()
+        stop = context.Event()
+        server = context.Process(
+            target=_serve, args=(serverdir, ready, stop), daemon=True)
+        server.start()
+        resources.callback(server.join)
+        resources.callback(stop.set)
+        if not ready.wait(30):
+            raise RuntimeError('The download server did not start')
+        destination = os.path.join(tmpdir, 'downloads')
+        downloads = []
+        for record in records:
+            for path, checksum in ((record['path'], record['checksum']),
+                                   (record['signature'], '')):
+                downloads.append(Record(
+                    config.https_base + path,
+                    os.path.join(destination, os.path.basename(path)),
+                    checksum))
+        def get_files():
+            _clear(destination)
+            get_download_manager().get_files(downloads, pausable=True)
+        for label, value in _measure_download(get_files, total).items():
+            results['get_files ' + label] = value
+        keyrings = os.path.dirname(config.gpg.image_master)
+        def run_until_apply():
+            # Start from scratch every time; nothing cached, and only the
+            # archive master keyring on the device.
+            _clear(config.updater.cache_partition,
+                   config.updater.data_partition, keyrings)
+            State().run_until('apply')
+        for label, value in _measure_download(
+                run_until_apply, total).items():
+            results['state ' + label] = value
+    return results
+
+
+def _download_benchmark(scenario):
+    def run():
+        return _download(scenario)
+    run.__name__ = 'download_' + scenario
+    return benchmark(run)
+
+
+for _scenario in DOWNLOAD_SCENARIOS:
+    _download_benchmark(_scenario)
+
+
+def _run(names):
+    results = OrderedDict()
+    for name in names:
+        print(name)
+        results[name] = BENCHMARKS[name]()
+        for label, value in results[name].items():
+            print('    {:<24} {}'.format(label, _format(value)))
+    return results
+
+
+def _format(value):
+    if isinstance(value, Bytes):
+        return '{:>12.1f} KiB'.format(value / 1024)
+    if isinstance(value, Count):
+        return '{:>12d}'.format(value)
+    if isinstance(value, Rate):
+        return '{:>12.1f} MB/s'.format(value)
+    return '{:>12.3f} ms'.format(value * 1000)
+
+
+def _kind(value):
+    # How a result is saved in the baseline.
+    if isinstance(value, Bytes):
+        return 'bytes'
+    if isinstance(value, Count):
+        return 'count'
+    if isinstance(value, Rate):
+        return 'rate'
+    return 'seconds'
+
+
+def _as_baseline(results):
+    baseline = dict(
+        version=BASELINE_VERSION,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        network=_network['name'],
+        seed=_network['seed'],
+        results={},
+        )
+    for name, measurements in results.items():
+        baseline['results'][name] = {
+            label: {_kind(value): (float(value)
+                                   if _kind(value) in ('rate', 'seconds')
+                                   else int(value))}
+            for label, value in measurements.items()
+            }
+    return baseline
+
+
+def _compare(results, baseline, threshold):
+    # Return the number of regressions.
+    regressions = 0
+    print('Compared to baseline (threshold: {}x)'.format(threshold))
+    for name, measurements in results.items():
+        saved = baseline['results'].get(name, {})
+        for label, value in measurements.items():
+            previous = saved.get(label)
+            if previous is None:
+                continue
+            previous = previous.get(_kind(value))
+            if not previous or not value:
+                continue
+            # A ratio above 1 is always worse than the baseline.
+            ratio = (previous / value
+                     if isinstance(value, Rate)
+                     else value / previous)
+            regressed = ratio > threshold
+            regressions += regressed
+            print('    {:<40} {:>6.2f}x{}'.format(
+                '{}: {}'.format(name, label), ratio,
+                '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m systemimage.testing.benchmarks',
+        description='Run the system-image benchmarks.')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help="""The benchmarks to run.  Defaults to all of
+                        them.""")
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List the available benchmarks and exit.')
+    parser.add_argument('--save', metavar='FILE',
+                        help="""Save the results to FILE as a JSON
+                        baseline.""")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="""Compare the results to the JSON baseline in
+                        FILE, exiting with a non-zero status if any of them
+                        regressed.""")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="""With --compare, the ratio to the baseline
+                        above which a result counts as a regression.  The
+                        default is %(default)s.""")
+    parser.add_argument('--network', choices=list(NETWORKS),
+                        default=DEFAULT_NETWORK,
+                        help="""The network to simulate in the download
+                        benchmarks.  The default is %(default)s.""")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="""The seed for the simulated network's random
+                        stalls.  The default is %(default)s.""")
+    args = parser.parse_args(argv)
+    _network.update(name=args.network, seed=args.seed)
+    if args.list:
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+    names = args.names if len(args.names) > 0 else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('No such benchmark: {}'.format(name))
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as fp:
+            baseline = json.load(fp)
+        if baseline.get('version') != BASELINE_VERSION:
+            parser.error('Unsupported baseline: {}'.format(args.compare))
+        if (baseline.get('network', DEFAULT_NETWORK),
+                baseline.get('seed', 0)) != (args.network, args.seed):
+            parser.error('Baseline was saved with a different network')
+    results = _run(names)
+    if args.save is not None:
+        with open(args.save, 'w', encoding='utf-8') as fp:
+            json.dump(_as_baseline(results), fp, indent=4, sort_keys=True)
+    if baseline is not None and _compare(results, baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':                          # pragma: no cover
+    sys.exit(main())
@@ -37,6 +37,8 @@ from systemimage.config import config
 from systemimage.dbus import Service, log_and_exit
 from systemimage.helpers import MiB, makedirs, safe_remove, version_detail
 from systemimage.logging import make_handler
+from systemimage.state import CHECK_FILE
+from systemimage.statistics import statistics
 from unittest.mock import patch
 
 
@@ -96,6 +98,12 @@ class _LiveTestableService(Service):
         self._failure_count = 0
         del config.build_number
         safe_remove(config.system.settings_db)
+        statistics.reset()
+        # Forget the last check, so the next one isn't resumed from it.
+        safe_remove(os.path.join(config.updater.data_partition, CHECK_FILE))
+        # The reloaded configuration may name different files.
+        self._watch_files()
+        self._invalidate_information()
 
     @log_and_exit
     @method('com.canonical.SystemImage')
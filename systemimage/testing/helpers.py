@@ -16,6 +16,8 @@
 """Test helpers."""
 
 __all__ = [
+    'NetworkConditions',
+    'NetworkProfile',
     'ServerTestBase',
     'chmod',
     'configuration',
@@ -41,33 +43,44 @@ __all__ = [
 
 
 import os
+import re
 import ssl
 import dbus
+import gzip
 import json
 import time
 import gnupg
+import random
+import struct
 import psutil
 import shutil
 import inspect
+import socketserver
 import tarfile
 import unittest
 
+from collections import Counter
 from contextlib import ExitStack, contextmanager, suppress
 from functools import partial, partialmethod, wraps
+from email.utils import formatdate
+from fnmatch import fnmatch
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+from io import BytesIO
 from pathlib import Path
 from pkg_resources import resource_filename, resource_string as resource_bytes
-from socket import SHUT_RDWR
+from socket import SHUT_RDWR, SOL_SOCKET, SO_LINGER
 from systemimage.channel import Channels
 from systemimage.config import Configuration, config
+from systemimage.facts import facts
 from systemimage.helpers import MiB, atomic, makedirs, temporary_directory
 from systemimage.index import Index
-from threading import Thread
+from threading import Lock, Thread
 from unittest.mock import patch
 
 
 EMPTYSTRING = ''
 SPACE = ' '
+CHUNK_SIZE = 64 * 1024
 
 
 def get_index(filename):
@@ -85,9 +98,115 @@ def data_path(filename):
    resource_filename('systemimage.tests.data', filename))
 
 
-def make_http_server(directory, port, certpem=None, keypem=None):
+class NetworkProfile:
+    """The simulated network conditions for some of the test server's files.
+
+    :param latency: Seconds to wait before answering each request.
+    :param bandwidth: If given, the maximum bytes per second to send the
+        response bodies at.
+    :param resets: The probability of the connection being reset, at a
+        random point in the response body.
+    :param stalls: The probability of the response body stalling, at a
+        random point, for `stall_seconds`.
+    :param stall_seconds: How long each stall lasts.
+    :param errors: The probability of a request starting a burst of server
+        errors.
+    :param error_burst: The number of consecutive requests in each burst,
+        including the one which started it.
+    :param error_status: The HTTP status code of the errors.
+    """
+
+    def __init__(self, *, latency=0, bandwidth=None, resets=0, stalls=0,
+                 stall_seconds=1, errors=0, error_burst=1, error_status=503):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.resets = resets
+        self.stalls = stalls
+        self.stall_seconds = stall_seconds
+        self.errors = errors
+        self.error_burst = error_burst
+        self.error_status = error_status
+
+
+class _Plan:
+    # What happens to one request.  The offsets are fractions of the body.
+    def __init__(self, profile, rng, in_burst):
+        self.latency = profile.latency
+        self.bandwidth = profile.bandwidth
+        self.status = profile.error_status if in_burst else None
+        self.stall_seconds = profile.stall_seconds
+        self.reset_at = (
+            rng.random() if rng.random() < profile.resets else None)
+        self.stall_at = (
+            rng.random() if rng.random() < profile.stalls else None)
+
+
+class NetworkConditions:
+    """Simulated network conditions for the test server, by path pattern.
+
+    Whatever happens to a request depends only on the seed, its path, and
+    how many requests for that path came before it, so a test or benchmark
+    sees the same network every time it runs, even though the server
+    handles connections in parallel.
+
+    :param profiles: A sequence of 2-tuples of shell-style path patterns,
+        e.g. ``/pool/*.tar.xz``, and the `NetworkProfile` for matching paths.
+        The first matching pattern wins, and paths matching none of them are
+        served normally.
+    :param seed: The seed for the random resets, stalls, and errors.
+    """
+
+    def __init__(self, profiles=(), *, seed=0):
+        self._profiles = list(profiles)
+        self._seed = seed
+        self._lock = Lock()
+        self._requests = Counter()
+        self._bursts = Counter()
+
+    def add(self, pattern, profile):
+        """Add a profile for paths matching `pattern`, after the others."""
+        with self._lock:
+            self._profiles.append((pattern, profile))
+
+    def plan(self, path):
+        """Return what will happen to the next request for `path`.
+
+        :param path: The request path, with any query string.
+        :return: The plan, or None if the path is served normally.
+        """
+        path = path.partition('?')[0]
+        for pattern, profile in self._profiles:
+            if fnmatch(path, pattern):
+                break
+        else:
+            return None
+        with self._lock:
+            count = self._requests[path]
+            self._requests[path] += 1
+            rng = random.Random('{}:{}:{}'.format(self._seed, path, count))
+            # Bursts of errors are shared by all the paths matching a
+            # pattern, the way a backend falling over would be.
+            in_burst = self._bursts[pattern] > 0
+            if in_burst:
+                self._bursts[pattern] -= 1
+            elif rng.random() < profile.errors:
+                in_burst = True
+                self._bursts[pattern] = profile.error_burst - 1
+        return _Plan(profile, rng, in_burst)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only available in Python 3.7 and
+    # newer.
+    daemon_threads = True
+
+
+def make_http_server(directory, port, certpem=None, keypem=None, *,
+                     threaded=False, conditions=None):
     """Create an HTTP/S server to vend from the file system.
 
+    Files are served with ETags, and single byte ranges are supported.
+
     :param directory: The file system directory to vend files from.
     :param port: The port to listen on for the server.
     :param certpem: For HTTPS servers, the path to the certificate PEM file.
@@ -96,6 +215,11 @@ def make_http_server(directory, port, certpem=None, keypem=None):
     :param keypem: For HTTPS servers, the path to the key PEM file.  If the
         file name does not start with a slash, it is considered relative to
         the test data directory.
+    :param threaded: If true, handle each connection in its own thread and
+        keep connections alive between requests (i.e. HTTP/1.1), as a real
+        server would.  This is what the benchmarks use.  Otherwise, requests
+        are handled one at a time, with one request per connection.
+    :param conditions: If given, the `NetworkConditions` to simulate.
     :return: A context manager that when closed, stops the server.
     """
     # We need an HTTP/S server to vend the file system, or at least parts of
@@ -106,15 +230,148 @@ def make_http_server(directory, port, certpem=None, keypem=None):
         # The base class hardcodes the use of os.getcwd() to vend the
         # files from, but we want to be able to pass in any directory.  I
         # suppose we could chdir in the server thread, but let's hack the
-        # path instead.
+        # path instead.  Newer Pythons vend from self.directory instead.
         def translate_path(self, path):
+            self.directory = directory
             with patch('http.server.os.getcwd', return_value=directory):
                 return super().translate_path(path)
 
+        if threaded:
+            protocol_version = 'HTTP/1.1'
+
         def log_message(self, *args, **kws):
             # Please shut up.
             pass
 
+        def _send_file(self, *, head):
+            # Like SimpleHTTPRequestHandler.send_head() and copyfile(), but
+            # with ETag and Range support, and simulated network conditions.
+            # Return False if this isn't a regular file, in which case the
+            # base class takes over.
+            plan = None if conditions is None else conditions.plan(self.path)
+            if plan is not None:
+                time.sleep(plan.latency)
+                if plan.status is not None:
+                    self.send_response(plan.status)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return True
+            path = self.translate_path(self.path)
+            if not os.path.isfile(path):
+                return False
+            info = os.stat(path)
+            size = info.st_size
+            etag = '"{:x}-{:x}"'.format(size, info.st_mtime_ns)
+            byte_range = self.headers.get('Range')
+            # Like a real server, compress JSON files on the fly for clients
+            # which accept it.  This is a different representation of the
+            # file, so it gets a different ETag.
+            body = None
+            if (path.endswith('.json') and byte_range is None and
+                    'gzip' in self.headers.get('Accept-Encoding', '')):
+                with open(path, 'rb') as fp:
+                    body = gzip.compress(fp.read())
+                size = len(body)
+                etag = etag[:-1] + '-gzip"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return True
+            start, end = 0, size - 1
+            status = 200
+            if_range = self.headers.get('If-Range')
+            if byte_range is not None and if_range in (None, etag):
+                mo = re.fullmatch(r'bytes=(\d*)-(\d*)', byte_range.strip())
+                if mo is not None and any(mo.groups()):
+                    first, last = mo.groups()
+                    if first == '':
+                        # A suffix range, i.e. the last N bytes.
+                        start = max(0, size - int(last))
+                    else:
+                        start = int(first)
+                        if last != '':
+                            end = min(end, int(last))
+                    if start >= size or start > end:
+                        self.send_response(416)
+                        self.send_header(
+                            'Content-Range', 'bytes */{}'.format(size))
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return True
+                    status = 206
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(length))
+            self.send_header('Last-Modified',
+                             formatdate(info.st_mtime, usegmt=True))
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            if path.endswith('.json'):
+                self.send_header('Vary', 'Accept-Encoding')
+            if body is not None:
+                self.send_header('Content-Encoding', 'gzip')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, end, size))
+            self.end_headers()
+            if head:
+                return True
+            with (open(path, 'rb') if body is None else BytesIO(body)) as fp:
+                fp.seek(start)
+                if plan is None:
+                    while length > 0:
+                        chunk = fp.read(min(CHUNK_SIZE, length))
+                        if len(chunk) == 0:
+                            break
+                        self.wfile.write(chunk)
+                        length -= len(chunk)
+                else:
+                    self._send_body(fp, length, plan)
+            return True
+
+        def _send_body(self, fp, length, plan):
+            chunk_size = CHUNK_SIZE
+            if plan.bandwidth is not None:
+                # About ten writes a second, so the rate is smooth.
+                chunk_size = max(1, min(chunk_size, plan.bandwidth // 10))
+            reset_at = (None if plan.reset_at is None
+                        else int(length * plan.reset_at))
+            stall_at = (None if plan.stall_at is None
+                        else int(length * plan.stall_at))
+            sent = 0
+            started = time.monotonic()
+            while sent < length:
+                if reset_at is not None and sent >= reset_at:
+                    # Send a TCP RST instead of a FIN.
+                    self.wfile.flush()
+                    self.connection.setsockopt(
+                        SOL_SOCKET, SO_LINGER, struct.pack('ii', 1, 0))
+                    self.connection.close()
+                    self.close_connection = True
+                    return
+                if stall_at is not None and sent >= stall_at:
+                    self.wfile.flush()
+                    time.sleep(plan.stall_seconds)
+                    stall_at = None
+                size = min(chunk_size, length - sent)
+                for offset in (reset_at, stall_at):
+                    if offset is not None and offset > sent:
+                        size = min(size, offset - sent)
+                chunk = fp.read(size)
+                if len(chunk) == 0:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if plan.bandwidth is not None:
+                    ahead = sent / plan.bandwidth - (
+                        time.monotonic() - started)
+                    if ahead > 0:
+                        self.wfile.flush()
+                        time.sleep(ahead)
+
         def handle_one_request(self):
             try:
                 super().handle_one_request()
@@ -125,12 +382,14 @@ def make_http_server(directory, port, certpem=None, keypem=None):
             # Just tell the client we have the magic file.
             if self.path == '/user-agent.txt':
                 self.send_response(200)
+                self.send_header('Content-Length', '0')
                 self.end_headers()
             else:
                 # Canceling a download can cause our internal server to
                 # see various ignorable errors.  No worries.
                 with suppress(BrokenPipeError, ConnectionResetError):
-                    super().do_HEAD()
+                    if not self._send_file(head=True):
+                        super().do_HEAD()
 
         def do_GET(self):
             # If we requested the magic 'user-agent.txt' file, send back the
@@ -138,14 +397,17 @@ def make_http_server(directory, port, certpem=None, keypem=None):
             if self.path == '/user-agent.txt':
                 self.send_response(200)
                 self.send_header('Content-Type', 'text/plain')
-                user_agent = self.headers.get('user-agent', 'no agent')
+                user_agent = self.headers.get(
+                    'user-agent', 'no agent').encode('utf-8')
+                self.send_header('Content-Length', str(len(user_agent)))
                 self.end_headers()
-                self.wfile.write(user_agent.encode('utf-8'))
+                self.wfile.write(user_agent)
             else:
                 # Canceling a download can cause our internal server to
                 # see various ignorable errors.  No worries.
                 with suppress(BrokenPipeError, ConnectionResetError):
-                    super().do_GET()
+                    if not self._send_file(head=False):
+                        super().do_GET()
     # Create the server in the main thread, but start it in the sub-thread.
     # This lets the main thread call .shutdown() to stop everything.  Return
     # just the shutdown method to the caller.
@@ -169,7 +431,9 @@ def make_http_server(directory, port, certpem=None, keypem=None):
     # the Qt networking stack, causing huge slowdowns on our test teardown
     # methods.
     connections = []
-    class Server(HTTPServer):
+    class Server(_ThreadingHTTPServer if threaded else HTTPServer):
+        daemon_threads = True
+
         def get_request(self):
             conn, addr = super().get_request()
             connections.append(conn)
@@ -254,7 +518,7 @@ def _wrapper(self, function, ini_files, *args, **kws):
     start = 0
     # It would be preferable to simply add a device='nexus7' argument, but that
     # causes 'decorator() takes 1 positional argument but 2 were given'
-    device = kws.get('device', 'nexus7')
+    device = kws.pop('device', 'nexus7')
     with ExitStack() as resources:
         # Create the config.d directory and copy all the source ini files to
         # this directory in sequential order, interpolating in the temporary
@@ -279,6 +543,10 @@ def _wrapper(self, function, ini_files, *args, **kws):
         resources.enter_context(
             patch('systemimage.device.check_output',
                   return_value=device))
+        # Forget everything learned about the host in other tests, some of
+        # which patch how it's learned.
+        facts.invalidate()
+        resources.callback(facts.invalidate)
         # Make sure the cache_partition and data_partition exist.
         makedirs(config.updater.cache_partition)
         makedirs(config.updater.data_partition)
@@ -291,7 +559,7 @@ def _wrapper(self, function, ini_files, *args, **kws):
         if 'config' in signature.parameters:
             kws['config'] = config
         # Call the function with the given arguments and return the result.
-        return function(self, *args)
+        return function(self, *args, **kws)
 
 
 def configuration(*args, **kwargs):
@@ -0,0 +1,143 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic index.json and channels.json files, of any size.
+
+These are for the benchmarks, which need realistic server data much bigger
+than the hand written test data files.  The output is deterministic for any
+given set of arguments.
+"""
+
+__all__ = [
+    'make_channels',
+    'make_index',
+    ]
+
+
+import json
+import random
+
+from systemimage.helpers import MiB
+
+
+GENERATED_AT = 'Mon Apr 29 18:45:27 UTC 2013'
+
+
+def _locales(count):
+    # aa, ab, ... az, ba, ...
+    return ['{}{}'.format(chr(97 + i // 26 % 26), chr(97 + i % 26))
+            for i in range(count)]
+
+
+def _image(rng, image_type, version, files_per_image, locales, base=None):
+    name = ('{}-{}'.format(image_type, version)
+            if base is None
+            else '{}-{}-{}'.format(image_type, base, version))
+    image = dict(
+        type=image_type,
+        version=version,
+        description='{} {}'.format(image_type.capitalize(), version),
+        files=[],
+        )
+    if base is not None:
+        image['base'] = base
+    for locale in locales:
+        image['description-' + locale] = '{} {} ({})'.format(
+            image_type.capitalize(), version, locale)
+    for order in range(1, files_per_image + 1):
+        path = '/pool/{}-{}.tar.xz'.format(name, order)
+        image['files'].append(dict(
+            checksum='{:064x}'.format(rng.getrandbits(256)),
+            order=order,
+            path=path,
+            signature=path + '.asc',
+            # Fulls are much bigger than deltas.
+            size=(rng.randint(100, 300) * MiB
+                  if image_type == 'full'
+                  else rng.randint(1, 50) * MiB),
+            ))
+    return image
+
+
+def make_index(*, fulls=2, delta_chain=10, fork_factor=1, files_per_image=3,
+               locales=0, seed=0):
+    """Return the contents of a synthetic index.json file.
+
+    The images form a ladder of consecutive versions starting at 1.  Every
+    version after the first can be reached by a delta from each of the
+    `fork_factor` versions before it, and there's a full image every
+    `delta_chain` + 1 versions.  A device at version 1 thus has candidate
+    upgrade paths through every full image and every combination of deltas;
+    with a `fork_factor` of 2, the number of delta paths grows like the
+    Fibonacci numbers.
+
+    :param fulls: The number of full images.
+    :param delta_chain: The number of versions between full images.
+    :param fork_factor: The number of deltas leading to each version.
+    :param files_per_image: The number of file records in each image.
+    :param locales: The number of translated descriptions in each image.
+    :param seed: The seed for the file checksums and sizes.
+    :return: The JSON text.
+    """
+    rng = random.Random(seed)
+    locale_codes = _locales(locales)
+    images = []
+    last_version = fulls * (delta_chain + 1)
+    for version in range(1, last_version + 1):
+        if (version - 1) % (delta_chain + 1) == 0:
+            images.append(
+                _image(rng, 'full', version, files_per_image, locale_codes))
+        for base in range(max(1, version - fork_factor), version):
+            images.append(_image(rng, 'delta', version, files_per_image,
+                                 locale_codes, base=base))
+    return json.dumps(dict(
+        **{'global': dict(generated_at=GENERATED_AT)},
+        images=images,
+        ))
+
+
+def make_channels(*, channels=5, devices=10, hidden=1, aliases=1,
+                  keyrings=True):
+    """Return the contents of a synthetic channels.json file.
+
+    Every channel supports every device, with every other device having a
+    device signing keyring if `keyrings` is true.  The first `hidden`
+    channels are hidden, and the last `aliases` channels are aliases of the
+    first channel.
+
+    :param channels: The number of channels.
+    :param devices: The number of devices.
+    :param hidden: The number of hidden channels.
+    :param aliases: The number of alias channels.
+    :param keyrings: Whether some devices have device signing keyrings.
+    :return: The JSON text.
+    """
+    mapping = {}
+    channel_names = ['channel-{}'.format(i) for i in range(channels)]
+    device_names = ['device-{}'.format(i) for i in range(devices)]
+    for i, channel in enumerate(channel_names):
+        device_mapping = {}
+        for j, device in enumerate(device_names):
+            entry = dict(index='/{}/{}/index.json'.format(channel, device))
+            if keyrings and j % 2 == 0:
+                path = '/{}/{}/device-signing.tar.xz'.format(channel, device)
+                entry['keyring'] = dict(path=path, signature=path + '.asc')
+            device_mapping[device] = entry
+        mapping[channel] = dict(devices=device_mapping)
+        if i < hidden:
+            mapping[channel]['hidden'] = True
+        if i >= channels - aliases and i > 0:
+            mapping[channel]['alias'] = channel_names[0]
+    return json.dumps(mapping)
@@ -62,6 +62,21 @@ class TestAPI(ServerTestBase):
         self.assertTrue(update_2.is_available)
         self.assertIs(update_1, update_2)
 
+    @configuration
+    def test_update_available_resumed(self):
+        # A later process, e.g. after the D-Bus service exits, resumes from
+        # the check made by an earlier one.
+        self._setup_server_keyrings()
+        self.assertIsNone(Mediator().resume_check())
+        self.assertTrue(Mediator().check_for_update().is_available)
+        mediator = Mediator()
+        with patch('systemimage.state.State.run_until') as mock:
+            update = mediator.resume_check()
+        self.assertEqual(mock.call_count, 0)
+        self.assertTrue(update.is_available)
+        self.assertEqual(update.version, '1600')
+        self.assertIs(mediator.check_for_update(), update)
+
     @configuration
     def test_update_available_version(self):
         # An update is available.  What's the target version number?
@@ -174,7 +189,8 @@ unmount system
             'image-signing.tar.xz.asc',
             'ubuntu_command',
             ]))
-        # And the blacklist keyring is available too.
+        # And the blacklist keyring is available too.  The saved check was
+        # forgotten when the cache partition was cleaned for the download.
         self.assertEqual(set(os.listdir(config.updater.data_partition)), set([
             'blacklist.tar.xz',
             'blacklist.tar.xz.asc',
@@ -229,6 +245,22 @@ unmount system
         mediator.cancel()
         self.assertRaises(Canceled, mediator.download)
 
+    @configuration
+    def test_resume_after_cancel(self):
+        # A canceled download doesn't throw away the check, so a later
+        # process can still resume from it.
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        mediator.check_for_update()
+        mediator.cancel()
+        self.assertRaises(Canceled, mediator.download)
+        mediator = Mediator()
+        with patch('systemimage.state.State.run_until') as mock:
+            update = mediator.resume_check()
+        self.assertEqual(mock.call_count, 0)
+        self.assertTrue(update.is_available)
+        self.assertEqual(update.version, '1600')
+
     @configuration
     def test_callback(self):
         # When downloading, we get callbacks.
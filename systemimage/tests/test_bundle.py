@@ -0,0 +1,212 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test offline update bundles."""
+
+__all__ = [
+    'TestBundle',
+    'TestBundleDownloadManager',
+    'TestExportSideload',
+    ]
+
+
+import os
+import hashlib
+import unittest
+
+from contextlib import ExitStack
+from systemimage.bundle import (
+    BundleDownloadManager, BundleReader, BundleWriter, export)
+from systemimage.config import config
+from systemimage.download import Record, get_download_manager
+from systemimage.helpers import safe_remove, temporary_directory
+from systemimage.state import State
+from systemimage.testing.helpers import (
+    ServerTestBase, configuration, touch_build)
+from unittest.mock import patch
+
+
+def _url(name):
+    return 'http://localhost:8980/' + name
+
+
+class _BundleTestBase(unittest.TestCase):
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self.tmpdir = self._resources.enter_context(temporary_directory())
+        self.bundle_path = os.path.join(self.tmpdir, 'update.bundle')
+
+    def _write(self, files, manifest=None):
+        # Write a bundle from a dictionary mapping server paths to contents.
+        writer = BundleWriter(self.bundle_path)
+        for i, (name, contents) in enumerate(files.items()):
+            path = os.path.join(self.tmpdir, 'file-{}'.format(i))
+            with open(path, 'wb') as fp:
+                fp.write(contents)
+            writer.add(path, name)
+        writer.close({} if manifest is None else manifest)
+        bundle = BundleReader(self.bundle_path)
+        self.addCleanup(bundle.close)
+        return bundle
+
+
+class TestBundle(_BundleTestBase):
+    def test_round_trip(self):
+        bundle = self._write({
+            'channels.json': b'{}',
+            'stable/nexus7/index.json': b'{"images": []}',
+            }, manifest=dict(channel='stable'))
+        self.assertEqual(bytes(bundle.view('channels.json')), b'{}')
+        self.assertEqual(bytes(bundle.view('stable/nexus7/index.json')),
+                         b'{"images": []}')
+        self.assertEqual(bundle.manifest, dict(channel='stable'))
+        self.assertIn('channels.json', bundle)
+        self.assertNotIn('gpg/blacklist.tar.xz', bundle)
+        self.assertRaises(KeyError, bundle.view, 'gpg/blacklist.tar.xz')
+
+    def test_last_one_wins(self):
+        # A file recorded twice, e.g. because it changed on the server during
+        # the export, is read back as it was last recorded.
+        writer = BundleWriter(self.bundle_path)
+        path = os.path.join(self.tmpdir, 'channels.json')
+        for contents in ('first', 'second'):
+            with open(path, 'w', encoding='utf-8') as fp:
+                fp.write(contents)
+            writer.add(path, 'channels.json')
+        writer.close({})
+        bundle = BundleReader(self.bundle_path)
+        self.addCleanup(bundle.close)
+        self.assertEqual(bytes(bundle.view('channels.json')), b'second')
+
+    def test_abort(self):
+        # An aborted bundle leaves nothing behind.
+        writer = BundleWriter(self.bundle_path)
+        writer.abort()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_not_a_bundle(self):
+        with open(self.bundle_path, 'wb') as fp:
+            fp.write(b'x' * 1024)
+        self.assertRaises(ValueError, BundleReader, self.bundle_path)
+
+
+class TestBundleDownloadManager(_BundleTestBase):
+    def setUp(self):
+        super().setUp()
+        self.destdir = self._resources.enter_context(temporary_directory())
+        self.bundle = self._write({
+            'stable/a.txt': b'a' * 1000,
+            'stable/a.txt.asc': b'signature',
+            })
+
+    def _dst(self, filename):
+        return os.path.join(self.destdir, filename)
+
+    def test_get_files(self):
+        received = []
+        downloader = BundleDownloadManager(
+            self.bundle, lambda *args: received.append(args))
+        downloader.get_files([
+            Record(_url('stable/a.txt'), self._dst('a.txt'),
+                   hashlib.sha256(b'a' * 1000).hexdigest()),
+            (_url('stable/a.txt.asc'), self._dst('a.txt.asc')),
+            ])
+        with open(self._dst('a.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'a' * 1000)
+        with open(self._dst('a.txt.asc'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'signature')
+        self.assertEqual(received[-1], (1009, 1009))
+
+    def test_no_statistics(self):
+        # Copying out of the bundle doesn't count as downloading.
+        downloader = BundleDownloadManager(self.bundle)
+        with patch('systemimage.download.statistics') as mock:
+            downloader.get_files([
+                (_url('stable/a.txt'), self._dst('a.txt')),
+                ], pausable=True)
+        self.assertEqual(mock.mock_calls, [])
+
+    def test_missing(self):
+        # Files which aren't in the bundle aren't found, just like files
+        # which aren't on the server.
+        downloader = BundleDownloadManager(self.bundle)
+        with self.assertRaises(FileNotFoundError):
+            downloader.get_files([
+                (_url('stable/a.txt'), self._dst('a.txt')),
+                (_url('gpg/blacklist.tar.xz'), self._dst('blacklist.tar.xz')),
+                ])
+        self.assertEqual(os.listdir(self.destdir), [])
+
+    def test_checksum_mismatch(self):
+        downloader = BundleDownloadManager(self.bundle)
+        with self.assertRaises(FileNotFoundError):
+            downloader.get_files([
+                (_url('stable/a.txt.asc'), self._dst('a.txt.asc')),
+                Record(_url('stable/a.txt'), self._dst('a.txt'), 'bogus'),
+                ])
+        self.assertEqual(os.listdir(self.destdir), [])
+
+    @configuration
+    def test_sideload_download_manager(self):
+        # While sideloading, all downloads come from the bundle.
+        config.sideload_bundle = self.bundle
+        downloader = get_download_manager()
+        self.assertIsInstance(downloader, BundleDownloadManager)
+        self.assertIs(downloader.bundle, self.bundle)
+
+    @configuration
+    def test_export_records(self):
+        # While exporting, all downloads are recorded in the new bundle.
+        path = os.path.join(self.tmpdir, 'exported.bundle')
+        config.export_bundle = BundleWriter(path)
+        BundleDownloadManager(self.bundle).get_files([
+            (_url('stable/a.txt'), self._dst('a.txt')),
+            ])
+        config.export_bundle.close({})
+        exported = BundleReader(path)
+        self.addCleanup(exported.close)
+        self.assertEqual(bytes(exported.view('stable/a.txt')), b'a' * 1000)
+
+
+class TestExportSideload(ServerTestBase):
+    INDEX_FILE = 'state.index_03.json'
+    CHANNEL_FILE = 'state.channels_02.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+
+    @configuration
+    def test_export_sideload(self):
+        self._setup_server_keyrings()
+        touch_build(0)
+        config.channel = 'stable'
+        config.device = 'nexus7'
+        bundle_path = os.path.join(config.tempdir, 'update.bundle')
+        winner = export(bundle_path)
+        self.assertEqual([image.version for image in winner], [1600])
+        # Shut down the server.  Sideloading doesn't need it.
+        self._resources.close()
+        # Start with nothing, like a factory fresh device.
+        for name in ('image_master', 'image_signing', 'device_signing'):
+            safe_remove(getattr(config.gpg, name))
+        config.sideload_bundle = BundleReader(bundle_path)
+        self.addCleanup(config.sideload_bundle.close)
+        state = State()
+        state.run_thru('download_files')
+        self.assertEqual([image.version for image in state.winner], [1600])
+        cache_dir = config.updater.cache_partition
+        for path, order in state.files:
+            self.assertTrue(os.path.exists(path),
+                            os.path.relpath(path, cache_dir))
@@ -19,6 +19,7 @@ __all__ = [
     'TestCandidateDownloads',
     'TestCandidateFilters',
     'TestCandidates',
+    'TestIterCandidates',
     'TestNewVersionRegime',
     ]
 
@@ -26,11 +27,16 @@ __all__ = [
 import unittest
 
 from operator import attrgetter
+from systemimage.bag import Bag
 from systemimage.candidates import (
-    delta_filter, full_filter, get_candidates, iter_path)
+    _Chaser, _Step, delta_filter, full_filter, get_candidates,
+    iter_candidates, iter_path)
+from systemimage.index import Index
 from systemimage.scores import WeightedScorer
 from systemimage.testing.helpers import (
     configuration, descriptions, get_index)
+from systemimage.testing.synthetic import make_index
+from unittest.mock import patch
 
 
 class TestCandidates(unittest.TestCase):
@@ -164,6 +170,108 @@ class TestCandidates(unittest.TestCase):
         self.assertEqual(descriptions, ['Full 1', 'Delta 1', 'Delta 3'])
 
 
+class TestIterCandidates(unittest.TestCase):
+    def setUp(self):
+        # Versions 1 through 21, each reachable by a delta from each of the
+        # two versions before it.  From version 1 there are 10946 paths, the
+        # shortest of which takes 10 deltas.
+        self.index = Index.from_json(
+            make_index(fulls=1, delta_chain=20, fork_factor=2))
+
+    def _paths(self, **limits):
+        with patch('systemimage.candidates.log') as log:
+            paths = list(iter_candidates(self.index, 1, **limits))
+        messages = [call[0][0] for call in log.info.call_args_list]
+        return paths, messages
+
+    def test_unlimited(self):
+        paths, messages = self._paths(
+            max_paths=None, max_depth=None, beam_width=None)
+        self.assertEqual(len(paths), 10946)
+        self.assertEqual(messages, [])
+        # Every path is different, and reaches the latest version.
+        self.assertEqual(
+            len(set(tuple(image.base for image in path) for path in paths)),
+            10946)
+        self.assertTrue(all(path[-1].version == 21 for path in paths))
+
+    def test_lazy(self):
+        # Paths are generated as they're asked for.
+        candidates = iter_candidates(self.index, 1)
+        path = next(candidates)
+        self.assertEqual(path[-1].version, 21)
+        candidates.close()
+
+    def test_max_paths(self):
+        # By default, only the first 1000 paths are generated.
+        paths, messages = self._paths()
+        self.assertEqual(len(paths), 1000)
+        self.assertIn('Stopped at {} candidate paths, {} unexplored',
+                      messages)
+        paths, messages = self._paths(max_paths=10)
+        self.assertEqual(len(paths), 10)
+
+    def test_max_depth(self):
+        # Paths longer than the maximum depth are dropped, rather than cut
+        # short, since they wouldn't reach the latest version.  There's one
+        # path of 10 deltas, and 55 paths of 11.
+        paths, messages = self._paths(max_paths=None, max_depth=11)
+        self.assertEqual(len(paths), 56)
+        self.assertTrue(all(path[-1].version == 21 for path in paths))
+        self.assertIn('Dropped {} candidate paths longer than {} images',
+                      messages)
+        # When every path is too long, there are no candidates.
+        paths, messages = self._paths(max_paths=None, max_depth=5)
+        self.assertEqual(paths, [])
+
+    def test_beam_width(self):
+        # Only the best scoring forks are remembered for later.  When deltas
+        # which skip a version score better, the path which skips the most
+        # versions survives the pruning.
+        def skip_versions(image):
+            return 0 if image.version - image.base > 1 else 1
+        paths, messages = self._paths(
+            score=skip_versions, max_paths=None, beam_width=1)
+        self.assertLess(len(paths), 20)
+        self.assertEqual(min(len(path) for path in paths), 10)
+        self.assertIn('Pruned {} candidate paths beyond the beam width of {}',
+                      messages)
+
+    def test_beam_width_needs_score(self):
+        # Without a score, there's no telling which forks are worst, so none
+        # are dropped.
+        paths, messages = self._paths(max_paths=None, beam_width=1)
+        self.assertEqual(len(paths), 10946)
+        self.assertEqual(messages, [])
+
+    def test_beam_width_ties(self):
+        # Of the forks which score the same, the one which has gotten the
+        # least far is dropped, rather than the one pushed last.
+        chaser = _Chaser(1)
+        for version in (3, 2):
+            chaser.push(_Step(Bag(version=version), None, lambda image: 0))
+        self.assertEqual([step.image.version for step in chaser], [3])
+        self.assertEqual(chaser.pruned, 1)
+
+    def test_get_candidates_unlimited(self):
+        # Unlike iter_candidates(), get_candidates() has no limits by
+        # default.
+        self.assertEqual(len(get_candidates(self.index, 1)), 10946)
+
+    def test_choose_from_iterator(self):
+        # Scorers can consume the paths as they're generated.
+        scorer = WeightedScorer()
+        winner = scorer.choose(
+            iter_candidates(self.index, 1, score=scorer.running_score),
+            'devel')
+        self.assertEqual(winner[-1].version, 21)
+
+    def test_same_as_get_candidates(self):
+        index = get_index('candidates.index_13.json')
+        self.assertEqual(list(iter_candidates(index, 0)),
+                         get_candidates(index, 0))
+
+
 class TestCandidateDownloads(unittest.TestCase):
     maxDiff = None
 
@@ -20,16 +20,19 @@ __all__ = [
     'TestLoadChannel',
     'TestLoadChannelOverHTTPS',
     'TestChannelsNewFormat',
+    'TestLazyChannels',
     ]
 
 
 import os
+import pickle
 import shutil
 import hashlib
 import unittest
 
 from contextlib import ExitStack
-from operator import getitem
+from operator import getitem, setitem
+from systemimage.channel import Channels
 from systemimage.config import Configuration
 from systemimage.gpg import SignatureError
 from systemimage.helpers import temporary_directory
@@ -282,3 +285,73 @@ class TestChannelsNewFormat(unittest.TestCase):
         # Trying to get a channel via getitem which doesn't exist.
         channels = get_channels('channel.channels_04.json')
         self.assertRaises(KeyError, getitem, channels, 'daily-testing')
+
+
+class TestLazyChannels(unittest.TestCase):
+    """Channels and devices are only parsed when they're looked up."""
+
+    def test_nothing_built(self):
+        # Iterating over the channels builds none of them.
+        channels = get_channels('channel.channels_04.json')
+        self.assertEqual(sorted(channels),
+                         ['daily', 'saucy', 'saucy-proposed'])
+        self.assertIn('saucy-proposed', channels)
+        self.assertNotIn('bleeding', channels)
+        self.assertEqual(channels.__untranslated__, {})
+
+    def test_one_device_built(self):
+        # Looking up a device only builds that device, in that channel.
+        channels = get_channels('channel.channels_04.json')
+        devices = channels['saucy'].devices
+        self.assertEqual(list(channels.__untranslated__), ['saucy'])
+        self.assertEqual(devices.manta.keyring.path,
+                         '/saucy/manta/device-signing.tar.xz')
+        self.assertEqual(list(devices.__untranslated__), ['manta'])
+        self.assertIn('mako', devices)
+        self.assertEqual(list(devices.__untranslated__), ['manta'])
+
+    def test_lookups_agree(self):
+        # Attributes, items, and get() all give the same objects.
+        channels = get_channels('channel.channels_04.json')
+        channel = channels.saucy_proposed
+        self.assertIs(channels['saucy-proposed'], channel)
+        self.assertIs(channels.get('saucy_proposed'), channel)
+        self.assertIs(channel.devices.get('mako'), channel.devices['mako'])
+        self.assertIsNone(channels.get('bleeding'))
+
+    def test_immutable(self):
+        channels = get_channels('channel.channels_04.json')
+        self.assertRaises(ValueError, setitem, channels, 'daily', None)
+
+    def test_incremental(self):
+        # Incremental indexes are listed next to the full index.
+        channels = Channels.from_json("""{
+            "daily": {"devices": {"mako": {
+                "index": "/daily/mako/index.json",
+                "incremental": [
+                    {"since": 300, "index": "/daily/mako/index-300.json"}
+                    ]
+                }}}
+            }""")
+        device = channels.daily.devices.mako
+        self.assertEqual(device.incremental[0].since, 300)
+        self.assertEqual(device.incremental[0].index,
+                         '/daily/mako/index-300.json')
+        self.assertIsNone(getattr(device, 'keyring', None))
+
+    def test_installable(self):
+        # The channels a device can be installed from.
+        channels = get_channels('channel.channels_01.json')
+        self.assertEqual(channels.installable('nexus7'), ['daily', 'stable'])
+        self.assertEqual(channels.installable('nexus4'), ['daily'])
+        self.assertEqual(channels.installable('nexus3'), [])
+        self.assertEqual(channels.__untranslated__, {})
+
+    def test_pickle(self):
+        channels = get_channels('channel.channels_04.json')
+        channels.daily.devices.grouper
+        new_channels = pickle.loads(pickle.dumps(channels))
+        self.assertEqual(new_channels.saucy.devices.manta.keyring.signature,
+                         '/saucy/manta/device-signing.tar.xz.asc')
+        self.assertEqual(new_channels.installable('mako'),
+                         ['daily', 'saucy', 'saucy-proposed'])
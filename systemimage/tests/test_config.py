@@ -17,11 +17,13 @@
 
 __all__ = [
     'TestConfiguration',
+    'TestConfigurationSnapshot',
     ]
 
 
 import os
 import sys
+import json
 import stat
 import shutil
 import logging
@@ -31,7 +33,8 @@ from contextlib import ExitStack, contextmanager
 from datetime import timedelta
 from subprocess import CalledProcessError, check_output
 from systemimage.apply import Reboot
-from systemimage.config import Configuration
+from systemimage.config import SNAPSHOT_FILE, Configuration
+from systemimage.helpers import NO_PORT, temporary_directory
 from systemimage.device import SystemProperty
 from systemimage.scores import WeightedScorer
 from systemimage.testing.helpers import configuration, data_path, touch_build
@@ -90,6 +93,10 @@ class TestConfiguration(unittest.TestCase):
                          '/android/cache/recovery')
         self.assertEqual(config.updater.data_partition,
                          '/var/lib/system-image')
+        self.assertEqual(config.updater.throughput, 256 * 1024)
+        self.assertEqual(config.updater.verify_cost, timedelta(seconds=15))
+        self.assertEqual(config.updater.apply_cost, timedelta(minutes=2))
+        self.assertEqual(config.updater.reboot_cost, timedelta(minutes=1))
         # [dbus]
         self.assertEqual(config.dbus.lifetime.total_seconds(), 600)
 
@@ -208,6 +215,15 @@ class TestConfiguration(unittest.TestCase):
             Configuration(config_d)
         self.assertEqual(cm.exception.args[0], '-1')
 
+    @configuration
+    def test_zero_throughput(self, config_d):
+        # The TimeScorer divides by the throughput, so it can't be zero.
+        shutil.copy(data_path('config.config_12.ini'),
+                    os.path.join(config_d, '01_override.ini'))
+        with self.assertRaises(ValueError) as cm:
+            Configuration(config_d)
+        self.assertEqual(cm.exception.args[0], '0K')
+
     @configuration
     def test_get_build_number(self, config):
         # The current build number is stored in a file specified in the
@@ -402,3 +418,169 @@ class TestConfiguration(unittest.TestCase):
             config.user_agent,
             'Ubuntu System Image Upgrade Client: '
             'device=geddyboard;channel=devel-trio;build=2112')
+
+
+class TestConfigurationSnapshot(unittest.TestCase):
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self.config_d = self._resources.enter_context(temporary_directory())
+        self.var_dir = self._resources.enter_context(temporary_directory())
+        self._resources.enter_context(patch(
+            'systemimage.config.DEFAULT_SETTINGS_DB',
+            os.path.join(self.var_dir, 'settings.db')))
+        self.snapshot = os.path.join(self.var_dir, SNAPSHOT_FILE)
+        self._write('00_base.ini', """\
+[service]
+base: phablet.example.com
+http_port: disabled
+https_port: 8443
+channel: stable
+
+[system]
+timeout: 10m
+loglevel: info:debug
+
+[hooks]
+scorer: systemimage.scores.WeightedScorer
+""")
+
+    def _write(self, filename, contents):
+        with open(os.path.join(self.config_d, filename), 'w',
+                  encoding='utf-8') as fp:
+            fp.write(contents)
+
+    def _assert_loaded(self, config):
+        self.assertEqual(config.service.base, 'phablet.example.com')
+        self.assertIs(config.service.http_port, NO_PORT)
+        self.assertEqual(config.http_base, 'https://phablet.example.com:8443')
+        self.assertEqual(config.system.timeout, timedelta(minutes=10))
+        self.assertEqual(config.system.loglevel,
+                         (logging.INFO, logging.DEBUG))
+        self.assertEqual(config.hooks.scorer, WeightedScorer)
+        self.assertEqual(
+            [os.path.basename(str(path)) for path in config.ini_files],
+            ['00_base.ini'])
+
+    def test_snapshot(self):
+        # The first load parses and converts the ini files and saves the
+        # snapshot, which the next load uses instead.
+        config = Configuration(self.config_d)
+        self._assert_loaded(config)
+        self.assertTrue(os.path.exists(self.snapshot))
+        with patch('systemimage.config.Configuration._read_file') as read, \
+                patch('systemimage.config.Configuration._load_file') as load:
+            config = Configuration(self.config_d)
+        self.assertFalse(read.called)
+        self.assertFalse(load.called)
+        self._assert_loaded(config)
+        self.assertEqual(sorted(config.service),
+                         ['base', 'build_number', 'channel', 'http_port',
+                          'https_port'])
+
+    def test_changed_file(self):
+        # Changing an ini file invalidates the snapshot.
+        Configuration(self.config_d)
+        self._write('00_base.ini', """\
+[service]
+base: other.example.com
+""")
+        config = Configuration(self.config_d)
+        self.assertEqual(config.service.base, 'other.example.com')
+        self.assertEqual(config.service.http_port, 80)
+
+    def test_new_file(self):
+        # So does adding an ini file.
+        Configuration(self.config_d)
+        self._write('01_channel.ini', """\
+[service]
+channel: devel
+""")
+        config = Configuration(self.config_d)
+        self.assertEqual(config.channel, 'devel')
+        self.assertEqual(len(config.ini_files), 2)
+
+    def test_other_directory(self):
+        # The snapshot is only good for the directory it was made from.
+        Configuration(self.config_d)
+        other_d = self._resources.enter_context(temporary_directory())
+        config = Configuration(other_d)
+        self.assertEqual(config.service.base, 'system-image.ubports.com')
+
+    def test_corrupt_snapshot(self):
+        # A corrupt snapshot is ignored, and replaced.
+        with open(self.snapshot, 'w', encoding='utf-8') as fp:
+            fp.write('{ not json')
+        self._assert_loaded(Configuration(self.config_d))
+        with patch('systemimage.config.Configuration._read_file') as mock:
+            self._assert_loaded(Configuration(self.config_d))
+        self.assertFalse(mock.called)
+
+    def test_reload(self):
+        config = Configuration(self.config_d)
+        config.reload()
+        self._assert_loaded(config)
+
+    def test_converted_values(self):
+        # The snapshot is JSON, holding the converted values which the ini
+        # files set.  Hook classes are saved by name, and are only imported
+        # when they're called, so loading the snapshot runs no code.
+        Configuration(self.config_d)
+        with open(self.snapshot, encoding='utf-8') as fp:
+            snapshot = json.load(fp)
+        values = snapshot['values']
+        self.assertIsNone(values['service']['http_port'])
+        self.assertEqual(values['service']['https_port'], 8443)
+        self.assertEqual(values['system']['timeout'], 600)
+        self.assertEqual(values['system']['loglevel'],
+                         [logging.INFO, logging.DEBUG])
+        self.assertEqual(values['hooks']['scorer'],
+                         'systemimage.scores.WeightedScorer')
+        self.assertEqual(values['updater'], {})
+
+    def test_writable_by_others(self):
+        # A snapshot which other users can change is not trusted.
+        Configuration(self.config_d)
+        os.chmod(self.snapshot, 0o666)
+        with patch('systemimage.config.Configuration._read_file',
+                   autospec=True,
+                   side_effect=Configuration._read_file) as mock:
+            Configuration(self.config_d)
+        self.assertTrue(mock.called)
+
+    def test_owned_by_another_user(self):
+        # Nor is a snapshot owned by some other user.
+        Configuration(self.config_d)
+        with patch('systemimage.config.os.geteuid',
+                   return_value=os.geteuid() + 1), \
+                patch('systemimage.config.Configuration._read_file',
+                      autospec=True,
+                      side_effect=Configuration._read_file) as mock:
+            Configuration(self.config_d)
+        self.assertTrue(mock.called)
+
+    def test_environment(self):
+        # Paths are expanded against the home directory, so the snapshot is
+        # only good for the same one.
+        self._write('01_system.ini', """\
+[system]
+tempdir: ~/si-tmp
+""")
+        with patch.dict(os.environ, HOME='/home/ant'):
+            config = Configuration(self.config_d)
+        self.assertEqual(config.system.tempdir, '/home/ant/si-tmp')
+        with patch.dict(os.environ, HOME='/home/bee'):
+            config = Configuration(self.config_d)
+        self.assertEqual(config.system.tempdir, '/home/bee/si-tmp')
+
+    def test_moved_settings_db(self):
+        # If the settings database isn't in its default location, the next
+        # load couldn't find the snapshot, so none is saved.
+        other_dir = self._resources.enter_context(temporary_directory())
+        self._write('01_system.ini', """\
+[system]
+settings_db: {}/settings.db
+""".format(other_dir))
+        Configuration(self.config_d)
+        self.assertFalse(os.path.exists(self.snapshot))
+        self.assertEqual(os.listdir(other_dir), [])
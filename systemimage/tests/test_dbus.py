@@ -321,6 +321,26 @@ class StartedReactor(Reactor):
         self.quit()
 
 
+class LatencyMeasuringReactor(Reactor):
+    def __init__(self, iface, samples=10):
+        super().__init__(dbus.SystemBus())
+        self.iface = iface
+        self.samples = samples
+        self.latencies = []
+        self.react_to('UpdateProgress')
+
+    def _do_UpdateProgress(self, signal, path, percentage, eta):
+        # Time a cheap method call while the download is in progress.  Skip
+        # the UpdateProgress(0, 0) which is sent before the download starts.
+        if percentage == 0:
+            return
+        start = time.monotonic()
+        self.iface.GetSetting('auto_download')
+        self.latencies.append(time.monotonic() - start)
+        if len(self.latencies) >= self.samples:
+            self.quit()
+
+
 class _TestBase(unittest.TestCase):
     """Base class for all DBus testing."""
 
@@ -545,6 +565,36 @@ class TestDBusCheckForUpdate(_LiveTesting):
         self.assertTrue(signal.is_available, msg=signal.error_reason)
         self.assertTrue(signal.downloading)
 
+    def test_trace(self):
+        # After a check, the step timings are available as a Chrome trace.
+        self.download_manually()
+        reactor = SignalCapturingReactor('UpdateAvailableStatus')
+        reactor.run(self.iface.CheckForUpdate)
+        self.assertEqual(len(reactor.signals), 1)
+        trace = json.loads(self.iface.GetTrace())
+        names = set(event['name'] for event in trace['traceEvents'])
+        self.assertIn('get_index', names)
+        self.assertIn('Index.from_json', names)
+        self.assertIn('Scorer.choose', names)
+        # The check stops before the download.
+        self.assertNotIn('download_files', names)
+
+    def test_statistics(self):
+        # The check is counted in the statistics.
+        self.download_manually()
+        reactor = SignalCapturingReactor('UpdateAvailableStatus')
+        reactor.run(self.iface.CheckForUpdate)
+        self.assertEqual(len(reactor.signals), 1)
+        statistics = self.iface.GetStatistics()
+        self.assertEqual(statistics['checks'], 1)
+        self.assertGreater(statistics['metadata_bytes'], 0)
+        self.assertEqual(statistics['payload_bytes'], 0)
+        self.assertGreater(statistics['gpg_invocations'], 0)
+        self.assertEqual(statistics['failures'], 0)
+        self.assertEqual(dict(statistics['failures_by_class']), {})
+        self.assertEqual(len(statistics['throughput_counts']),
+                         len(statistics['throughput_buckets']) + 1)
+
 
 class TestDBusDownload(_LiveTesting):
     def test_auto_download(self):
@@ -738,6 +788,22 @@ update 5.txt 5.txt.asc
 unmount system
 """)
 
+    def test_method_latency_during_download(self):
+        # The download happens in a worker thread, so the service stays
+        # responsive to other method calls while it's in progress.
+        def write_callback(dst):
+            write_bytes(dst, 750)
+        self._prepare_index('dbus.index_04.json', write_callback)
+        tweak_checksums(HASH750)
+        self.download_always()
+        reactor = LatencyMeasuringReactor(self.iface)
+        reactor.schedule(self.iface.CheckForUpdate)
+        reactor.run(timeout=600)
+        self.assertEqual(len(reactor.latencies), 10)
+        # Even on a slow test machine, a GetSetting() call shouldn't take
+        # anywhere near this long, unless it's waiting on the download.
+        self.assertLess(max(reactor.latencies), 1.0)
+
 
 class TestDBusApply(_LiveTesting):
     def setUp(self):
@@ -1379,6 +1445,29 @@ class TestDBusGetSet(_TestBase):
         self.iface.SetSetting('thing', 'one')
         self.assertEqual(self.iface.GetSetting('thing'), 'one')
 
+    def test_set_get_many(self):
+        # Several keys can be set and gotten at once.
+        self.iface.SetSettings(dict(name='ant', other='bee'))
+        self.assertEqual(
+            self.iface.GetSettings(['name', 'other', 'missing']),
+            dict(name='ant', other='bee', missing=''))
+
+    def test_set_many_validates(self):
+        # Invalid values for special keys are ignored, the rest get set.
+        self.iface.SetSettings(dict(min_battery='200', name='ant'))
+        self.assertEqual(
+            self.iface.GetSettings(['min_battery', 'name']),
+            dict(min_battery='', name='ant'))
+
+    def test_set_many_signals(self):
+        # A SettingChanged signal is sent for each changed value.
+        self.iface.SetSetting('name', 'ant')
+        reactor = SignalCapturingReactor('SettingChanged')
+        reactor.run(partial(self.iface.SetSettings,
+                            dict(name='ant', other='bee')),
+                    timeout=15)
+        self.assertEqual(reactor.signals, [('other', 'bee')])
+
     def test_setting_persists(self):
         # Set a key, restart the dbus server, and the key's value persists.
         self.iface.SetSetting('permanent', 'waves')
@@ -1614,6 +1703,30 @@ version_detail: ubuntu=222,mako=333,custom=444
         response = self.iface.Information()
         self.assertEqual(response['target_build_number'], '1600')
 
+    def test_information_snapshot_invalidated_by_settings(self):
+        # .Information() is served from a snapshot, but writing the settings
+        # database, either through the service or behind its back,
+        # invalidates it.
+        touch_build(45, use_config=self.config)
+        self.iface.Reset()
+        response = self.iface.Information()
+        self.assertEqual(response['last_check_date'], '')
+        self.assertEqual(self.iface.Information(), response)
+        self.iface.SetSetting('last_check_date', '2055-08-01 21:12:02')
+        response = self.iface.Information()
+        self.assertEqual(response['last_check_date'], '2055-08-01 21:12:02')
+        # Writes by other processes are seen by the service's file monitor,
+        # which may take a moment.
+        config = Configuration(SystemImagePlugin.controller.ini_path)
+        Settings(config).set('last_check_date', '2055-08-01 21:12:03')
+        until = datetime.now() + timedelta(seconds=10)
+        while datetime.now() < until:
+            response = self.iface.Information()
+            if response['last_check_date'] == '2055-08-01 21:12:03':
+                break
+            time.sleep(0.1)
+        self.assertEqual(response['last_check_date'], '2055-08-01 21:12:03')
+
     def test_target_version_detail_before_check(self):
         # Before we do a CheckForUpdate, there is no target version detail.
         timestamp = int(datetime(2022, 8, 1, 4, 45, 45).timestamp())
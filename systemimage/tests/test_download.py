@@ -17,6 +17,7 @@
 
 __all__ = [
     'TestCURL',
+    'TestCompressedMetadata',
     'TestDownload',
     'TestDownloadBigFiles',
     'TestDownloadManagerFactory',
@@ -26,27 +27,35 @@ __all__ = [
     'TestHTTPSDownloadsExpired',
     'TestHTTPSDownloadsNasty',
     'TestHTTPSDownloadsNoSelfSigned',
+    'TestNetworkConditions',
+    'TestNetworkConditionsDownloads',
     'TestRecord',
+    'TestTestServer',
     ]
 
 
 import os
+import gzip
+import time
 import random
 import unittest
 
 from contextlib import ExitStack
 from dbus.exceptions import DBusException
 from hashlib import sha256
+from http.client import HTTPConnection, IncompleteRead
 from systemimage.config import Configuration, config
 from systemimage.curl import CurlDownloadManager
 from systemimage.download import (
     Canceled, DuplicateDestinationError, Record, get_download_manager)
-from systemimage.helpers import temporary_directory
+from systemimage.helpers import MiB, temporary_directory
 from systemimage.settings import Settings
 from systemimage.testing.controller import USING_PYCURL
 from systemimage.testing.helpers import (
-    configuration, data_path, make_http_server, reset_envar, write_bytes)
+    NetworkConditions, NetworkProfile, configuration, data_path,
+    make_http_server, reset_envar, write_bytes)
 from systemimage.testing.nose import SystemImagePlugin
+from systemimage.testing.synthetic import make_index
 from systemimage.udm import DOWNLOADER_INTERFACE, UDMDownloadManager
 from unittest.mock import patch
 from urllib.parse import urljoin
@@ -146,8 +155,11 @@ class TestDownload(unittest.TestCase):
         self.assertEqual(
             set(os.listdir(config.tempdir)),
             set(['channels.json', 'index.json']))
-        self.assertEqual(received_bytes, 669)
-        self.assertEqual(total_bytes, 669)
+        # The PyCURL downloader asks for metadata gzip encoded, so it counts
+        # the compressed bytes.
+        expected = 280 if USING_PYCURL else 669
+        self.assertEqual(received_bytes, expected)
+        self.assertEqual(total_bytes, expected)
 
     @configuration
     def test_download_with_broken_callback(self):
@@ -641,6 +653,38 @@ class TestCURL(unittest.TestCase):
             'http://localhost:8980/(channel.channels_05|index_01).json')
 
 
+@unittest.skipUnless(USING_PYCURL, 'Test is not relevant for UDM')
+class TestCompressedMetadata(unittest.TestCase):
+    """Metadata is downloaded compressed, and decoded on the fly."""
+
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        serverdir = self._resources.enter_context(temporary_directory())
+        self._index = make_index(fulls=4, locales=10).encode('utf-8')
+        with open(os.path.join(serverdir, 'index.json'), 'wb') as fp:
+            fp.write(self._index)
+        self._resources.push(make_http_server(serverdir, 8980))
+
+    def _get_files(self, pausable):
+        downloader = CurlDownloadManager()
+        downloader.get_files(
+            _http_pathify([('index.json', 'index.json')]), pausable=pausable)
+        with open(os.path.join(config.tempdir, 'index.json'), 'rb') as fp:
+            self.assertEqual(fp.read(), self._index)
+        return downloader.received
+
+    @configuration
+    def test_metadata(self):
+        # Far fewer bytes are received than are written.
+        self.assertLess(self._get_files(False), len(self._index) / 4)
+
+    @configuration
+    def test_payload(self):
+        # Update files aren't asked for compressed.
+        self.assertEqual(self._get_files(True), len(self._index))
+
+
 class TestDownloadManagerFactory(unittest.TestCase):
     """We have a factory for creating the download manager to use."""
 
@@ -712,3 +756,233 @@ class TestDownloadManagerFactory(unittest.TestCase):
                 patch.object(systemimage.download, 'pycurl', None))
             self.assertRaises(ImportError, get_download_manager)
             mock.assert_called_once_with(DOWNLOADER_INTERFACE, '/')
+
+
+class TestTestServer(unittest.TestCase):
+    """The test server supports what the benchmarks need from a real one."""
+
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self._directory = self._resources.enter_context(
+            temporary_directory())
+        self._data = bytes(range(256)) * 4
+        with open(os.path.join(self._directory, 'data.bin'), 'wb') as fp:
+            fp.write(self._data)
+        self._conditions = NetworkConditions()
+        self._resources.push(make_http_server(
+            self._directory, 8980, threaded=True,
+            conditions=self._conditions))
+        self._conn = HTTPConnection('localhost', 8980)
+        self._resources.callback(self._conn.close)
+
+    def _get(self, **headers):
+        self._conn.request('GET', '/data.bin', headers=headers)
+        response = self._conn.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        # Several requests can be made over one connection.
+        response, body = self._get()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self._data)
+        sock = self._conn.sock
+        response, body = self._get()
+        self.assertEqual(body, self._data)
+        self.assertIs(self._conn.sock, sock)
+
+    def test_range(self):
+        response, body = self._get(Range='bytes=100-199')
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'),
+                         'bytes 100-199/1024')
+        self.assertEqual(body, self._data[100:200])
+        # Open ended and suffix ranges.
+        response, body = self._get(Range='bytes=1000-')
+        self.assertEqual(body, self._data[1000:])
+        response, body = self._get(Range='bytes=-24')
+        self.assertEqual(body, self._data[-24:])
+
+    def test_unsatisfiable_range(self):
+        response, body = self._get(Range='bytes=2000-')
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes */1024')
+        self.assertEqual(body, b'')
+
+    def test_etag(self):
+        # A matching ETag means the file hasn't changed.
+        response, body = self._get()
+        etag = response.getheader('ETag')
+        self.assertIsNotNone(etag)
+        response, body = self._get(**{'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, b'')
+        # A range with a stale If-Range gets the whole file.
+        response, body = self._get(
+            Range='bytes=0-9', **{'If-Range': '"stale"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self._data)
+
+    def test_latency(self):
+        self._conditions.add('/data.bin', NetworkProfile(latency=0.2))
+        start = time.monotonic()
+        response, body = self._get()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(body, self._data)
+
+    def test_bandwidth(self):
+        # 1KiB at 2KiB/s takes about half a second.
+        self._conditions.add('/*.bin', NetworkProfile(bandwidth=2048))
+        start = time.monotonic()
+        response, body = self._get()
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertEqual(body, self._data)
+
+    def test_stall(self):
+        self._conditions.add(
+            '/data.bin', NetworkProfile(stalls=1, stall_seconds=0.2))
+        start = time.monotonic()
+        response, body = self._get()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(body, self._data)
+
+    def test_reset(self):
+        # The body is cut off part way through.
+        self._conditions.add('/data.bin', NetworkProfile(resets=1))
+        self._conn.request('GET', '/data.bin')
+        response = self._conn.getresponse()
+        self.assertEqual(response.status, 200)
+        with self.assertRaises((IncompleteRead, ConnectionResetError)):
+            response.read()
+
+    def test_gzip(self):
+        # JSON files are compressed for clients which accept it.
+        with open(data_path('download.index_01.json'), 'rb') as fp:
+            data = fp.read()
+        with open(os.path.join(self._directory, 'index.json'), 'wb') as fp:
+            fp.write(data)
+        self._conn.request(
+            'GET', '/index.json', headers={'Accept-Encoding': 'gzip'})
+        response = self._conn.getresponse()
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(response.read()), data)
+        # But not for clients which don't, and never other files.
+        self._conn.request('GET', '/index.json')
+        response = self._conn.getresponse()
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(response.read(), data)
+        response, body = self._get(**{'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(body, self._data)
+
+    def test_server_errors(self):
+        self._conditions.add(
+            '/data.bin', NetworkProfile(errors=1, error_status=502))
+        response, body = self._get()
+        self.assertEqual(response.status, 502)
+        # Other files are unaffected.
+        self._conn.request('GET', '/nothing.txt')
+        response = self._conn.getresponse()
+        response.read()
+        self.assertEqual(response.status, 404)
+
+
+class TestNetworkConditions(unittest.TestCase):
+    def _statuses(self, conditions, path, count=50):
+        statuses = []
+        for i in range(count):
+            plan = conditions.plan(path)
+            statuses.append(None if plan is None else plan.status)
+        return statuses
+
+    def test_unmatched(self):
+        conditions = NetworkConditions(
+            [('/pool/*', NetworkProfile(errors=1))])
+        self.assertIsNone(conditions.plan('/channels.json'))
+        self.assertEqual(conditions.plan('/pool/a.tar.xz?x=1').status, 503)
+
+    def test_first_pattern_wins(self):
+        conditions = NetworkConditions([
+            ('/pool/*.asc', NetworkProfile(latency=1)),
+            ('/pool/*', NetworkProfile(latency=2)),
+            ])
+        self.assertEqual(conditions.plan('/pool/a.tar.xz.asc').latency, 1)
+        self.assertEqual(conditions.plan('/pool/a.tar.xz').latency, 2)
+
+    def test_bursts(self):
+        # Once an error happens, it continues for the length of the burst.
+        conditions = NetworkConditions(
+            [('*', NetworkProfile(errors=0.1, error_burst=3))])
+        statuses = self._statuses(conditions, '/index.json', 200)
+        self.assertIn(503, statuses)
+        runs = []
+        for status in statuses:
+            if status is None:
+                runs.append(0)
+            elif len(runs) == 0 or runs[-1] == 0:
+                runs.append(1)
+            else:
+                runs[-1] += 1
+        # A burst can start right after another one ends.  The last one may
+        # be cut short by the end of the requests.
+        for run in runs[:-1]:
+            self.assertEqual(run % 3, 0)
+
+    def test_seeded(self):
+        # The same seed always gives the same network.
+        profiles = [('*', NetworkProfile(
+            errors=0.2, resets=0.3, stalls=0.3))]
+        def plans(seed):
+            conditions = NetworkConditions(profiles, seed=seed)
+            return [(plan.status, plan.reset_at, plan.stall_at)
+                    for plan in (conditions.plan('/a') for i in range(50))]
+        self.assertEqual(plans(1), plans(1))
+        self.assertNotEqual(plans(1), plans(2))
+
+
+class TestNetworkConditionsDownloads(unittest.TestCase):
+    """Drive the downloader through bad networks."""
+
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self._serverdir = self._resources.enter_context(temporary_directory())
+        for name in ('file_1.dat', 'file_2.dat'):
+            write_bytes(os.path.join(self._serverdir, name), 1)
+
+    def _serve(self, *profiles, seed=0):
+        self._resources.push(make_http_server(
+            self._serverdir, 8980, threaded=True,
+            conditions=NetworkConditions(profiles, seed=seed)))
+
+    def _get_files(self):
+        get_download_manager().get_files(_http_pathify([
+            ('file_1.dat', 'file_1.dat'),
+            ('file_2.dat', 'file_2.dat'),
+            ]))
+
+    @configuration
+    def test_slow_network(self):
+        # A slow, stalling network is still a working one.
+        self._serve(('*', NetworkProfile(
+            latency=0.05, bandwidth=4 * MiB, stalls=1, stall_seconds=0.2)))
+        self._get_files()
+        for name in ('file_1.dat', 'file_2.dat'):
+            path = os.path.join(config.tempdir, name)
+            self.assertEqual(os.path.getsize(path), MiB)
+
+    @configuration
+    def test_server_errors(self):
+        # A server error fails the whole download.
+        self._serve(('/file_2.dat', NetworkProfile(errors=1)))
+        self.assertRaises(FileNotFoundError, self._get_files)
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+    @configuration
+    def test_reset(self):
+        # So does a connection reset.  This happens part way through the
+        # body, so the file is cut short.
+        self._serve(('/file_1.dat', NetworkProfile(resets=1)))
+        self.assertRaises(FileNotFoundError, self._get_files)
+        self.assertLess(
+            os.path.getsize(os.path.join(config.tempdir, 'file_1.dat')), MiB)
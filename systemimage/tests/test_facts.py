@@ -0,0 +1,220 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cached host facts."""
+
+__all__ = [
+    'TestDevice',
+    'TestHostFacts',
+    ]
+
+
+import os
+import json
+import unittest
+
+from contextlib import ExitStack
+from systemimage.device import BaseDevice, SystemProperty
+from systemimage.facts import BOOT, FACTS_FILE, NEVER, HostFacts
+from systemimage.helpers import temporary_directory
+from systemimage.testing.helpers import configuration
+from unittest.mock import patch
+
+
+def _rewrite(path, contents):
+    # Change the contents of a file without changing its stat, to see
+    # whether it gets read again.
+    info = os.stat(path)
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(contents)
+    os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns))
+
+
+class _Provider(BaseDevice):
+    calls = 0
+    device = 'manta'
+
+    def get_device(self):
+        type(self).calls += 1
+        return self.device
+
+
+class BootProvider(_Provider):
+    cache = BOOT
+
+
+class NeverProvider(_Provider):
+    cache = NEVER
+
+
+class TestHostFacts(unittest.TestCase):
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self.tmpdir = self._resources.enter_context(temporary_directory())
+        self.facts = HostFacts()
+
+    def _path(self, filename, contents):
+        path = os.path.join(self.tmpdir, filename)
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(contents)
+        return path
+
+    def test_machine_id(self):
+        # The machine id is read once, until the file changes.
+        path = self._path('machine-id', 'aaaa\n')
+        self._resources.enter_context(
+            patch('systemimage.helpers.UNIQUE_MACHINE_ID_FILES', [path]))
+        self.assertEqual(self.facts.machine_id(), 'aaaa')
+        _rewrite(path, 'bbbb\n')
+        self.assertEqual(self.facts.machine_id(), 'aaaa')
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write('cccccc\n')
+        self.assertEqual(self.facts.machine_id(), 'cccccc')
+
+    def test_machine_id_fallback(self):
+        # A machine id file appearing earlier in the search path counts as a
+        # change.
+        first = os.path.join(self.tmpdir, 'first')
+        second = self._path('second', 'bbbb')
+        self._resources.enter_context(patch(
+            'systemimage.helpers.UNIQUE_MACHINE_ID_FILES', [first, second]))
+        self.assertEqual(self.facts.machine_id(), 'bbbb')
+        self._path('first', 'aaaa')
+        self.assertEqual(self.facts.machine_id(), 'aaaa')
+
+    def test_no_machine_id(self):
+        self._resources.enter_context(patch(
+            'systemimage.helpers.UNIQUE_MACHINE_ID_FILES',
+            [os.path.join(self.tmpdir, 'missing')]))
+        self.assertRaises(RuntimeError, self.facts.machine_id)
+
+    def test_clock_offset(self):
+        path = self._path('timekeep', '100\n')
+        self._resources.enter_context(
+            patch('systemimage.helpers.TIMEKEEPER_OFFSET_FILE', path))
+        self.assertEqual(self.facts.clock_offset(), 100)
+        _rewrite(path, '200\n')
+        self.assertEqual(self.facts.clock_offset(), 100)
+        os.utime(path, (0, 0))
+        self.assertEqual(self.facts.clock_offset(), 200)
+
+    @configuration
+    def test_last_update_date(self):
+        path = self._path('.last_update', '')
+        os.utime(path, (1352538487, 1352538487))
+        self._resources.enter_context(
+            patch('systemimage.helpers.LAST_UPDATE_FILE', path))
+        with patch('systemimage.facts.HostFacts._last_update_date',
+                   return_value='2012-11-10 09:08:07') as mock:
+            self.facts.last_update_date()
+            self.facts.last_update_date()
+            self.assertEqual(mock.call_count, 1)
+            # Touching the file invalidates the cached date.
+            os.utime(path, (1352624887, 1352624887))
+            self.facts.last_update_date()
+            self.assertEqual(mock.call_count, 2)
+            # So does removing it.
+            os.remove(path)
+            self.facts.last_update_date()
+            self.assertEqual(mock.call_count, 3)
+
+    def test_invalidate(self):
+        path = self._path('machine-id', 'aaaa')
+        self._resources.enter_context(
+            patch('systemimage.helpers.UNIQUE_MACHINE_ID_FILES', [path]))
+        self.facts.machine_id()
+        _rewrite(path, 'bbbb')
+        self.facts.invalidate('machine_id')
+        self.assertEqual(self.facts.machine_id(), 'bbbb')
+
+
+class TestDevice(unittest.TestCase):
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self.tmpdir = self._resources.enter_context(temporary_directory())
+        self.settings_db = os.path.join(self.tmpdir, 'settings.db')
+        self.boot_id = os.path.join(self.tmpdir, 'boot_id')
+        self._boot('1111')
+        self._resources.enter_context(
+            patch('systemimage.facts.BOOT_ID_FILE', self.boot_id))
+        BootProvider.calls = NeverProvider.calls = 0
+
+    def _boot(self, boot_id):
+        with open(self.boot_id, 'w', encoding='utf-8') as fp:
+            fp.write(boot_id + '\n')
+
+    def test_system_property(self):
+        # getprop only needs to be run once per boot.
+        self.assertEqual(SystemProperty.cache, BOOT)
+
+    def test_boot_cache(self):
+        # BOOT cacheable device names are saved for later processes.
+        device = HostFacts().device(BootProvider(), self.settings_db)
+        self.assertEqual(device, 'manta')
+        self.assertEqual(BootProvider.calls, 1)
+        device = HostFacts().device(BootProvider(), self.settings_db)
+        self.assertEqual(device, 'manta')
+        self.assertEqual(BootProvider.calls, 1)
+        with open(os.path.join(self.tmpdir, FACTS_FILE),
+                  encoding='utf-8') as fp:
+            saved = json.load(fp)
+        self.assertEqual(saved['device']['value'], 'manta')
+
+    def test_reboot(self):
+        # After a reboot, the provider is asked again.
+        HostFacts().device(BootProvider(), self.settings_db)
+        self._boot('2222')
+        HostFacts().device(BootProvider(), self.settings_db)
+        self.assertEqual(BootProvider.calls, 2)
+
+    def test_other_provider(self):
+        # The saved name is only good for the provider that gave it.
+        class OtherProvider(BootProvider):
+            device = 'mako'
+        HostFacts().device(BootProvider(), self.settings_db)
+        device = HostFacts().device(OtherProvider(), self.settings_db)
+        self.assertEqual(device, 'mako')
+
+    def test_unknown_not_saved(self):
+        class UnknownProvider(BootProvider):
+            device = '?'
+        HostFacts().device(UnknownProvider(), self.settings_db)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir, FACTS_FILE)))
+
+    def test_no_boot_id(self):
+        # Without a boot id, BOOT is the same as PROCESS.
+        os.remove(self.boot_id)
+        HostFacts().device(BootProvider(), self.settings_db)
+        HostFacts().device(BootProvider(), self.settings_db)
+        self.assertEqual(BootProvider.calls, 2)
+
+    @configuration
+    def test_config_caches(self, config):
+        # The configuration caches the device name for the process...
+        with patch.object(config.hooks, 'device', BootProvider):
+            self.assertEqual(config.device, 'manta')
+            self.assertEqual(config.device, 'manta')
+        self.assertEqual(BootProvider.calls, 1)
+
+    @configuration
+    def test_config_never(self, config):
+        # ...unless the provider says not to.
+        with patch.object(config.hooks, 'device', NeverProvider):
+            self.assertEqual(config.device, 'manta')
+            self.assertEqual(config.device, 'manta')
+        self.assertEqual(NeverProvider.calls, 2)
@@ -16,6 +16,7 @@
 """Test that we can verify GPG signatures."""
 
 __all__ = [
+    'TestKeyringIndex',
     'TestKeyrings',
     'TestSignature',
     'TestSignatureError',
@@ -32,10 +33,12 @@ import traceback
 from contextlib import ExitStack
 from io import StringIO
 from systemimage.config import config
-from systemimage.gpg import Context, SignatureError
-from systemimage.helpers import temporary_directory
+from systemimage.gpg import (
+    Context, SignatureError, _list_fingerprints, keyring_index)
+from systemimage.helpers import makedirs, temporary_directory
 from systemimage.testing.helpers import (
     configuration, copy, setup_keyring_txz, setup_keyrings, sign)
+from unittest.mock import patch
 
 
 class TestKeyrings(unittest.TestCase):
@@ -613,3 +616,156 @@ class TestSignatureWithOverrides(unittest.TestCase):
                                   channels_asc, channels_json)
                 config.skip_gpg_verification = True
                 ctx.validate(channels_asc, channels_json)
+
+
+class TestKeyringIndex(unittest.TestCase):
+    """Keyring tarballs are only unpacked, and their keys listed, once."""
+
+    def setUp(self):
+        self._stack = ExitStack()
+        self.addCleanup(self._stack.close)
+        self._tmpdir = self._stack.enter_context(temporary_directory())
+        self.addCleanup(keyring_index.clear)
+
+    def _make_keyring(self, **data):
+        json_data = dict(type='image-signing')
+        json_data.update(data)
+        dst = os.path.join(self._tmpdir, 'image-signing.tar.xz')
+        setup_keyring_txz('image-signing.gpg', 'image-master.gpg',
+                          json_data, dst)
+        return dst
+
+    @configuration
+    def test_metadata(self):
+        # The index knows what's in the keyring.json file, along with the
+        # fingerprints of the keys in the keyring.
+        keyring = self._make_keyring(model='nexus7', expiry=1234567890)
+        info = keyring_index.lookup(keyring)
+        self.assertEqual(info.type, 'image-signing')
+        self.assertEqual(info.model, 'nexus7')
+        self.assertEqual(info.expiry, 1234567890)
+        self.assertEqual(info.fingerprints,
+                         ('C5E39F07D159687BA3E82BD15A0DE8A4F1F1846F',))
+        self.assertTrue(os.path.exists(info.gpg_path))
+
+    @configuration
+    def test_optional_metadata(self):
+        # The model and expiry keys are optional.
+        info = keyring_index.lookup(self._make_keyring())
+        self.assertIsNone(info.model)
+        self.assertIsNone(info.expiry)
+
+    @configuration
+    def test_unpack_once(self):
+        # Once the tarball has been seen, it doesn't get unpacked again.
+        keyring = self._make_keyring()
+        info = keyring_index.lookup(keyring)
+        with patch('systemimage.gpg.tarfile.open') as mock:
+            self.assertEqual(keyring_index.lookup(keyring), info)
+            with Context(keyring) as ctx:
+                self.assertEqual(
+                    ctx.fingerprints,
+                    set(['C5E39F07D159687BA3E82BD15A0DE8A4F1F1846F']))
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_persistent(self):
+        # The index survives across processes, which we simulate by clearing
+        # the in-memory index.
+        keyring = self._make_keyring(expiry=1234567890)
+        info = keyring_index.lookup(keyring)
+        keyring_index.clear()
+        with patch('systemimage.gpg.tarfile.open') as mock:
+            self.assertEqual(keyring_index.lookup(keyring), info)
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_keyed_on_contents(self):
+        # Replacing the tarball with a different one at the same path gives
+        # us the new keyring's metadata.
+        keyring = self._make_keyring(expiry=1234567890)
+        self.assertEqual(keyring_index.lookup(keyring).expiry, 1234567890)
+        dst = os.path.join(self._tmpdir, 'other', 'image-signing.tar.xz')
+        setup_keyring_txz('device-signing.gpg', 'image-signing.gpg',
+                          dict(type='device-signing'), dst)
+        os.replace(dst, keyring)
+        info = keyring_index.lookup(keyring)
+        self.assertEqual(info.type, 'device-signing')
+        self.assertIsNone(info.expiry)
+        self.assertEqual(info.fingerprints,
+                         ('C43D6575FDD935D2F9BC2A4669BC664FCB86D917',))
+
+    @configuration
+    def test_missing_gpg_file(self):
+        # If the extracted .gpg file disappears, the tarball gets unpacked
+        # again.
+        keyring = self._make_keyring()
+        info = keyring_index.lookup(keyring)
+        os.remove(info.gpg_path)
+        self.assertEqual(keyring_index.lookup(keyring), info)
+        self.assertTrue(os.path.exists(info.gpg_path))
+
+    @configuration
+    def test_unwritable_cache(self, config):
+        # If the directory next to the settings database can't be written,
+        # the index lives in the temporary directory.
+        keyring = self._make_keyring()
+        def unwritable(directory):
+            if not directory.startswith(config.tempdir):
+                raise PermissionError(directory)
+            makedirs(directory)
+        with patch('systemimage.gpg.makedirs', unwritable):
+            info = keyring_index.lookup(keyring)
+        self.assertTrue(info.gpg_path.startswith(config.tempdir))
+        self.assertTrue(os.path.exists(info.gpg_path))
+
+    @configuration
+    def test_verify_is_a_set_lookup(self):
+        # Once the keyrings are indexed, verification doesn't ask gpg to list
+        # any keys.
+        channels_json = os.path.join(self._tmpdir, 'channels.json')
+        copy('gpg.channels_01.json', self._tmpdir, dst=channels_json)
+        sign(channels_json, 'image-signing.gpg')
+        keyring = self._make_keyring()
+        keyring_index.lookup(keyring)
+        with ExitStack() as resources:
+            mock = resources.enter_context(
+                patch('systemimage.gpg._list_fingerprints'))
+            ctx = resources.enter_context(Context(keyring))
+            resources.enter_context(
+                patch.object(ctx._ctx, 'list_keys',
+                             side_effect=AssertionError))
+            self.assertTrue(ctx.verify(channels_json + '.asc', channels_json))
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_blacklist_fingerprints_indexed(self):
+        # The blacklist's fingerprints also come from the index.
+        channels_json = os.path.join(self._tmpdir, 'channels.json')
+        copy('gpg.channels_01.json', self._tmpdir, dst=channels_json)
+        sign(channels_json, 'image-signing.gpg')
+        keyring = self._make_keyring()
+        blacklist = os.path.join(self._tmpdir, 'blacklist.tar.xz')
+        setup_keyring_txz('image-signing.gpg', 'image-master.gpg',
+                          dict(type='blacklist'), blacklist)
+        keyring_index.lookup(keyring)
+        keyring_index.lookup(blacklist)
+        with patch('systemimage.gpg._list_fingerprints') as mock:
+            with Context(keyring, blacklist=blacklist) as ctx:
+                self.assertFalse(
+                    ctx.verify(channels_json + '.asc', channels_json))
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_cached_gpg_fingerprints_listed_once(self):
+        # Bare .gpg files in the temporary directory only get their keys
+        # listed once.
+        copy('archive-master.gpg', config.tempdir)
+        with patch('systemimage.gpg._list_fingerprints',
+                   wraps=_list_fingerprints) as mock:
+            for i in range(3):
+                with Context(config.gpg.archive_master) as ctx:
+                    self.assertEqual(
+                        ctx.fingerprints,
+                        set(['289518ED3A0C4CFE975A0B32E0979A7EADE8E880']))
+        self.assertEqual(mock.call_count, 1)
@@ -38,9 +38,9 @@ from pathlib import Path
 from systemimage.bag import Bag
 from systemimage.config import Configuration
 from systemimage.helpers import (
-    MiB, NO_PORT, as_loglevel, as_object, as_port, as_stripped, as_timedelta,
-    calculate_signature, get_android_offset, last_update_date, phased_percentage,
-    temporary_directory, version_detail)
+    MiB, NO_PORT, as_loglevel, as_object, as_port, as_positive_size, as_size,
+    as_stripped, as_timedelta, calculate_signature, get_android_offset,
+    last_update_date, phased_percentage, temporary_directory, version_detail)
 from systemimage.testing.helpers import configuration, data_path, touch_build
 from unittest.mock import patch
 
@@ -71,6 +71,11 @@ class TestConverters(unittest.TestCase):
     def test_as_object_not_equal(self):
         self.assertNotEqual(as_object('systemimage.bag.Bag'), object())
 
+    def test_as_object_str(self):
+        # The dotted path is available without importing anything.
+        self.assertEqual(str(as_object('systemimage.doesnotexist.Foo')),
+                         'systemimage.doesnotexist.Foo')
+
     def test_as_timedelta_seconds(self):
         self.assertEqual(as_timedelta('2s'), timedelta(seconds=2))
 
@@ -126,6 +131,24 @@ class TestConverters(unittest.TestCase):
     def test_stripped(self):
         self.assertEqual(as_stripped('   field   '), 'field')
 
+    def test_as_size(self):
+        self.assertEqual(as_size('0'), 0)
+        self.assertEqual(as_size('512'), 512)
+        self.assertEqual(as_size('4k'), 4096)
+        self.assertEqual(as_size('10M'), 10 * MiB)
+        self.assertEqual(as_size('2G'), 2048 * MiB)
+
+    def test_as_bad_size(self):
+        self.assertRaises(ValueError, as_size, 'big')
+        self.assertRaises(ValueError, as_size, '10T')
+        self.assertRaises(ValueError, as_size, '-1')
+
+    def test_as_positive_size(self):
+        self.assertEqual(as_positive_size('1'), 1)
+        self.assertEqual(as_positive_size('4k'), 4096)
+        self.assertRaises(ValueError, as_positive_size, '0')
+        self.assertRaises(ValueError, as_positive_size, '0M')
+
 
 class TestGetAndroidOffset(unittest.TestCase):
     @configuration
@@ -0,0 +1,76 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the incremental index generator."""
+
+__all__ = [
+    'TestIncrementalIndex',
+    ]
+
+
+import os
+import json
+import unittest
+
+from systemimage.candidates import get_candidates
+from systemimage.helpers import temporary_directory
+from systemimage.incremental import incremental_index, main
+from systemimage.index import Index
+from systemimage.testing.helpers import data_path
+from systemimage.testing.synthetic import make_index
+
+
+def _paths(index, build):
+    return sorted([image.version for image in path]
+                  for path in get_candidates(index, build))
+
+
+class TestIncrementalIndex(unittest.TestCase):
+    def test_images(self):
+        # Only the fulls newer than the build, and the deltas based on it or
+        # anything newer, are kept.
+        with open(data_path('state.index_01.json'), encoding='utf-8') as fp:
+            full = fp.read()
+        index = Index.from_json(incremental_index(full, 201))
+        self.assertEqual(
+            sorted((image.type, image.version) for image in index.images),
+            [('delta', 301), ('delta', 304), ('delta', 304), ('full', 300)])
+        self.assertEqual(index.global_.since, 201)
+        self.assertEqual(index.global_.generated_at,
+                         Index.from_json(full).global_.generated_at)
+
+    def test_same_candidates(self):
+        # Devices at or above the build get the same candidate upgrade paths
+        # from the incremental index as from the full one.
+        full = make_index(fulls=3, delta_chain=5, fork_factor=2)
+        full_index = Index.from_json(full)
+        incremental = Index.from_json(incremental_index(full, 8))
+        self.assertLess(len(incremental.images), len(full_index.images))
+        for build in range(8, 20):
+            self.assertEqual(_paths(incremental, build),
+                             _paths(full_index, build))
+
+    def test_main(self):
+        with temporary_directory() as tmpdir:
+            output = os.path.join(tmpdir, 'index-since-300.json')
+            status = main(['--since', '300', '-o', output,
+                           data_path('state.index_01.json')])
+            self.assertEqual(status, 0)
+            with open(output, encoding='utf-8') as fp:
+                incremental = json.load(fp)
+        self.assertEqual(incremental['global']['since'], 300)
+        self.assertEqual(
+            sorted(image['version'] for image in incremental['images']),
+            [301, 304])
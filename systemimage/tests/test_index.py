@@ -28,9 +28,11 @@ from contextlib import ExitStack
 from datetime import datetime, timezone
 from systemimage.gpg import SignatureError
 from systemimage.helpers import temporary_directory
+from systemimage.incremental import incremental_index
+from systemimage.index import Index
 from systemimage.state import State
 from systemimage.testing.helpers import (
-    configuration, copy, get_index, make_http_server, makedirs,
+    configuration, copy, data_path, get_index, make_http_server, makedirs,
     setup_keyring_txz, setup_keyrings, sign)
 from systemimage.testing.nose import SystemImagePlugin
 
@@ -46,6 +48,15 @@ class TestIndex(unittest.TestCase):
             index.global_.generated_at,
             datetime(2013, 4, 29, 18, 45, 27, tzinfo=timezone.utc))
 
+    def test_index_global_since(self):
+        # Only incremental indexes say which build they're good for.
+        index = get_index('index.index_02.json')
+        self.assertIsNone(getattr(index.global_, 'since', None))
+        with open(data_path('index.index_03.json'), encoding='utf-8') as fp:
+            index = Index.from_json(incremental_index(fp.read(), 1300))
+        self.assertEqual(index.global_.since, 1300)
+        self.assertEqual([image.version for image in index.images], [1400])
+
     def test_index_image_count(self):
         index = get_index('index.index_02.json')
         self.assertEqual(len(index.images), 0)
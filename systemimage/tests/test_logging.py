@@ -0,0 +1,323 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the logging setup."""
+
+__all__ = [
+    'TestBatchingQueueHandler',
+    'TestFormattingLogRecord',
+    'TestInitialize',
+    'TestRotation',
+    ]
+
+
+import gzip
+import stat
+import logging
+import unittest
+
+from contextlib import ExitStack
+from pathlib import Path
+from systemimage.config import config
+from systemimage.helpers import temporary_directory
+from systemimage.logging import (
+    BatchingQueueHandler, FormattingLogRecord, initialize, make_handler)
+from systemimage.testing.helpers import configuration
+from unittest.mock import patch
+
+
+class Counted:
+    """Count how many times we get formatted."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __format__(self, spec):
+        self.count += 1
+        return 'counted'
+
+
+class _LoggingTestBase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self.tmpdir = Path(self._resources.enter_context(
+            temporary_directory()))
+        old_factory = logging.getLogRecordFactory()
+        logging.setLogRecordFactory(FormattingLogRecord)
+        self.addCleanup(logging.setLogRecordFactory, old_factory)
+        # Use a private logger so as not to disturb the real ones.
+        self.log = logging.getLogger('systemimage.testing.logging')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+
+    def add_handler(self, handler):
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+        self.addCleanup(handler.close)
+
+
+class TestFormattingLogRecord(_LoggingTestBase):
+    def test_format_style(self):
+        # systemimage loggers use {}-style messages.
+        path = self.tmpdir / 'client.log'
+        self.add_handler(make_handler(path))
+        self.log.info('{} and {}', 'ant', 'bee')
+        self.assertTrue(path.read_text().endswith('ant and bee\n'))
+
+    def test_not_emitted_not_formatted(self):
+        # A record which no handler emits is never formatted.
+        handler = make_handler(self.tmpdir / 'client.log')
+        handler.setLevel(logging.INFO)
+        self.add_handler(handler)
+        counted = Counted()
+        self.log.debug('{}', counted)
+        self.assertEqual(counted.count, 0)
+
+    def test_formatted_once(self):
+        # A record emitted by several handlers is only formatted once.
+        self.add_handler(make_handler(self.tmpdir / 'one.log'))
+        self.add_handler(make_handler(self.tmpdir / 'two.log'))
+        counted = Counted()
+        self.log.info('{}', counted)
+        self.assertEqual(counted.count, 1)
+
+
+class TestBatchingQueueHandler(_LoggingTestBase):
+    def test_records_written(self):
+        # Records are written to the wrapped handlers, in order.
+        path = self.tmpdir / 'client.log'
+        queue_handler = BatchingQueueHandler([make_handler(path)])
+        self.add_handler(queue_handler)
+        for i in range(250):
+            self.log.info('record {}', i)
+        queue_handler.close()
+        lines = path.read_text().splitlines()
+        self.assertEqual(len(lines), 250)
+        for i, line in enumerate(lines):
+            self.assertTrue(line.endswith('record {}'.format(i)), line)
+
+    def test_handler_levels(self):
+        # Each wrapped handler's level is honored.
+        info_path = self.tmpdir / 'info.log'
+        debug_path = self.tmpdir / 'debug.log'
+        info_handler = make_handler(info_path)
+        info_handler.setLevel(logging.INFO)
+        debug_handler = make_handler(debug_path)
+        debug_handler.setLevel(logging.DEBUG)
+        queue_handler = BatchingQueueHandler([info_handler, debug_handler])
+        self.add_handler(queue_handler)
+        self.log.debug('debugging')
+        self.log.info('informing')
+        queue_handler.close()
+        self.assertEqual(len(info_path.read_text().splitlines()), 1)
+        self.assertEqual(len(debug_path.read_text().splitlines()), 2)
+
+    def test_formatted_by_writer(self):
+        # Messages whose arguments are only strings and numbers are left for
+        # the writer thread to format.
+        path = self.tmpdir / 'client.log'
+        queue_handler = BatchingQueueHandler([make_handler(path)])
+        self.add_handler(queue_handler)
+        with patch.object(queue_handler.queue, 'put') as put:
+            self.log.info('{} of {:.1f}', 'received', 12.25)
+        record = put.call_args[0][0]
+        self.assertIsNone(record._formatted)
+        self.assertEqual(record.args, ('received', 12.25))
+        self.log.info('{} of {:.1f}', 'received', 12.25)
+        queue_handler.close()
+        self.assertTrue(path.read_text().endswith(' received of 12.2\n'))
+
+    def test_formatted_when_queued(self):
+        # Other messages are formatted by the caller, once, so that
+        # arguments which change afterward are logged as they were.
+        path = self.tmpdir / 'client.log'
+        queue_handler = BatchingQueueHandler([make_handler(path)])
+        self.add_handler(queue_handler)
+        counted = Counted()
+        images = [1200]
+        with patch.object(queue_handler.queue, 'put') as put:
+            self.log.info('{} {}', counted, images)
+        self.assertEqual(counted.count, 1)
+        record = put.call_args[0][0]
+        self.assertEqual(record.msg, 'counted [1200]')
+        self.assertIsNone(record.args)
+        self.log.info('{}', images)
+        images.append(1300)
+        queue_handler.close()
+        self.assertTrue(path.read_text().endswith(' [1200]\n'))
+
+    def test_traceback_when_queued(self):
+        # Likewise, the traceback is formatted before the record is queued.
+        path = self.tmpdir / 'client.log'
+        queue_handler = BatchingQueueHandler([make_handler(path)])
+        self.add_handler(queue_handler)
+        try:
+            raise RuntimeError('oops')
+        except RuntimeError:
+            with patch.object(queue_handler.queue, 'put') as put:
+                self.log.exception('failed')
+        record = put.call_args[0][0]
+        self.assertIsNone(record.exc_info)
+        self.assertIn('RuntimeError: oops', record.exc_text)
+
+    def test_flush_once_per_batch(self):
+        # The wrapped handlers are flushed once per batch, not per record.
+        path = self.tmpdir / 'client.log'
+        handler = make_handler(path)
+        queue_handler = BatchingQueueHandler([handler])
+        self.add_handler(queue_handler)
+        records = [
+            self.log.makeRecord(self.log.name, logging.INFO, __file__, 0,
+                                'record {}', (i,), None)
+            for i in range(10)
+            ]
+        with patch.object(handler.stream, 'flush') as flush:
+            queue_handler._write(records)
+        self.assertEqual(flush.call_count, 1)
+        handler.flush()
+        self.assertEqual(len(path.read_text().splitlines()), 10)
+
+
+class TestInitialize(_LoggingTestBase):
+    NAMES = ('systemimage', 'systemimage.dbus', 'dbus.proxies')
+
+    def setUp(self):
+        super().setUp()
+        # initialize() configures the real loggers, so put them back the way
+        # they were afterward.
+        for name in self.NAMES:
+            log = logging.getLogger(name)
+            self.addCleanup(self._restore, log, log.handlers[:], log.level,
+                            log.propagate)
+
+    def _restore(self, log, handlers, level, propagate):
+        for handler in log.handlers:
+            if handler not in handlers:
+                handler.close()
+        log.handlers[:] = handlers
+        log.setLevel(level)
+        log.propagate = propagate
+
+    def _handlers(self):
+        return [logging.getLogger(name).handlers[-1] for name in self.NAMES]
+
+    @configuration
+    def test_one_file_handler(self):
+        # All the loggers share one file handler, since only one of them can
+        # rotate the log file.
+        config.system.logfile = str(self.tmpdir / 'client.log')
+        initialize()
+        handlers = self._handlers()
+        self.assertEqual(len(set(handlers)), 1)
+        self.assertEqual(handlers[0].baseFilename,
+                         str(self.tmpdir / 'client.log'))
+
+    @configuration
+    def test_one_queue(self):
+        # With a queue, all the loggers share one queue and writer thread.
+        config.system.logfile = str(self.tmpdir / 'client.log')
+        initialize(queue=True)
+        handlers = self._handlers()
+        self.assertEqual(len(set(handlers)), 1)
+        self.assertIsInstance(handlers[0], BatchingQueueHandler)
+        logging.getLogger('systemimage').error('main')
+        logging.getLogger('systemimage.dbus').error('dbus')
+        handlers[0].close()
+        lines = (self.tmpdir / 'client.log').read_text().splitlines()
+        self.assertEqual(len(lines), 2)
+
+
+class TestRotation(_LoggingTestBase):
+    def setUp(self):
+        super().setUp()
+        self.path = self.tmpdir / 'client.log'
+
+    def _segment(self, number):
+        return self.tmpdir / 'client.log.{}.gz'.format(number)
+
+    def test_rotated_and_compressed(self):
+        # Once the log file reaches its maximum size, it gets rotated out to
+        # a compressed segment and a new log file is started.
+        handler = make_handler(self.path, max_bytes=1024, backup_count=3)
+        self.add_handler(handler)
+        for i in range(20):
+            self.log.info('record {:02d} {}', i, 'x' * 60)
+        handler.close()
+        self.assertLessEqual(self.path.stat().st_size, 1024)
+        rotated = []
+        for number in (3, 2, 1):
+            if self._segment(number).exists():
+                with gzip.open(str(self._segment(number)), 'rt',
+                               encoding='utf-8') as fp:
+                    rotated.extend(fp.read().splitlines())
+        self.assertGreater(len(rotated), 0)
+        current = self.path.read_text().splitlines()
+        # Nothing got lost between the segments and the current log file.
+        lines = rotated + current
+        self.assertEqual(len(lines), 20)
+        for i, line in enumerate(lines):
+            self.assertIn('record {:02d}'.format(i), line)
+        # The uncompressed intermediate file is gone.
+        self.assertFalse((self.tmpdir / 'client.log.1').exists())
+
+    def test_backup_count(self):
+        # Only the configured number of compressed segments are kept.
+        handler = make_handler(self.path, max_bytes=256, backup_count=2)
+        self.add_handler(handler)
+        for i in range(50):
+            self.log.info('record {:02d} {}', i, 'x' * 60)
+        handler.close()
+        self.assertTrue(self._segment(1).exists())
+        self.assertTrue(self._segment(2).exists())
+        self.assertFalse(self._segment(3).exists())
+        # The newest segment picks up where the log file starts.
+        with gzip.open(str(self._segment(1)), 'rt', encoding='utf-8') as fp:
+            last_rotated = fp.read().splitlines()[-1]
+        first_current = self.path.read_text().splitlines()[0]
+        self.assertEqual(int(last_rotated.split()[-2]) + 1,
+                         int(first_current.split()[-2]))
+
+    def test_permissions(self):
+        # The new log file and the compressed segments are private.
+        handler = make_handler(self.path, max_bytes=256, backup_count=2)
+        self.add_handler(handler)
+        for i in range(10):
+            self.log.info('record {:02d} {}', i, 'x' * 60)
+        handler.close()
+        for path in (self.path, self._segment(1)):
+            self.assertEqual(stat.filemode(path.stat().st_mode),
+                             '-rw-------')
+
+    def test_no_rotation(self):
+        # A maximum size of zero disables rotation.
+        handler = make_handler(self.path, max_bytes=0, backup_count=2)
+        self.add_handler(handler)
+        for i in range(50):
+            self.log.info('record {:02d} {}', i, 'x' * 60)
+        handler.close()
+        self.assertEqual(len(self.path.read_text().splitlines()), 50)
+        self.assertFalse(self._segment(1).exists())
+
+    def test_existing_size_counts(self):
+        # The size of an existing log file counts towards the maximum.
+        self.path.write_text('x' * 1000)
+        handler = make_handler(self.path, max_bytes=1024, backup_count=2)
+        self.add_handler(handler)
+        self.log.info('record {:02d} {}', 0, 'x' * 60)
+        handler.close()
+        self.assertTrue(self._segment(1).exists())
+        self.assertEqual(len(self.path.read_text().splitlines()), 1)
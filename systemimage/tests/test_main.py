@@ -31,6 +31,7 @@ __all__ = [
     'TestCLISignatures',
     'TestDBusMain',
     'TestDBusMainNoConfigD',
+    'TestImportTime',
     ]
 
 
@@ -53,6 +54,7 @@ from systemimage.config import Configuration, config
 from systemimage.helpers import safe_remove
 from systemimage.main import main as cli_main
 from systemimage.settings import Settings
+from systemimage.statistics import Statistics
 from systemimage.testing.controller import USING_PYCURL
 from systemimage.testing.helpers import (
     ServerTestBase, chmod, configuration, copy, data_path, find_dbus_process,
@@ -64,6 +66,23 @@ from unittest.mock import MagicMock, patch
 
 
 SPACE = ' '
+# These must not be imported until they're needed.
+LAZY_IMPORTS = [
+    'dbus',
+    'gi',
+    'gnupg',
+    'pkg_resources',
+    'pycurl',
+    'sqlite3',
+    'systemimage.api',
+    'systemimage.dbus',
+    'systemimage.download',
+    'systemimage.gpg',
+    'systemimage.settings',
+    'systemimage.state',
+    'tarfile',
+    'xdg',
+    ]
 TIMESTAMP = datetime(2013, 8, 1, 12, 11, 10).timestamp()
 
 
@@ -136,7 +155,8 @@ class TestCLIMain(unittest.TestCase):
             patch('systemimage.main.DEFAULT_CONFIG_D', tempdir))
         # Mock out the initialize() call so that the main() doesn't try to
         # create a log file in a non-existent system directory.
-        self._resources.enter_context(patch('systemimage.main.initialize'))
+        self._resources.enter_context(
+            patch('systemimage.logging.initialize'))
         cli_main()
         self.assertEqual(config.config_d, tempdir)
         self.assertEqual(config.channel, 'special')
@@ -389,7 +409,7 @@ class TestCLIMain(unittest.TestCase):
                 raise StopIteration
         self._resources.enter_context(argv('-C', config.config_d))
         self._resources.enter_context(
-            patch('systemimage.main.State', FakeState))
+            patch('systemimage.state.State', FakeState))
         cli_main()
         self.assertTrue(os.path.exists(config.system.logfile))
         with open(config.system.logfile, encoding='utf-8') as fp:
@@ -438,6 +458,19 @@ class TestCLIMain(unittest.TestCase):
             self._stderr.getvalue().splitlines()[-1],
             'system-image-cli: error: Bad filter type: bogus')
 
+    @configuration
+    def test_missing_plan_file(self, config_d):
+        # --plan with a file that doesn't exist is an error.
+        self._resources.enter_context(
+            argv('-C', config_d, '--plan', '/does/not/exist.csv'))
+        with self.assertRaises(SystemExit) as cm:
+            cli_main()
+        self.assertEqual(cm.exception.code, 2)
+        self.assertEqual(
+            self._stderr.getvalue().splitlines()[-1],
+            "system-image-cli: error: Cannot read /does/not/exist.csv: "
+            "[Errno 2] No such file or directory: '/does/not/exist.csv'")
+
     @configuration
     def test_version_detail(self, config_d):
         # --info where a config file has [service]version_detail.
@@ -479,6 +512,8 @@ class TestCLIMain(unittest.TestCase):
         with chmod(config.updater.cache_partition, 0):
             exit_code = cli_main()
         self.assertEqual(exit_code, 1)
+        # The failure is counted in the statistics.
+        self.assertEqual(Statistics().as_dict()['counters']['failures'], 1)
 
     @configuration
     def test_state_machine_exceptions_dry_run(self, config):
@@ -487,6 +522,21 @@ class TestCLIMain(unittest.TestCase):
         with chmod(config.updater.cache_partition, 0):
             exit_code = cli_main()
         self.assertEqual(exit_code, 1)
+        self.assertEqual(Statistics().as_dict()['counters']['failures'], 1)
+
+    @configuration
+    def test_unwritable_trace(self, config):
+        # A --trace file which can't be written is reported, but doesn't
+        # change the exit status.
+        trace_path = os.path.join(config.config_d, 'missing', 'trace.json')
+        self._resources.enter_context(argv(
+            '-C', config.config_d, '--dry-run', '--trace', trace_path))
+        self._resources.enter_context(
+            patch('systemimage.main.sys.stderr', self._stderr))
+        with chmod(config.updater.cache_partition, 0):
+            exit_code = cli_main()
+        self.assertEqual(exit_code, 1)
+        self.assertIn('Cannot write the trace: ', self._stderr.getvalue())
 
 
 class TestCLIMainDryRun(ServerTestBase):
@@ -634,6 +684,34 @@ Upgrade path is 1200:1201:1304
 Target phase: 0%
 """)
 
+    @configuration
+    def test_dry_run_trace(self, config_d):
+        # --trace writes the timings of the steps in Chrome trace-event format.
+        self._setup_server_keyrings()
+        trace_path = os.path.join(config_d, 'trace.json')
+        with ExitStack() as resources:
+            resources.enter_context(capture_print(StringIO()))
+            resources.push(machine_id('0000000000000000aaaaaaaaaaaaaaaa'))
+            resources.enter_context(
+                argv('-C', config_d, '--dry-run', '--trace', trace_path))
+            cli_main()
+        with open(trace_path, encoding='utf-8') as fp:
+            trace = json.load(fp)
+        events = {event['name']: event for event in trace['traceEvents']}
+        # The steps up to the download are traced...
+        self.assertEqual(events['get_index']['cat'], 'state')
+        self.assertNotIn('download_files', events)
+        # ...as are the operations within them.
+        self.assertEqual(events['Index.from_json']['cat'], 'parse')
+        self.assertIn('get_candidates', events)
+        self.assertIn('Scorer.choose', events)
+        self.assertIn('get_files', events)
+        # The bytes downloaded within a step count towards the step, as do
+        # the bytes of the index read in it.
+        self.assertGreater(events['get_files']['args']['bytes'], 0)
+        self.assertGreaterEqual(events['get_index']['args']['bytes'],
+                                events['get_files']['args']['bytes'])
+
 
 class TestCLIMainDryRunAliases(ServerTestBase):
     INDEX_FILE = 'main.index_02.json'
@@ -1327,6 +1405,27 @@ class TestCLISettings(unittest.TestCase):
             self._stderr.getvalue().splitlines()[-1],
             'system-image-cli: error: Cannot mix and match settings arguments')
 
+    @configuration
+    def test_stats(self, config_d):
+        # `system-image-cli --stats` shows the statistics saved by earlier
+        # runs as key=value pairs.
+        statistics = Statistics()
+        statistics.increment('checks', 2)
+        statistics.failure('FileNotFoundError')
+        statistics.throughput(10 * 1024, 1)
+        statistics.throughput(100 * 1024, 1, payload=True)
+        statistics.save()
+        self._resources.enter_context(argv('-C', config_d, '--stats'))
+        cli_main()
+        lines = self._stdout.getvalue().splitlines()
+        self.assertIn('checks=2', lines)
+        self.assertIn('payload_bytes=0', lines)
+        self.assertIn('failures=1', lines)
+        self.assertIn('failures.FileNotFoundError=1', lines)
+        self.assertIn('throughput.le_16384=1', lines)
+        self.assertIn('throughput.le_inf=0', lines)
+        self.assertIn('throughput.estimate=102400', lines)
+
 
 class TestDBusMain(unittest.TestCase):
     def setUp(self):
@@ -1803,3 +1902,19 @@ class TestCLIGSMOverride(ServerTestBase):
         # call args.
         args, kws = mock.call_args
         self.assertTrue(kws['allow_gsm'])
+
+
+class TestImportTime(unittest.TestCase):
+    """system-image-cli must start quickly for --info, --get, etc."""
+
+    def test_lazy_imports(self):
+        # Importing the command line's main module in a fresh interpreter
+        # doesn't import any of the expensive modules.
+        stdout = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, systemimage.main; print(*sys.modules)'],
+            universal_newlines=True)
+        imported = set(stdout.split())
+        self.assertIn('systemimage.main', imported)
+        for name in LAZY_IMPORTS:
+            self.assertNotIn(name, imported)
@@ -0,0 +1,223 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test mirroring a channel."""
+
+__all__ = [
+    'TestLocalPaths',
+    'TestMirror',
+    'TestOptionalIndexes',
+    ]
+
+
+import os
+import json
+import lzma
+import unittest
+
+from systemimage.config import config
+from systemimage.download import DownloadManagerBase
+from systemimage.helpers import temporary_directory
+from systemimage.mirror import MANIFEST_FILE, STAGING_DIR, _local, mirror
+from systemimage.state import ChecksumError
+from systemimage.testing.helpers import (
+    ServerTestBase, configuration, get_index, sign)
+from unittest.mock import patch
+
+
+class TestLocalPaths(unittest.TestCase):
+    def test_inside(self):
+        self.assertEqual(_local('/srv/mirror', '/stable/nexus7/index.json'),
+                         '/srv/mirror/stable/nexus7/index.json')
+        self.assertEqual(_local('/srv/mirror', 'gpg/blacklist.tar.xz'),
+                         '/srv/mirror/gpg/blacklist.tar.xz')
+
+    def test_outside(self):
+        # Server paths can't escape the mirror.
+        self.assertRaises(ValueError, _local, '/srv/mirror', '/../etc/passwd')
+        self.assertRaises(ValueError, _local, '/srv/mirror', 'a/../../b')
+
+
+class TestMirror(ServerTestBase):
+    INDEX_FILE = 'state.index_05.json'
+    CHANNEL_FILE = 'state.channels_02.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+
+    def setUp(self):
+        super().setUp()
+        self._mirror = self._resources.enter_context(temporary_directory())
+
+    def _mirror_files(self):
+        self._setup_server_keyrings()
+        config.channel = 'stable'
+        config.device = 'nexus7'
+        with patch('systemimage.download.DownloadManagerBase.get_files',
+                   autospec=True,
+                   side_effect=DownloadManagerBase.get_files) as mock:
+            mirror(self._mirror)
+        # Return the update files which were downloaded.  They're
+        # downloaded into the staging directory.
+        staging = os.path.join(self._mirror, STAGING_DIR)
+        downloaded = []
+        for call in mock.call_args_list:
+            if call[1].get('pausable'):
+                downloaded.extend(
+                    os.path.relpath(record.destination, staging)
+                    for record in call[0][1])
+        return sorted(downloaded)
+
+    @configuration
+    def test_mirror(self):
+        self._mirror_files()
+        for path in ('channels.json',
+                     'gpg/image-master.tar.xz',
+                     'gpg/image-signing.tar.xz',
+                     'stable/nexus7/device-signing.tar.xz',
+                     'stable/nexus7/index.json',
+                     ):
+            for suffix in ('', '.asc'):
+                self.assertTrue(os.path.exists(
+                    os.path.join(self._mirror, path + suffix)),
+                    path + suffix)
+        for image in get_index(self.INDEX_FILE).images:
+            for filerec in image.files:
+                self.assertTrue(os.path.exists(
+                    _local(self._mirror, filerec.path)))
+                self.assertTrue(os.path.exists(
+                    _local(self._mirror, filerec.signature)))
+        # The new metadata has replaced the old.
+        self.assertFalse(
+            os.path.exists(os.path.join(self._mirror, '.staging')))
+
+    @configuration
+    def test_install_order(self):
+        # The update files go into the mirror before the metadata which
+        # refers to them, and channels.json goes in last.
+        with patch('systemimage.mirror.os.replace',
+                   side_effect=os.replace) as mock:
+            self._mirror_files()
+        installed = [os.path.relpath(args[1], self._mirror)
+                     for args, kws in mock.call_args_list]
+        files = set()
+        for image in get_index(self.INDEX_FILE).images:
+            for filerec in image.files:
+                files.add(filerec.path.lstrip('/'))
+                files.add(filerec.signature.lstrip('/'))
+        self.assertEqual(set(installed[:len(files)]), files)
+        self.assertIn('stable/nexus7/index.json', installed[len(files):])
+        self.assertEqual(installed[-2:],
+                         ['channels.json', 'channels.json.asc'])
+
+    @configuration
+    def test_host_keyring_untouched(self):
+        # The device keyring is mirrored, but not installed on this host.
+        self._mirror_files()
+        self.assertTrue(os.path.exists(os.path.join(
+            self._mirror, 'stable', 'nexus7', 'device-signing.tar.xz')))
+        self.assertFalse(os.path.exists(config.gpg.device_signing))
+
+    @configuration
+    def test_no_statistics(self):
+        # Mirroring doesn't say how fast the device downloads.
+        with patch('systemimage.download.statistics') as mock:
+            self._mirror_files()
+        self.assertEqual(mock.mock_calls, [])
+
+    @configuration
+    def test_only_changes(self):
+        # Mirroring again only downloads what's missing or changed.
+        self._mirror_files()
+        index = get_index(self.INDEX_FILE)
+        changed = index.images[0].files[0]
+        os.remove(_local(self._mirror, changed.path))
+        downloaded = self._mirror_files()
+        self.assertEqual(downloaded, sorted([
+            changed.path.lstrip('/'), changed.signature.lstrip('/')]))
+        # There's nothing to do the next time.
+        self.assertEqual(self._mirror_files(), [])
+
+    @configuration
+    def test_manifest(self):
+        # The checksums of the mirrored files are remembered, along with
+        # their stat, so they don't need to be checksummed on the next run.
+        self._mirror_files()
+        with open(os.path.join(self._mirror, MANIFEST_FILE),
+                  encoding='utf-8') as fp:
+            manifest = json.load(fp)
+        filerec = get_index(self.INDEX_FILE).images[0].files[0]
+        self.assertEqual(manifest[filerec.path][0], filerec.checksum)
+        with patch('systemimage.mirror.verify_file') as mock:
+            self._mirror_files()
+        self.assertEqual(mock.call_count, 0)
+
+    @configuration
+    def test_bad_download(self):
+        # When a changed file doesn't check out, nothing in the mirror is
+        # touched, not even the old copy of that file.
+        self._mirror_files()
+        filerec = get_index(self.INDEX_FILE).images[0].files[0]
+        path = _local(self._mirror, filerec.path)
+        with open(path, 'wb') as fp:
+            fp.write(b'old contents')
+        self._setup_server_keyrings()
+        config.channel = 'stable'
+        config.device = 'nexus7'
+        with patch('systemimage.mirror.calculate_signature',
+                   return_value='bogus'):
+            self.assertRaises(ChecksumError, mirror, self._mirror)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'old contents')
+
+
+class TestOptionalIndexes(ServerTestBase):
+    # channels.json lists a compressed and an incremental index.
+    INDEX_FILE = 'state.index_05.json'
+    CHANNEL_FILE = 'state.channels_09.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+    SIGNING_KEY = 'image-signing.gpg'
+
+    def setUp(self):
+        super().setUp()
+        self._mirror = self._resources.enter_context(temporary_directory())
+        self._setup_server_keyrings(device_signing=False)
+        config.channel = 'stable'
+        config.device = 'nexus7'
+
+    @configuration
+    def test_missing_indexes(self):
+        # Neither is on the server, but the full index is enough.
+        mirror(self._mirror)
+        index = os.path.join(self._mirror, 'stable', 'nexus7', 'index.json')
+        self.assertTrue(os.path.exists(index))
+        self.assertFalse(os.path.exists(index + '.xz'))
+        self.assertFalse(os.path.exists(os.path.join(
+            self._mirror, 'stable', 'nexus7', 'index-since-300.json')))
+
+    @configuration
+    def test_compressed_index(self):
+        # The indexes which are on the server are mirrored.
+        path = os.path.join(
+            self._serverdir, 'stable', 'nexus7', 'index.json')
+        with open(path, 'rb') as fp:
+            contents = fp.read()
+        with lzma.open(path + '.xz', 'wb') as fp:
+            fp.write(contents)
+        sign(path + '.xz', self.SIGNING_KEY)
+        mirror(self._mirror)
+        index = os.path.join(self._mirror, 'stable', 'nexus7', 'index.json')
+        for suffix in ('', '.xz', '.xz.asc'):
+            self.assertTrue(os.path.exists(index + suffix), suffix)
@@ -0,0 +1,180 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test batch upgrade planning."""
+
+__all__ = [
+    'TestPlan',
+    'TestPlanBuilds',
+    'TestPlanDeviceKeyring',
+    'TestReadTargets',
+    ]
+
+
+import os
+import json
+import unittest
+
+from contextlib import ExitStack
+from systemimage.config import config
+from systemimage.helpers import temporary_directory
+from systemimage.planning import Target, _plan_builds, plan, read_targets
+from systemimage.testing.helpers import (
+    ServerTestBase, configuration, get_index)
+from unittest.mock import patch
+
+
+class TestReadTargets(unittest.TestCase):
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self.tmpdir = self._resources.enter_context(temporary_directory())
+
+    def _write(self, filename, contents):
+        path = os.path.join(self.tmpdir, filename)
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(contents)
+        return path
+
+    def test_csv(self):
+        path = self._write('targets.csv', """\
+device,channel,build
+nexus7,stable,100
+mako,daily,0
+""")
+        self.assertEqual(read_targets(path), [
+            Target('nexus7', 'stable', 100),
+            Target('mako', 'daily', 0),
+            ])
+
+    def test_json(self):
+        path = self._write('targets.json', json.dumps([
+            dict(device='nexus7', channel='stable', build=100),
+            dict(device='mako', channel='daily', build='0'),
+            ]))
+        self.assertEqual(read_targets(path), [
+            Target('nexus7', 'stable', 100),
+            Target('mako', 'daily', 0),
+            ])
+
+    def test_missing_key(self):
+        path = self._write('targets.json', json.dumps([
+            dict(device='nexus7', build=100),
+            ]))
+        self.assertRaises(ValueError, read_targets, path)
+
+    def test_bad_build(self):
+        path = self._write('targets.csv', """\
+device,channel,build
+nexus7,stable,latest
+""")
+        self.assertRaises(ValueError, read_targets, path)
+
+
+class TestPlanBuilds(unittest.TestCase):
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self._resources.enter_context(patch(
+            'systemimage.planning._indexes',
+            {('devel', 'nexus7'): get_index('scores.index_05.json')}))
+
+    @configuration
+    def test_plan_builds(self):
+        # One plan is returned for each build.
+        config.phase_override = 0
+        plans = _plan_builds('devel', 'nexus7', [100, 1700])
+        self.assertEqual(len(plans), 2)
+        first, second = plans
+        self.assertEqual([image['type'] for image in first['path']],
+                         ['full', 'delta', 'delta'])
+        self.assertEqual(first['target'], first['path'][-1]['version'])
+        self.assertEqual(first['size'],
+                         sum(image['size'] for image in first['path']))
+        # The last build is already up-to-date.
+        self.assertEqual(second, dict(
+            target=None, size=0, phased_percentage=None, path=[]))
+
+    @configuration
+    def test_phased_percentage(self):
+        # `Full B`'s path is phased to 50% of devices.
+        config.phase_override = 0
+        first_in_line = _plan_builds('devel', 'nexus7', [100])[0]
+        self.assertEqual(
+            [image['base'] for image in first_in_line['path']],
+            [None, 200, 201])
+        self.assertEqual(first_in_line['phased_percentage'], 50)
+        # Devices outside of the phase get the `Full A` path.
+        config.phase_override = 66
+        outside = _plan_builds('devel', 'nexus7', [100])[0]
+        self.assertEqual(
+            [image['base'] for image in outside['path']], [None, 300, 301])
+        self.assertEqual(outside['phased_percentage'], 100)
+
+
+class TestPlan(ServerTestBase):
+    INDEX_FILE = 'state.index_01.json'
+    CHANNEL_FILE = 'state.channels_08.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+    SIGNING_KEY = 'image-signing.gpg'
+
+    @configuration
+    def test_plan(self):
+        self._setup_server_keyrings(device_signing=False)
+        report = plan([
+            Target('nexus7', 'stable', 100),
+            Target('nexus7', 'daily', 100),
+            Target('mako', 'stable', 100),
+            Target('nexus7', 'stable', 250),
+            ], jobs=2)
+        self.assertEqual([entry.get('error') for entry in report], [
+            None,
+            'No such channel: daily',
+            'No such device: mako',
+            None,
+            ])
+        self.assertEqual(
+            [image['version'] for image in report[0]['path']],
+            [200, 201, 304])
+        self.assertEqual(
+            [image['version'] for image in report[3]['path']],
+            [300, 301, 304])
+        self.assertEqual(report[3]['build'], 250)
+        self.assertEqual(report[3]['target'], 304)
+        # The phase override is only used while planning.
+        self.assertIsNone(config.phase_override)
+
+
+class TestPlanDeviceKeyring(ServerTestBase):
+    INDEX_FILE = 'state.index_01.json'
+    CHANNEL_FILE = 'state.channels_02.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+    SIGNING_KEY = 'device-signing.gpg'
+
+    @configuration
+    def test_keyring_not_installed(self):
+        # The device signing keyring is only used for planning.  It doesn't
+        # replace this host's own, and the configured device is untouched.
+        self._setup_server_keyrings()
+        device = config.device
+        report = plan([Target('nexus7', 'stable', 100)], jobs=1)
+        self.assertIsNone(report[0].get('error'))
+        self.assertEqual(
+            [image['version'] for image in report[0]['path']],
+            [200, 201, 304])
+        self.assertEqual(config.device, device)
+        self.assertFalse(os.path.exists(config.gpg.device_signing))
@@ -14,7 +14,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 __all__ = [
+    'TestCacheAwareScorer',
     'TestPhasedUpdates',
+    'TestTimeScorer',
     'TestVersionDetail',
     'TestWeightedScorer',
     ]
@@ -22,9 +24,12 @@ __all__ = [
 
 import unittest
 
-from systemimage.candidates import get_candidates
-from systemimage.scores import WeightedScorer
-from systemimage.testing.helpers import descriptions, get_index
+from systemimage.candidates import get_candidates, iter_candidates
+from systemimage.helpers import MiB
+from systemimage.scores import (
+    CacheAwareScorer, Cost, TimeScorer, WeightedScorer)
+from systemimage.statistics import statistics
+from systemimage.testing.helpers import configuration, descriptions, get_index
 from unittest.mock import patch
 
 
@@ -88,6 +93,134 @@ class TestWeightedScorer(unittest.TestCase):
         self.assertEqual(path[0].version, 1800)
 
 
+class _Cache:
+    # A view of the verified cache, holding exactly the given files.
+    def __init__(self, filerecs):
+        self._ids = set(id(filerec) for filerec in filerecs)
+
+    def __contains__(self, filerec):
+        return id(filerec) in self._ids
+
+
+class TestCacheAwareScorer(unittest.TestCase):
+    def setUp(self):
+        self.scorer = CacheAwareScorer()
+        # See TestWeightedScorer.test_three_paths() for the paths.
+        index = get_index('scores.index_03.json')
+        self.candidates = get_candidates(index, 600)
+
+    def test_no_cache(self):
+        # Without a view of the cache, all bytes count.
+        self.assertEqual(self.scorer.score(self.candidates), [300, 200, 9401])
+
+    def test_nothing_cached(self):
+        self.scorer.cache = _Cache([])
+        self.assertEqual(self.scorer.score(self.candidates), [300, 200, 9401])
+
+    def test_interrupted_download(self):
+        # Path A's full image is already downloaded, so path A now has less
+        # left to download than path B, and the bytes already downloaded
+        # aren't wasted.
+        path_a = self.candidates[0]
+        self.scorer.cache = _Cache(path_a[0].files)
+        self.assertEqual(self.scorer.score(self.candidates), [300, 500, 9701])
+        winner = self.scorer.choose(self.candidates, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full A', 'Delta A.1', 'Delta A.2'])
+        # The weighted scorer still picks path B.
+        weighted = WeightedScorer()
+        weighted.cache = self.scorer.cache
+        winner = weighted.choose(self.candidates, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full B', 'Delta B.1', 'Delta B.2'])
+
+    def test_explanations(self):
+        # Each path's score is explained in the log.
+        self.scorer.cache = _Cache(self.candidates[0][0].files)
+        with patch('systemimage.scores.log') as log:
+            log.isEnabledFor.return_value = True
+            self.scorer.score(self.candidates)
+        explanations = [call[0] for call in log.debug.call_args_list]
+        self.assertEqual(len(explanations), 3)
+        # The arguments are the path, its score, the extra reboots, the MiB
+        # to download, the smallest download, and the builds short.
+        self.assertEqual(explanations[0][1:], ('1300:1301:1304', 300, 3,
+                                               600, 600, 0))
+        self.assertEqual(explanations[1][1:], ('1200:1201:1304', 500, 1,
+                                               1000, 600, 0))
+        self.assertEqual(explanations[2][1:], ('1100:1303', 9701, 0,
+                                               1300, 600, 1))
+
+
+class TestTimeScorer(unittest.TestCase):
+    # Path A is 900MiB with two extra reboots, path B is 1000MiB with one
+    # extra reboot, and path C doesn't reach the highest build.  See
+    # TestWeightedScorer.test_three_paths().
+    def setUp(self):
+        self.scorer = TimeScorer()
+        index = get_index('scores.index_03.json')
+        self.candidates = get_candidates(index, 600)
+
+    @configuration
+    def test_slow_network(self):
+        # Until this device has downloaded anything, it's assumed to download
+        # 256KiB/s, so path A's smaller download beats path B's fewer reboots.
+        scores = self.scorer.score(self.candidates)
+        self.assertEqual(scores[:2], [4154, 4495])
+        self.assertGreater(scores[2], 365 * 24 * 60 * 60)
+        winner = self.scorer.choose(self.candidates, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full A', 'Delta A.1', 'Delta A.2'])
+
+    @configuration
+    def test_fast_network(self):
+        # On a fast network, the extra reboot costs more than the extra
+        # download.
+        statistics.throughput(100 * MiB, 1, payload=True)
+        winner = self.scorer.choose(self.candidates, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full B', 'Delta B.1', 'Delta B.2'])
+
+    @configuration('00.ini', 'scores.config_01.ini')
+    def test_costs(self):
+        # The cost breakdown of each path, in seconds.  Here, only the
+        # downloads cost anything, at 1MiB/s.
+        costs = self.scorer.costs(self.candidates)
+        self.assertEqual(costs[0], Cost(900, 0, 0, 0, 0))
+        self.assertEqual(costs[1], Cost(1000, 0, 0, 0, 0))
+        self.assertEqual(costs[2].total, 1300 + 365 * 24 * 60 * 60)
+
+    @configuration
+    def test_cached(self):
+        # Files already in the cache don't need to be downloaded or
+        # verified again.
+        full_a = self.candidates[0][0]
+        self.scorer.cache = _Cache(full_a.files)
+        cost = self.scorer.costs(self.candidates)[0]
+        self.assertEqual(cost.download, 600 * MiB / (256 * 1024))
+        self.assertEqual(cost.apply, 3 * 120)
+        self.assertEqual(cost.reboot, 3 * 60)
+
+    @configuration
+    def test_rates_looked_up_once(self):
+        # The throughput is only estimated once per choice, not once for
+        # every image the candidates are pruned by.
+        index = get_index('scores.index_03.json')
+        candidates = iter_candidates(
+            index, 600, score=self.scorer.running_score)
+        with patch('systemimage.scores.statistics.estimated_throughput',
+                   return_value=None) as estimate:
+            winner = self.scorer.choose(candidates, 'devel')
+        self.assertEqual(estimate.call_count, 1)
+        self.assertEqual(descriptions(winner),
+                         ['Full A', 'Delta A.1', 'Delta A.2'])
+        # After choosing, the rates are looked up again.
+        statistics.throughput(100 * MiB, 1, payload=True)
+        winner = self.scorer.choose(self.candidates, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full B', 'Delta B.1', 'Delta B.2'])
+
+
 class TestPhasedUpdates(unittest.TestCase):
     def setUp(self):
         self.scorer = WeightedScorer()
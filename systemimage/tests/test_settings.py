@@ -21,12 +21,13 @@ __all__ = [
 
 
 import os
+import sqlite3
 import unittest
 
 from contextlib import ExitStack
 from pathlib import Path
 from systemimage.helpers import temporary_directory
-from systemimage.settings import Settings
+from systemimage.settings import SCHEMA_VERSION, Settings, _databases
 from systemimage.testing.helpers import chmod, configuration
 from unittest.mock import patch
 
@@ -128,3 +129,105 @@ class TestSettings(unittest.TestCase):
         # The settings.db file still doesn't exist because it got
         # created in a different place.
         self.assertFalse(db_file.exists())
+
+    @configuration
+    def test_get_many(self):
+        # Several keys can be gotten at once; unset keys get their defaults.
+        settings = Settings()
+        settings.set('a', 'ant')
+        settings.set('b', 'bee')
+        self.assertEqual(
+            settings.get_many(['a', 'b', 'c', 'auto_download']),
+            dict(a='ant', b='bee', c='', auto_download='1'))
+        self.assertEqual(settings.get_many([]), {})
+
+    @configuration
+    def test_set_many(self):
+        # Several keys can be set at once.
+        settings = Settings()
+        settings.set('a', 'ant')
+        settings.set_many(dict(a='aardvark', b='bee'))
+        self.assertEqual(sorted(Settings()),
+                         [('a', 'aardvark'), ('b', 'bee')])
+
+    @configuration
+    def test_no_duplicate_rows(self, config):
+        # Creating Settings objects and setting keys over and over again
+        # doesn't grow the database.
+        for i in range(10):
+            Settings().set('animal', str(i))
+        with sqlite3.connect(config.system.settings_db) as conn:
+            rows = conn.execute(
+                'select key, value from settings order by key').fetchall()
+        self.assertEqual(rows, [('__version__', SCHEMA_VERSION),
+                                ('animal', '9')])
+
+    @configuration
+    def test_migrate_duplicate_rows(self, config):
+        # A version 1 database, with no primary key and lots of duplicate
+        # __version__ rows, gets migrated to the keyed table.
+        with sqlite3.connect(config.system.settings_db) as conn:
+            conn.execute('create table settings (key, value)')
+            for i in range(100):
+                conn.execute(
+                    'insert into settings values ("__version__", "1")')
+            conn.execute('insert into settings values ("animal", "ant")')
+            conn.execute('insert into settings values ("auto_download", "0")')
+        settings = Settings()
+        self.assertEqual(sorted(settings),
+                         [('animal', 'ant'), ('auto_download', '0')])
+        with sqlite3.connect(config.system.settings_db) as conn:
+            rows = conn.execute(
+                'select key, value from settings order by key').fetchall()
+            version = conn.execute('pragma user_version').fetchone()[0]
+        self.assertEqual(rows, [('__version__', SCHEMA_VERSION),
+                                ('animal', 'ant'),
+                                ('auto_download', '0')])
+        self.assertEqual(version, 2)
+
+    @configuration
+    def test_rollback_journal(self, config):
+        # The database is left in the default rollback journal mode, so
+        # opening it doesn't need any -wal or -shm files.
+        Settings().set('animal', 'bat')
+        with sqlite3.connect(config.system.settings_db) as conn:
+            mode = conn.execute('pragma journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'delete')
+        for suffix in ('-wal', '-shm'):
+            self.assertFalse(
+                os.path.exists(config.system.settings_db + suffix))
+
+    @unittest.skipIf(os.getuid() == 0, 'Test cannot succeed when run as root')
+    @configuration
+    def test_read_only_database(self, config):
+        # A process which can't write to the database or its directory can
+        # still read the settings, rather than falling back to its own.
+        Settings().set('animal', 'bat')
+        # Close the writable connection, as if the writer had exited.
+        db_file = config.system.settings_db
+        _databases.pop(db_file).connection.close()
+        with ExitStack() as resources:
+            resources.enter_context(chmod(db_file, 0o444))
+            resources.enter_context(chmod(os.path.dirname(db_file), 0o555))
+            resources.enter_context(
+                patch('systemimage.settings.Settings._check_fallback',
+                      side_effect=RuntimeError))
+            self.assertEqual(Settings().get('animal'), 'bat')
+
+    @configuration
+    def test_connection_reused(self):
+        # Creating a Settings object doesn't reconnect to the database.
+        Settings()
+        with patch('systemimage.settings.sqlite3.connect') as connect:
+            Settings().set('animal', 'bat')
+            self.assertEqual(Settings().get('animal'), 'bat')
+        self.assertEqual(connect.call_count, 0)
+
+    @configuration
+    def test_database_replaced(self, config):
+        # If the database file is removed behind our back, a new one gets
+        # created the next time the settings are used.
+        Settings().set('animal', 'cat')
+        os.remove(config.system.settings_db)
+        self.assertEqual(Settings().get('animal'), '')
+        self.assertTrue(os.path.exists(config.system.settings_db))
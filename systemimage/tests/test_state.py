@@ -20,12 +20,15 @@ __all__ = [
     'TestChannelAlias',
     'TestCommandFileDelta',
     'TestCommandFileFull',
+    'TestCompressedIndex',
     'TestDailyProposed',
     'TestFileOrder',
+    'TestIncrementalIndex',
     'TestKeyringDoubleChecks',
     'TestMaximumImage',
     'TestMiscellaneous',
     'TestPhasedUpdates',
+    'TestSavedCheck',
     'TestState',
     'TestStateDuplicateDestinations',
     'TestStateNewChannelsFormat',
@@ -34,6 +37,7 @@ __all__ = [
 
 
 import os
+import json
 import shutil
 import hashlib
 import unittest
@@ -44,17 +48,21 @@ from functools import partial
 from subprocess import CalledProcessError
 from systemimage.candidates import version_filter
 from systemimage.config import config
-from systemimage.download import DuplicateDestinationError
+from systemimage.download import (
+    DownloadManagerBase, DuplicateDestinationError)
 from systemimage.gpg import Context, SignatureError
 from systemimage.helpers import calculate_signature
-from systemimage.state import ChecksumError, State
+from systemimage.incremental import incremental_index
+from systemimage.scores import CacheAwareScorer
+from systemimage.state import (
+    CHECK_FILE, DECOMPRESSORS, ChecksumError, State)
 from systemimage.testing.demo import DemoDevice
 from systemimage.testing.helpers import (
     ServerTestBase, configuration, copy, data_path, descriptions, get_index,
     make_http_server, setup_keyring_txz, setup_keyrings, sign,
     temporary_directory, touch_build)
 from systemimage.testing.nose import SystemImagePlugin
-from unittest.mock import call, patch
+from unittest.mock import Mock, call, patch
 
 BAD_SIGNATURE = 'f' * 64
 
@@ -1341,6 +1349,38 @@ class TestCachedFiles(ServerTestBase):
                          set(('5.txt', '6.txt', '7.txt',
                               '5.txt.asc', '6.txt.asc', '7.txt.asc')))
 
+    @configuration
+    def test_cached_file_changes_after_scoring(self):
+        # The scorer saw all the files in the cache, but one of them changed
+        # before the download, so it gets downloaded again.
+        self._setup_server_keyrings()
+        touch_build(0)
+        for path in ('3/4/5.txt', '4/5/6.txt', '5/6/7.txt'):
+            data_file = os.path.join(self._serverdir, path)
+            shutil.copy(data_file, config.updater.cache_partition)
+            shutil.copy(data_file + '.asc', config.updater.cache_partition)
+        state = State()
+        with patch('systemimage.state.config.hooks.scorer', CacheAwareScorer):
+            state.run_thru('calculate_winner')
+        self.assertIsNotNone(state.winner)
+        # The new file is still signed with the right key, but its checksum
+        # is wrong.
+        data_file = os.path.join(config.updater.cache_partition, '7.txt')
+        with open(data_file, 'wb') as fp:
+            fp.write(b'xxx')
+        sign(data_file, 'image-signing.gpg')
+        requested_downloads = set()
+        old_get_files = state.downloader.get_files
+        def get_files(downloads, *args, **kws):
+            for record in downloads:
+                requested_downloads.add(os.path.basename(record.destination))
+            return old_get_files(downloads, *args, **kws)
+        state.downloader.get_files = get_files
+        state.run_thru('download_files')
+        self.assertEqual(requested_downloads, set(('7.txt', '7.txt.asc')))
+        with open(data_file, 'rb') as fp:
+            self.assertNotEqual(fp.read(), b'xxx')
+
     @configuration
     def test_cached_files_all_have_bad_hashes(self):
         # All the data files are cached, and the signatures match, but the
@@ -1759,3 +1799,328 @@ update 7.txt 7.txt.asc
 update 5.txt 5.txt.asc
 unmount system
 """)
+
+
+class TestIncrementalIndex(ServerTestBase):
+    """Incremental indexes are used when they cover the current build."""
+
+    INDEX_FILE = 'state.index_01.json'
+    CHANNEL_FILE = 'state.channels_08.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+    SIGNING_KEY = 'image-signing.gpg'
+
+    def _publish(self, since, declared=None):
+        # Generate an incremental index from the full index, sign it, and put
+        # it on the server.  `declared` is the build the index itself claims
+        # to be good for, if that's different.
+        with open(data_path(self.INDEX_FILE), encoding='utf-8') as fp:
+            incremental = json.loads(incremental_index(fp.read(), since))
+        if declared is not None:
+            incremental['global']['since'] = declared
+        path = os.path.join(
+            self._serverdir, self.CHANNEL, self.DEVICE,
+            'index-since-{}.json'.format(since))
+        with open(path, 'w', encoding='utf-8') as fp:
+            json.dump(incremental, fp)
+        sign(path, self.SIGNING_KEY)
+
+    def _check(self, build):
+        self._setup_server_keyrings(device_signing=False)
+        touch_build(build)
+        state = State()
+        state.run_until('download_files')
+        return state
+
+    @configuration
+    def test_incremental_index(self):
+        # The device is at build 300, so the incremental index since 300 has
+        # everything it needs.
+        self._publish(200)
+        self._publish(300)
+        state = self._check(300)
+        self.assertEqual(state.index.global_.since, 300)
+        self.assertEqual(
+            sorted(image.version for image in state.index.images),
+            [301, 304])
+        self.assertEqual([image.version for image in state.winner],
+                         [301, 304])
+
+    @configuration
+    def test_best_incremental_index(self):
+        # The device is at build 250, so it needs the incremental index since
+        # 200.
+        self._publish(200)
+        self._publish(300)
+        state = self._check(250)
+        self.assertEqual(state.index.global_.since, 200)
+        self.assertEqual([image.version for image in state.winner],
+                         [300, 301, 304])
+
+    @configuration
+    def test_below_window(self):
+        # The device is too old for any incremental index.
+        self._publish(200)
+        self._publish(300)
+        state = self._check(100)
+        self.assertIsNone(getattr(state.index.global_, 'since', None))
+        self.assertEqual([image.version for image in state.winner],
+                         [200, 201, 304])
+
+    @configuration
+    def test_missing_incremental_index(self):
+        # channels.json advertises an incremental index which isn't on the
+        # server, so the full index is used.
+        state = self._check(300)
+        self.assertIsNone(getattr(state.index.global_, 'since', None))
+        self.assertEqual([image.version for image in state.winner],
+                         [301, 304])
+
+    @configuration
+    def test_wrong_incremental_index(self):
+        # The incremental index doesn't cover the build channels.json says it
+        # does, so the full index is used.
+        self._publish(300, declared=301)
+        state = self._check(300)
+        self.assertIsNone(getattr(state.index.global_, 'since', None))
+        self.assertEqual([image.version for image in state.winner],
+                         [301, 304])
+
+
+class TestCompressedIndex(ServerTestBase):
+    """Compressed indexes are used when channels.json says they exist."""
+
+    INDEX_FILE = 'state.index_01.json'
+    CHANNEL_FILE = 'state.channels_09.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+    SIGNING_KEY = 'image-signing.gpg'
+
+    def _publish(self, filename, contents, compression):
+        # The signature is over the compressed file.
+        path = os.path.join(
+            self._serverdir, self.CHANNEL, self.DEVICE,
+            filename + '.' + compression)
+        with DECOMPRESSORS[compression](path, 'wt', encoding='utf-8') as fp:
+            fp.write(contents)
+        sign(path, self.SIGNING_KEY)
+
+    def _check(self, build):
+        self._setup_server_keyrings(device_signing=False)
+        touch_build(build)
+        state = State()
+        with patch('systemimage.state.DECOMPRESSORS',
+                   {key: Mock(wraps=value)
+                    for key, value in DECOMPRESSORS.items()}) as mocks:
+            state.run_until('download_files')
+        return state, mocks['xz'].call_count
+
+    @configuration
+    def test_compressed_index(self):
+        with open(data_path(self.INDEX_FILE), encoding='utf-8') as fp:
+            self._publish('index.json', fp.read(), 'xz')
+        state, decompressed = self._check(200)
+        self.assertEqual(decompressed, 1)
+        self.assertEqual(len(state.index.images), 8)
+        self.assertEqual([image.version for image in state.winner],
+                         [300, 301, 304])
+
+    @configuration
+    def test_missing_compressed_index(self):
+        # The uncompressed index is used if the compressed one is missing.
+        state, decompressed = self._check(200)
+        self.assertEqual(decompressed, 0)
+        self.assertEqual([image.version for image in state.winner],
+                         [300, 301, 304])
+
+    @configuration
+    def test_compressed_incremental_index(self):
+        # Incremental indexes can be compressed too.
+        with open(data_path(self.INDEX_FILE), encoding='utf-8') as fp:
+            self._publish('index-since-300.json',
+                          incremental_index(fp.read(), 300), 'xz')
+        state, decompressed = self._check(300)
+        self.assertEqual(decompressed, 1)
+        self.assertEqual(state.index.global_.since, 300)
+        self.assertEqual([image.version for image in state.winner],
+                         [301, 304])
+
+    @configuration
+    def test_bad_signature(self):
+        # The signature must be over the compressed index.
+        path = os.path.join(
+            self._serverdir, self.CHANNEL, self.DEVICE, 'index.json')
+        shutil.copy(path + '.asc', path + '.xz.asc')
+        with open(path, encoding='utf-8') as fp:
+            contents = fp.read()
+        with DECOMPRESSORS['xz'](path + '.xz', 'wt', encoding='utf-8') as fp:
+            fp.write(contents)
+        self._setup_server_keyrings(device_signing=False)
+        touch_build(200)
+        self.assertRaises(SignatureError, State().run_until, 'download_files')
+
+
+class TestSavedCheck(ServerTestBase):
+    CHANNEL_FILE = 'state.channels_03.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+    INDEX_FILE = 'state.index_03.json'
+    SIGNING_KEY = 'image-signing.gpg'
+
+    def _check(self):
+        # Do a full check in one process and save it.
+        self._setup_server_keyrings(device_signing=False)
+        touch_build(0)
+        state = State()
+        state.run_thru('calculate_winner')
+        state.save_check()
+        self.assertEqual([image.version for image in state.winner], [1600])
+
+    def _resume(self):
+        # Resume the saved check in a later process, and return the state
+        # machine and the urls it downloaded.
+        state = State()
+        with patch('systemimage.download.DownloadManagerBase.get_files',
+                   autospec=True,
+                   side_effect=DownloadManagerBase.get_files) as mock:
+            resumed = state.resume_check()
+        urls = [download[0]
+                for args, kws in mock.call_args_list
+                for download in args[1]]
+        return state, resumed, urls
+
+    @configuration
+    def test_resume(self):
+        # A later process resumes from the saved check after only looking at
+        # channels.json and a couple of signatures.
+        self._check()
+        state, resumed, urls = self._resume()
+        self.assertTrue(resumed)
+        self.assertEqual(sorted(urls), [
+            'https://localhost:8943/channels.json',
+            'https://localhost:8943/gpg/blacklist.tar.xz.asc',
+            'https://localhost:8943/stable/nexus7/index.json.asc',
+            ])
+        self.assertEqual([image.version for image in state.winner], [1600])
+        self.assertEqual(descriptions(state.winner), ['Full'])
+        self.assertIn('stable', state.channels)
+        # The state machine carries on with downloading the files.
+        state.run_thru('download_files')
+        self.assertEqual(set(os.listdir(config.updater.cache_partition)),
+                         set(('5.txt', '6.txt', '7.txt',
+                              '5.txt.asc', '6.txt.asc', '7.txt.asc')))
+
+    @configuration
+    def test_no_saved_check(self):
+        state = State()
+        self.assertFalse(state.resume_check())
+        self.assertIsNone(state.winner)
+
+    @configuration
+    def test_new_index(self):
+        # When the index has changed on the server, the check must be done
+        # again.
+        self._check()
+        index_asc = os.path.join(
+            self._serverdir, 'stable', 'nexus7', 'index.json.asc')
+        with open(index_asc, 'a', encoding='utf-8') as fp:
+            print(file=fp)
+        state, resumed, urls = self._resume()
+        self.assertFalse(resumed)
+        self.assertIsNone(state.winner)
+        # The state machine is as good as new.
+        state.run_thru('calculate_winner')
+        self.assertEqual([image.version for image in state.winner], [1600])
+
+    @configuration
+    def test_new_blacklist(self):
+        self._check()
+        os.remove(os.path.join(
+            config.updater.data_partition, 'blacklist.tar.xz.asc'))
+        state, resumed, urls = self._resume()
+        self.assertFalse(resumed)
+
+    @configuration
+    def test_new_build(self):
+        # The saved check is for a different build.
+        self._check()
+        touch_build(1600)
+        config.reload()
+        state, resumed, urls = self._resume()
+        self.assertFalse(resumed)
+        # Nothing was downloaded to find that out.
+        self.assertEqual(urls, [])
+
+    @configuration
+    def test_expired_keyring(self):
+        # A keyring which expired after the check was saved looks just the
+        # same on disk, but the full check has to replace it.
+        self._setup_server_keyrings(device_signing=False)
+        expiry = datetime.now(tz=timezone.utc) + timedelta(days=1)
+        setup_keyring_txz(
+            'image-signing.gpg', 'image-master.gpg',
+            dict(type='image-signing', expiry=expiry.timestamp()),
+            os.path.join(self._serverdir, 'gpg', 'image-signing.tar.xz'))
+        touch_build(0)
+        state = State()
+        state.run_thru('calculate_winner')
+        state.save_check()
+        # The check is resumed until the keyring expires.
+        state, resumed, urls = self._resume()
+        self.assertTrue(resumed)
+        with patch('systemimage.state.datetime') as mock:
+            mock.now.return_value = expiry + timedelta(days=1)
+            state, resumed, urls = self._resume()
+        self.assertFalse(resumed)
+        self.assertIsNone(state.winner)
+        self.assertEqual(urls, [])
+
+    @configuration
+    def test_new_updater_settings(self):
+        # The [updater] settings can change which path wins.
+        self._check()
+        config.updater.reboot_cost = timedelta(minutes=5)
+        state, resumed, urls = self._resume()
+        self.assertFalse(resumed)
+        self.assertEqual(urls, [])
+
+    @configuration
+    def test_downloaded_forgets(self):
+        # Once the files are downloaded and verified, the saved check is
+        # forgotten.
+        self._check()
+        path = os.path.join(config.updater.data_partition, CHECK_FILE)
+        state, resumed, urls = self._resume()
+        self.assertTrue(resumed)
+        self.assertTrue(os.path.exists(path))
+        state.run_thru('download_files')
+        self.assertFalse(os.path.exists(path))
+
+    @configuration
+    def test_failed_download_keeps(self):
+        # If the download fails, the saved check is kept for next time.
+        self._check()
+        path = os.path.join(config.updater.data_partition, CHECK_FILE)
+        state = State()
+        self.assertTrue(state.resume_check())
+        with patch.object(state.downloader, 'get_files',
+                          side_effect=FileNotFoundError):
+            self.assertRaises(FileNotFoundError,
+                              state.run_thru, 'download_files')
+        self.assertTrue(os.path.exists(path))
+        state, resumed, urls = self._resume()
+        self.assertTrue(resumed)
+
+    @configuration
+    def test_up_to_date_forgets(self):
+        # When a later check finds no update, the saved check is forgotten.
+        self._check()
+        path = os.path.join(config.updater.data_partition, CHECK_FILE)
+        self.assertTrue(os.path.exists(path))
+        touch_build(1600)
+        config.reload()
+        state = State()
+        state.run_thru('calculate_winner')
+        self.assertEqual(state.winner, [])
+        state.save_check()
+        self.assertFalse(os.path.exists(path))
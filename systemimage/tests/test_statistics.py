@@ -0,0 +1,251 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the persistent statistics."""
+
+__all__ = [
+    'TestStatistics',
+    ]
+
+
+import os
+import json
+import stat
+import unittest
+
+from systemimage.statistics import STATISTICS_FILE, Statistics
+from systemimage.testing.helpers import configuration
+from unittest.mock import patch
+
+
+class TestStatistics(unittest.TestCase):
+    @configuration
+    def test_counters(self):
+        # Counters start at zero and can be incremented.
+        statistics = Statistics()
+        statistics.increment('checks')
+        statistics.increment('payload_bytes', 1000)
+        statistics.increment('payload_bytes', 24)
+        counters = statistics.as_dict()['counters']
+        self.assertEqual(counters['checks'], 1)
+        self.assertEqual(counters['payload_bytes'], 1024)
+        self.assertEqual(counters['metadata_bytes'], 0)
+
+    @configuration
+    def test_unknown_counter(self):
+        # Only the known counters can be incremented.
+        statistics = Statistics()
+        self.assertRaises(KeyError, statistics.increment, 'bogus')
+
+    @configuration
+    def test_failures(self):
+        # Failures are counted in total and by exception class.
+        statistics = Statistics()
+        statistics.failure('FileNotFoundError')
+        statistics.failure('SignatureError')
+        statistics.failure('FileNotFoundError')
+        snapshot = statistics.as_dict()
+        self.assertEqual(snapshot['counters']['failures'], 3)
+        self.assertEqual(snapshot['failures'], dict(
+            FileNotFoundError=2, SignatureError=1))
+
+    @configuration
+    def test_gpg(self):
+        # gpg invocations are counted and timed.
+        statistics = Statistics()
+        with statistics.gpg():
+            pass
+        with statistics.gpg():
+            pass
+        counters = statistics.as_dict()['counters']
+        self.assertEqual(counters['gpg_invocations'], 2)
+        self.assertIsInstance(counters['gpg_seconds'], float)
+        self.assertGreaterEqual(counters['gpg_seconds'], 0)
+
+    @configuration
+    def test_throughput(self):
+        # Download throughputs are recorded in a histogram.
+        statistics = Statistics()
+        # 10KiB/s, 100KiB/s, and 1GiB/s.
+        statistics.throughput(10 * 1024, 1)
+        statistics.throughput(100 * 1024, 1)
+        statistics.throughput(1024 ** 3, 1)
+        # Empty downloads don't count.
+        statistics.throughput(0, 1)
+        throughput = statistics.as_dict()['throughput']
+        self.assertEqual(throughput['counts'], [1, 0, 1, 0, 0, 0, 0, 1])
+        self.assertEqual(throughput['sum'], (10 + 100) * 1024 + 1024 ** 3)
+
+    @configuration
+    def test_throughput_estimate(self):
+        # The update file downloads make a moving estimate of this device's
+        # throughput.
+        statistics = Statistics()
+        self.assertIsNone(statistics.estimated_throughput())
+        statistics.throughput(1000, 1, payload=True)
+        self.assertEqual(statistics.estimated_throughput(), 1000)
+        # The newest download counts for 30%.
+        statistics.throughput(2000, 1, payload=True)
+        self.assertAlmostEqual(statistics.estimated_throughput(), 1300)
+        # Metadata downloads are too small to say anything.
+        statistics.throughput(10, 1)
+        self.assertAlmostEqual(statistics.estimated_throughput(), 1300)
+        statistics.save()
+        self.assertAlmostEqual(Statistics().estimated_throughput(), 1300)
+
+    @configuration
+    def test_persistence(self, config):
+        # Statistics are saved next to the settings database, and loaded by
+        # the next process.
+        statistics = Statistics()
+        statistics.increment('checks', 3)
+        statistics.failure('FileNotFoundError')
+        statistics.throughput(10 * 1024, 1)
+        statistics.save()
+        path = os.path.join(
+            os.path.dirname(config.system.settings_db), STATISTICS_FILE)
+        self.assertTrue(os.path.exists(path))
+        statistics = Statistics()
+        statistics.increment('checks')
+        snapshot = statistics.as_dict()
+        self.assertEqual(snapshot['counters']['checks'], 4)
+        self.assertEqual(snapshot['failures'], dict(FileNotFoundError=1))
+        self.assertEqual(snapshot['throughput']['counts'][0], 1)
+
+    @configuration
+    def test_reset(self):
+        # Resetting the statistics forgets the saved ones too.
+        statistics = Statistics()
+        statistics.increment('checks')
+        statistics.save()
+        statistics.reset()
+        self.assertEqual(statistics.as_dict()['counters']['checks'], 0)
+        self.assertEqual(Statistics().as_dict()['counters']['checks'], 0)
+
+    @configuration
+    def test_unreadable(self, config):
+        # A corrupt statistics file is ignored.
+        path = os.path.join(
+            os.path.dirname(config.system.settings_db), STATISTICS_FILE)
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write('{ not json')
+        statistics = Statistics()
+        statistics.increment('checks')
+        self.assertEqual(statistics.as_dict()['counters']['checks'], 1)
+
+    @configuration
+    def test_prometheus(self):
+        # The statistics can be rendered in the Prometheus text format.
+        statistics = Statistics()
+        statistics.increment('checks', 2)
+        statistics.failure('FileNotFoundError')
+        statistics.throughput(10 * 1024, 1)
+        statistics.throughput(100 * 1024, 1)
+        lines = statistics.as_prometheus().splitlines()
+        self.assertIn('# TYPE systemimage_checks_total counter', lines)
+        self.assertIn('systemimage_checks_total 2', lines)
+        self.assertIn(
+            'systemimage_failures_total{exception="FileNotFoundError"} 1',
+            lines)
+        # Histogram buckets are cumulative.
+        metric = 'systemimage_download_throughput_bytes_per_second'
+        self.assertIn(metric + '_bucket{le="16384"} 1', lines)
+        self.assertIn(metric + '_bucket{le="65536"} 1', lines)
+        self.assertIn(metric + '_bucket{le="262144"} 2', lines)
+        self.assertIn(metric + '_bucket{le="+Inf"} 2', lines)
+        self.assertIn(metric + '_count 2', lines)
+
+    @configuration
+    def test_textfile(self, config):
+        # When configured, saving also writes the Prometheus textfile, which
+        # the exporter must be able to read.
+        textfile = os.path.join(config.tempdir, 'systemimage.prom')
+        config.system.stats_textfile = textfile
+        statistics = Statistics()
+        statistics.increment('checks')
+        statistics.save()
+        with open(textfile, encoding='utf-8') as fp:
+            self.assertIn('systemimage_checks_total 1\n', fp.read())
+        self.assertEqual(stat.filemode(os.stat(textfile).st_mode),
+                         '-rw-r--r--')
+
+    @configuration
+    def test_no_textfile(self, config):
+        # By default, there's no Prometheus export.
+        self.assertEqual(config.system.stats_textfile, '')
+        statistics = Statistics()
+        statistics.save()
+        self.assertEqual(
+            [name for name in os.listdir(config.tempdir)
+             if name.endswith('.prom')], [])
+
+    @configuration
+    def test_saved_json(self, config):
+        # The saved file is plain JSON.
+        statistics = Statistics()
+        statistics.increment('retries')
+        statistics.save()
+        path = os.path.join(
+            os.path.dirname(config.system.settings_db), STATISTICS_FILE)
+        with open(path, encoding='utf-8') as fp:
+            saved = json.load(fp)
+        self.assertEqual(saved['counters']['retries'], 1)
+
+    @configuration
+    def test_concurrent_saves(self, config):
+        # The D-Bus service and system-image-cli may both be counting.  Each
+        # adds its own counts to the saved ones, rather than overwriting
+        # them.
+        first = Statistics()
+        second = Statistics()
+        first.increment('checks')
+        second.increment('checks', 2)
+        second.failure('FileNotFoundError')
+        second.throughput(10 * 1024, 1, payload=True)
+        first.save()
+        second.save()
+        first.increment('checks')
+        first.failure('FileNotFoundError')
+        first.save()
+        snapshot = Statistics().as_dict()
+        self.assertEqual(snapshot['counters']['checks'], 4)
+        self.assertEqual(snapshot['counters']['failures'], 2)
+        self.assertEqual(snapshot['failures'], dict(FileNotFoundError=2))
+        self.assertEqual(snapshot['throughput']['counts'][0], 1)
+        self.assertAlmostEqual(snapshot['throughput']['estimate'], 10240)
+        # After saving, each process sees the other's counts too.
+        self.assertEqual(first.as_dict()['counters']['checks'], 4)
+
+    @configuration
+    def test_nothing_to_save(self, config):
+        # When nothing was counted, nothing is saved.
+        Statistics().save()
+        path = os.path.join(
+            os.path.dirname(config.system.settings_db), STATISTICS_FILE)
+        self.assertFalse(os.path.exists(path))
+
+    @configuration
+    def test_cannot_save(self):
+        # Users who can't write the statistics just don't save them, with
+        # nothing more than a debug message.
+        statistics = Statistics()
+        statistics.increment('checks')
+        with patch('systemimage.statistics.atomic',
+                   side_effect=PermissionError), \
+                patch('systemimage.statistics.log') as log:
+            statistics.save()
+        self.assertEqual(log.debug.call_count, 1)
+        self.assertEqual(log.exception.call_count, 0)
+        self.assertEqual(Statistics().as_dict()['counters']['checks'], 0)
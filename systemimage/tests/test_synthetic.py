@@ -0,0 +1,93 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the synthetic server data used by the benchmarks."""
+
+__all__ = [
+    'TestSyntheticChannels',
+    'TestSyntheticIndex',
+    ]
+
+
+import unittest
+
+from systemimage.candidates import get_candidates
+from systemimage.channel import Channels
+from systemimage.index import Index
+from systemimage.testing.synthetic import make_channels, make_index
+
+
+class TestSyntheticIndex(unittest.TestCase):
+    def test_ladder(self):
+        # Two fulls with ten versions between them, reachable by deltas.
+        index = Index.from_json(make_index(fulls=2, delta_chain=10))
+        fulls = [image.version for image in index.images
+                 if image.type == 'full']
+        deltas = [image for image in index.images if image.type == 'delta']
+        self.assertEqual(fulls, [1, 12])
+        self.assertEqual(len(deltas), 21)
+        for delta in deltas:
+            self.assertEqual(delta.base, delta.version - 1)
+        # From version 1, either take all the deltas, or start at the second
+        # full and take the deltas from there.
+        candidates = get_candidates(index, 1)
+        self.assertEqual(
+            sorted([image.version for image in path][0]
+                   for path in candidates),
+            [2, 12])
+
+    def test_forks(self):
+        # With a fork factor of 2, each version can be reached from the two
+        # before it, so the number of paths from 1 to 6 is the number of ways
+        # of adding up 1s and 2s to 5.
+        index = Index.from_json(
+            make_index(fulls=1, delta_chain=5, fork_factor=2))
+        self.assertEqual(len(get_candidates(index, 1)), 8)
+
+    def test_files_and_locales(self):
+        index = Index.from_json(make_index(
+            fulls=1, delta_chain=0, files_per_image=4, locales=30))
+        image = index.images[0]
+        self.assertEqual([filerec.order for filerec in image.files],
+                         [1, 2, 3, 4])
+        for filerec in image.files:
+            self.assertEqual(filerec.signature, filerec.path + '.asc')
+            self.assertEqual(len(filerec.checksum), 64)
+        self.assertEqual(len(image.descriptions), 31)
+        self.assertIn('description-ab', image.descriptions)
+
+    def test_deterministic(self):
+        # The same arguments always give the same data.
+        self.assertEqual(make_index(seed=7), make_index(seed=7))
+        self.assertNotEqual(make_index(seed=7), make_index(seed=8))
+
+
+class TestSyntheticChannels(unittest.TestCase):
+    def test_channels(self):
+        channels = Channels.from_json(make_channels(
+            channels=4, devices=3, hidden=1, aliases=1))
+        self.assertEqual(sorted(channels), [
+            'channel-0', 'channel-1', 'channel-2', 'channel-3'])
+        self.assertTrue(channels['channel-0'].hidden)
+        self.assertFalse(channels['channel-1'].hidden)
+        self.assertEqual(channels['channel-3'].alias, 'channel-0')
+        devices = channels['channel-1'].devices
+        self.assertEqual(sorted(devices),
+                         ['device-0', 'device-1', 'device-2'])
+        self.assertEqual(devices['device-1'].index,
+                         '/channel-1/device-1/index.json')
+        self.assertEqual(devices['device-0'].keyring.signature,
+                         '/channel-1/device-0/device-signing.tar.xz.asc')
+        self.assertIsNone(getattr(devices['device-1'], 'keyring', None))
@@ -0,0 +1,129 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the state machine tracing."""
+
+__all__ = [
+    'TestTracer',
+    ]
+
+
+import os
+import json
+import unittest
+
+from systemimage.trace import Tracer, traced
+from threading import Thread
+from unittest.mock import patch
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tracer = Tracer()
+        self.tracer.reset()
+
+    def test_span(self):
+        # A span records its start and stop times.
+        with self.tracer.span('one', 'test') as span:
+            self.assertIsNone(span.stop)
+        self.assertGreaterEqual(span.stop, span.start)
+        self.assertEqual(self.tracer.spans, [span])
+
+    def test_span_exception(self):
+        # A span is recorded even if the traced operation fails.
+        with self.assertRaises(RuntimeError):
+            with self.tracer.span('one'):
+                raise RuntimeError
+        self.assertEqual([span.name for span in self.tracer.spans], ['one'])
+
+    def test_nested_bytes(self):
+        # Bytes counted in a nested span also count in the enclosing span.
+        with self.tracer.span('outer') as outer:
+            self.tracer.add_bytes(10)
+            with self.tracer.span('inner') as inner:
+                self.tracer.add_bytes(5)
+        self.assertEqual(inner.bytes, 5)
+        self.assertEqual(outer.bytes, 15)
+        # The spans are listed in the order they started.
+        self.assertEqual(self.tracer.spans, [outer, inner])
+
+    def test_no_span(self):
+        # Counting outside of any span is harmless.
+        self.tracer.add_bytes(10)
+        self.tracer.add_subprocess()
+        self.assertEqual(self.tracer.spans, [])
+
+    def test_reset(self):
+        # Resetting the tracer forgets the last run.
+        with self.tracer.span('one'):
+            pass
+        self.tracer.reset()
+        self.assertEqual(self.tracer.spans, [])
+
+    def test_subprocesses(self):
+        # Spawned subprocesses are counted in the current span, and in the
+        # spans enclosing it.
+        with self.tracer.span('outer') as outer:
+            with self.tracer.span('inner') as inner:
+                self.tracer.add_subprocess()
+            self.tracer.add_subprocess()
+        self.assertEqual(inner.subprocesses, 1)
+        self.assertEqual(outer.subprocesses, 2)
+
+    def test_threads(self):
+        # Spans in other threads don't nest in this thread's spans.
+        def worker():
+            with self.tracer.span('worker'):
+                self.tracer.add_bytes(10)
+        with self.tracer.span('main') as main:
+            thread = Thread(target=worker)
+            thread.start()
+            thread.join()
+        self.assertEqual(main.bytes, 0)
+        spans = {span.name: span for span in self.tracer.spans}
+        self.assertEqual(spans['worker'].bytes, 10)
+        self.assertNotEqual(spans['worker'].thread_id, main.thread_id)
+
+    def test_traced(self):
+        # The decorator runs the function in a span of the global tracer.
+        @traced('decorated', 'test')
+        def function(a, b):
+            return a + b
+        with patch('systemimage.trace.tracer', self.tracer):
+            self.assertEqual(function(1, 2), 3)
+        spans = self.tracer.spans
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0].name, 'decorated')
+        self.assertEqual(spans[0].category, 'test')
+
+    def test_chrome_trace(self):
+        # The spans export as Chrome trace-event "complete" events.
+        with self.tracer.span('outer', 'test'):
+            with self.tracer.span('inner', 'test'):
+                self.tracer.add_bytes(7)
+        trace = json.loads(self.tracer.as_chrome_trace())
+        self.assertEqual(trace['displayTimeUnit'], 'ms')
+        outer, inner = trace['traceEvents']
+        self.assertEqual(outer['name'], 'outer')
+        self.assertEqual(outer['cat'], 'test')
+        self.assertEqual(outer['ph'], 'X')
+        self.assertEqual(outer['pid'], os.getpid())
+        self.assertEqual(outer['args'], dict(bytes=7, subprocesses=0))
+        self.assertEqual(inner['name'], 'inner')
+        # The inner event lies within the outer one.
+        self.assertGreaterEqual(inner['ts'], outer['ts'])
+        self.assertLessEqual(inner['ts'] + inner['dur'],
+                             outer['ts'] + outer['dur'] + 1)
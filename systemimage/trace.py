@@ -0,0 +1,157 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing and tracing of state machine runs.
+
+Each state machine step, and some of the more expensive operations nested
+inside the steps, are recorded as spans, with their monotonic start and stop
+times, the number of bytes they transferred or parsed, and the number of
+subprocesses (e.g. gpg) they spawned.  The spans of the last run can be
+dumped in the Chrome trace-event format, which chrome://tracing and other
+trace viewers can load.
+"""
+
+__all__ = [
+    'Span',
+    'Tracer',
+    'traced',
+    'tracer',
+    ]
+
+
+import os
+import json
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, get_ident, local
+from time import monotonic
+
+
+class Span:
+    """A single timed operation."""
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+        self.start = monotonic()
+        self.stop = None
+        self.bytes = 0
+        self.subprocesses = 0
+        self.thread_id = get_ident()
+
+    @property
+    def duration(self):
+        return (None if self.stop is None else self.stop - self.start)
+
+    def as_event(self, pid):
+        """Return the span as a Chrome trace-event "complete" event."""
+        # Trace-event times are in microseconds.
+        return dict(
+            name=self.name,
+            cat=self.category,
+            ph='X',
+            ts=int(self.start * 1000000),
+            dur=int((self.stop - self.start) * 1000000),
+            pid=pid,
+            tid=self.thread_id,
+            args=dict(bytes=self.bytes, subprocesses=self.subprocesses),
+            )
+
+
+class Tracer:
+    """Collect the spans of the current (or last) run."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self._spans = []
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def reset(self):
+        """Start a new run, forgetting the spans of the last one."""
+        with self._lock:
+            self._spans = []
+
+    @contextmanager
+    def span(self, name, category='systemimage'):
+        """Time the enclosed block as a span.
+
+        Spans nest.  The bytes and subprocesses counted in a span are also
+        counted in all the spans enclosing it.
+        """
+        span = Span(name, category)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.stop = monotonic()
+            stack.pop()
+            if len(stack) > 0:
+                stack[-1].bytes += span.bytes
+                stack[-1].subprocesses += span.subprocesses
+            with self._lock:
+                self._spans.append(span)
+
+    def add_bytes(self, count):
+        """Count some bytes in the current span, if there is one."""
+        stack = self._stack()
+        if len(stack) > 0:
+            stack[-1].bytes += count
+
+    def add_subprocess(self):
+        """Count a subprocess in the current span, if there is one.
+
+        Call this wherever a subprocess is spawned, e.g. for gpg.
+        """
+        stack = self._stack()
+        if len(stack) > 0:
+            stack[-1].subprocesses += 1
+
+    @property
+    def spans(self):
+        """The finished spans, in the order they started."""
+        with self._lock:
+            spans = list(self._spans)
+        return sorted(spans, key=lambda span: span.start)
+
+    def as_chrome_trace(self):
+        """Return the finished spans as Chrome trace-event JSON."""
+        pid = os.getpid()
+        return json.dumps(dict(
+            traceEvents=[span.as_event(pid) for span in self.spans],
+            displayTimeUnit='ms',
+            ))
+
+
+def traced(name, category='systemimage'):
+    """Decorator which runs the decorated function in a span."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kws):
+            with tracer.span(name, category):
+                return function(*args, **kws)
+        return wrapper
+    return decorator
+
+
+# The process-wide tracer.
+tracer = Tracer()